@@ -242,7 +242,7 @@ class Agent(Daemon):
                     sys.path.append(lib_path)
 
         # Save the agent start-up stats.
-        CollectorStatus().persist()
+        CollectorStatus().publish()
 
         # Intialize the collector.
         if not config:
@@ -1,10 +1,12 @@
 # stdlib
 import sys
 import logging
-from time import time
+from time import sleep, time
 
 # project
 from checks.metric_types import MetricTypes
+from utils.hyperloglog import HyperLogLog
+from utils.sketch import DEFAULT_RELATIVE_ACCURACY, QuantileSketch
 
 log = logging.getLogger(__name__)
 
@@ -20,6 +22,17 @@ log = logging.getLogger(__name__)
 # MetricsBucketAggregator constructor.
 RECENT_POINT_THRESHOLD_DEFAULT = 3600
 
+# Estimated memory used by a context cache entry on top of its key: dict
+# slot, entry tuple and context tuple.
+CONTEXT_CACHE_ENTRY_OVERHEAD = 256
+
+# Tag of the context new contexts are folded into past a context budget
+OVERFLOW_TAG = 'stackstate.overflow:true'
+
+# How long the flushing thread sleeps between checks when it waits for the
+# receive path to finish writing to a retired generation.
+SUBMISSION_WAIT_INTERVAL = 0.0005
+
 
 class Infinity(Exception):
     pass
@@ -33,7 +46,13 @@ class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
+
+    There is one metric object per context, so metrics declare their attributes
+    in `__slots__` instead of having a `__dict__`, which more than halves their
+    size. Slotted objects are pickled with protocol 2, as multiprocessing does
+    for sharded handoffs.
     """
+    __slots__ = ('formatter', 'name', 'tags', 'hostname', 'device_name', 'last_sample_time')
 
     def sample(self, value, sample_rate, timestamp=None):
         """ Add a point to the given metric. """
@@ -43,9 +62,14 @@ class Metric(object):
         """ Flush all metrics up to the given timestamp. """
         raise NotImplementedError()
 
+    def merge(self, other):
+        """ Fold the samples of another metric of the same type and context into this one. """
+        raise NotImplementedError()
+
 
 class Raw(Metric):
     """ A metric that tracks a value at particular points in time and does not aggregate in any way """
+    __slots__ = ('values', 'timestamp')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -61,6 +85,9 @@ class Raw(Metric):
     def sample(self, value, sample_rate, timestamp=None):
         self.values.append((value, timestamp))
 
+    def merge(self, other):
+        self.values.extend(other.values)
+
     def flush(self, timestamp, interval):
         metrics = [self.formatter(
             metric=self.name,
@@ -78,6 +105,7 @@ class Raw(Metric):
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
+    __slots__ = ('value', 'timestamp')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -94,6 +122,13 @@ class Gauge(Metric):
         self.last_sample_time = time()
         self.timestamp = timestamp
 
+    def merge(self, other):
+        # Last write wins
+        if other.value is not None and other.last_sample_time >= self.last_sample_time:
+            self.value = other.value
+            self.last_sample_time = other.last_sample_time
+            self.timestamp = other.timestamp
+
     def flush(self, timestamp, interval):
         if self.value is not None:
             res = [self.formatter(
@@ -119,6 +154,7 @@ class BucketGauge(Gauge):
     opposed to the time that the sample was collected.
 
     """
+    __slots__ = ()
 
     def flush(self, timestamp, interval):
         if self.value is not None:
@@ -140,6 +176,7 @@ class BucketGauge(Gauge):
 
 class Count(Metric):
     """ A metric that tracks a count. """
+    __slots__ = ('value',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -154,6 +191,11 @@ class Count(Metric):
         self.value = (self.value or 0) + value
         self.last_sample_time = time()
 
+    def merge(self, other):
+        if other.value is not None:
+            self.value = (self.value or 0) + other.value
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         if self.value is None:
             return []
@@ -172,6 +214,7 @@ class Count(Metric):
             self.value = None
 
 class MonotonicCount(Metric):
+    __slots__ = ('prev_counter', 'curr_counter', 'count')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -220,6 +263,7 @@ class MonotonicCount(Metric):
 
 class Counter(Metric):
     """ A metric that tracks a counter value. """
+    __slots__ = ('value',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -234,6 +278,10 @@ class Counter(Metric):
         self.value += value * int(1 / sample_rate)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.value += other.value
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
         try:
             value = self.value / interval
@@ -255,6 +303,7 @@ DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
 
 class Histogram(Metric):
     """ A metric to track the distribution of a set of values. """
+    __slots__ = ('count', 'samples', 'aggregates', 'percentiles', 'relative_accuracy', 'sketch')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -267,6 +316,10 @@ class Histogram(Metric):
         self.percentiles = extra_config['percentiles'] if\
             extra_config is not None and extra_config.get('percentiles') is not None\
             else DEFAULT_HISTOGRAM_PERCENTILES
+        # Keep the samples in a bounded-memory sketch instead of a list when
+        # a relative accuracy is configured
+        self.relative_accuracy = extra_config.get('relative_accuracy') if extra_config is not None else None
+        self.sketch = QuantileSketch(self.relative_accuracy) if self.relative_accuracy else None
         self.tags = tags
         self.hostname = hostname
         self.device_name = device_name
@@ -274,20 +327,47 @@ class Histogram(Metric):
 
     def sample(self, value, sample_rate, timestamp=None):
         self.count += int(1 / sample_rate)
-        self.samples.append(value)
+        if self.sketch is not None:
+            self.sketch.add(value)
+        else:
+            self.samples.append(value)
         self.last_sample_time = time()
 
+    def merge(self, other):
+        self.count += other.count
+        if self.sketch is None and other.sketch is not None:
+            self.sketch = QuantileSketch(other.sketch.relative_accuracy)
+            for value in self.samples:
+                self.sketch.add(value)
+            self.samples = []
+        if self.sketch is None:
+            self.samples.extend(other.samples)
+        elif other.sketch is not None:
+            self.sketch.merge(other.sketch)
+        else:
+            for value in other.samples:
+                self.sketch.add(value)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, ts, interval):
         if not self.count:
             return []
 
-        self.samples.sort()
-        length = len(self.samples)
-
-        min_ = self.samples[0]
-        max_ = self.samples[-1]
-        med = self.samples[int(round(length/2 - 1))]
-        sum_ = sum(self.samples)
+        if self.sketch is not None:
+            length = self.sketch.count
+            min_ = self.sketch.min
+            max_ = self.sketch.max
+            sum_ = self.sketch.sum
+            value_at_rank = self.sketch.value_at_rank
+        else:
+            self.samples.sort()
+            length = len(self.samples)
+            min_ = self.samples[0]
+            max_ = self.samples[-1]
+            sum_ = sum(self.samples)
+            value_at_rank = self.samples.__getitem__
+
+        med = value_at_rank(int(round(length/2 - 1)))
         avg = sum_ / float(length)
 
         aggregators = [
@@ -317,7 +397,7 @@ class Histogram(Metric):
         ]
 
         for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
+            val = value_at_rank(int(round(p * length - 1)))
             name = '%s.%spercentile' % (self.name, int(p * 100))
             metrics.append(self.formatter(
                 hostname=self.hostname,
@@ -331,13 +411,71 @@ class Histogram(Metric):
 
         # Reset our state.
         self.samples = []
+        if self.sketch is not None:
+            self.sketch = QuantileSketch(self.relative_accuracy)
         self.count = 0
 
         return metrics
 
 
+class Distribution(Metric):
+    """
+    A metric to track the distribution of a set of values across hosts.
+
+    The values are counted in a QuantileSketch, which is flushed as is so that
+    the backend can merge the sketches of all the hosts before computing
+    percentiles. A sketch has at most DEFAULT_MAX_BINS (2048) bins of about
+    100 bytes each, so a context never uses more than about 200KB. With the
+    default 1% accuracy, values spanning 4 orders of magnitude fit in 460 bins.
+    """
+    __slots__ = ('relative_accuracy', 'sketch')
+
+    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
+        self.formatter = formatter
+        self.name = name
+        self.tags = tags
+        self.hostname = hostname
+        self.device_name = device_name
+        self.relative_accuracy = extra_config.get('relative_accuracy') if extra_config is not None else None
+        self.relative_accuracy = self.relative_accuracy or DEFAULT_RELATIVE_ACCURACY
+        self.sketch = QuantileSketch(self.relative_accuracy)
+        self.last_sample_time = None
+
+    def sample(self, value, sample_rate, timestamp=None):
+        self.sketch.add(value, int(1 / sample_rate))
+        self.last_sample_time = time()
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def flush(self, timestamp, interval):
+        if not self.sketch.count:
+            return []
+        try:
+            return [self.formatter(
+                hostname=self.hostname,
+                device_name=self.device_name,
+                tags=self.tags,
+                metric=self.name,
+                value=self.sketch.to_dict(),
+                timestamp=timestamp,
+                metric_type=MetricTypes.DISTRIBUTION,
+                interval=interval,
+            )]
+        finally:
+            self.sketch = QuantileSketch(self.relative_accuracy)
+
+
 class Set(Metric):
-    """ A metric to track the number of unique elements in a set. """
+    """
+    A metric to track the number of unique elements in a set.
+
+    When a cardinality threshold is configured, the values are counted with a
+    HyperLogLog once there are more distinct values than the threshold, which
+    bounds the memory used by the metric.
+    """
+    __slots__ = ('values', 'hll', 'cardinality_threshold', 'precision')
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -346,14 +484,42 @@ class Set(Metric):
         self.hostname = hostname
         self.device_name = device_name
         self.values = set()
+        self.hll = None
+        self.cardinality_threshold = extra_config.get('cardinality_threshold') if extra_config is not None else None
+        self.precision = extra_config.get('precision') if extra_config is not None else None
         self.last_sample_time = None
 
     def sample(self, value, sample_rate, timestamp=None):
-        self.values.add(value)
+        if self.hll is not None:
+            self.hll.add(value)
+        else:
+            self.values.add(value)
+            if self.cardinality_threshold and len(self.values) > self.cardinality_threshold:
+                self._to_hll(self.precision)
         self.last_sample_time = time()
 
+    def _to_hll(self, precision):
+        self.hll = HyperLogLog(precision) if precision else HyperLogLog()
+        for value in self.values:
+            self.hll.add(value)
+        self.values = set()
+
+    def merge(self, other):
+        if self.hll is None and other.hll is not None:
+            self._to_hll(other.hll.precision)
+        if self.hll is None:
+            self.values.update(other.values)
+            if self.cardinality_threshold and len(self.values) > self.cardinality_threshold:
+                self._to_hll(self.precision)
+        elif other.hll is not None:
+            self.hll.merge(other.hll)
+        else:
+            for value in other.values:
+                self.hll.add(value)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
     def flush(self, timestamp, interval):
-        if not self.values:
+        if not self.values and self.hll is None:
             return []
         try:
             return [self.formatter(
@@ -361,17 +527,19 @@ class Set(Metric):
                 device_name=self.device_name,
                 tags=self.tags,
                 metric=self.name,
-                value=len(self.values),
+                value=self.hll.count() if self.hll is not None else len(self.values),
                 timestamp=timestamp,
                 metric_type=MetricTypes.GAUGE,
                 interval=interval,
             )]
         finally:
             self.values = set()
+            self.hll = None
 
 
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
+    __slots__ = ('samples',)
 
     def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
         self.formatter = formatter
@@ -422,6 +590,239 @@ class Rate(Metric):
         finally:
             self.samples = self.samples[-1:]
 
+class Generation(object):
+    """
+    The state written by the receive path between two flushes.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.service_checks = []
+        self.count = 0
+        self.event_count = 0
+        self.service_check_count = 0
+        self.num_discarded_old_points = 0
+
+    def is_empty(self):
+        return not (self.events or self.service_checks or self.count or self.event_count
+                    or self.service_check_count or self.num_discarded_old_points)
+
+    def merge(self, other):
+        """
+        Move the content of `other`, which must not be written to anymore, into
+        this generation.
+        """
+        self.events.extend(other.events)
+        self.service_checks.extend(other.service_checks)
+        self.count += other.count
+        self.event_count += other.event_count
+        self.service_check_count += other.service_check_count
+        self.num_discarded_old_points += other.num_discarded_old_points
+
+
+class BucketGeneration(Generation):
+    """
+    Generation of a MetricsBucketAggregator, metrics are kept by bucket.
+    """
+
+    def __init__(self):
+        super(BucketGeneration, self).__init__()
+        self.metric_by_bucket = {}
+        # Cache of the bucket the receive path is writing to
+        self.current_bucket = None
+        self.current_mbc = {}
+        # Contexts admitted by the context guard, and their count by metric name
+        self.admitted_contexts = set()
+        self.context_count_by_name = {}
+        # Samples of contexts rejected by the context guard, by metric name
+        self.rejected_by_name = {}
+
+    def is_empty(self):
+        return not (self.metric_by_bucket or self.rejected_by_name) and super(BucketGeneration, self).is_empty()
+
+    def merge(self, other):
+        super(BucketGeneration, self).merge(other)
+        for name, count in other.rejected_by_name.iteritems():
+            self.rejected_by_name[name] = self.rejected_by_name.get(name, 0) + count
+        for bucket_start_timestamp, other_mbc in other.metric_by_bucket.iteritems():
+            metric_by_context = self.metric_by_bucket.get(bucket_start_timestamp)
+            if metric_by_context is None:
+                self.metric_by_bucket[bucket_start_timestamp] = other_mbc
+                continue
+            for context, other_metric in other_mbc.iteritems():
+                metric = metric_by_context.get(context)
+                if metric is None:
+                    metric_by_context[context] = other_metric
+                else:
+                    metric.merge(other_metric)
+
+
+class ExpiryWheel(object):
+    """
+    Last sample time of contexts, with the contexts indexed by slots of
+    `interval` seconds of their last sample time, so that the contexts due to
+    expire are found without scanning all of them.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_sample_time_by_context = {}
+        self.contexts_by_slot = {}
+
+    def __len__(self):
+        return len(self.last_sample_time_by_context)
+
+    def __iter__(self):
+        return iter(self.last_sample_time_by_context)
+
+    def _slot(self, timestamp):
+        return int(timestamp // self.interval)
+
+    def touch(self, context, last_sample_time):
+        slot = self._slot(last_sample_time)
+        previous = self.last_sample_time_by_context.get(context)
+        self.last_sample_time_by_context[context] = last_sample_time
+        if previous is not None:
+            previous_slot = self._slot(previous)
+            if previous_slot == slot:
+                return
+            self._remove_from_slot(context, previous_slot)
+        contexts = self.contexts_by_slot.get(slot)
+        if contexts is None:
+            contexts = self.contexts_by_slot[slot] = set()
+        contexts.add(context)
+
+    def discard(self, context):
+        last_sample_time = self.last_sample_time_by_context.pop(context, None)
+        if last_sample_time is not None:
+            self._remove_from_slot(context, self._slot(last_sample_time))
+
+    def _remove_from_slot(self, context, slot):
+        contexts = self.contexts_by_slot[slot]
+        contexts.discard(context)
+        if not contexts:
+            del self.contexts_by_slot[slot]
+
+    def expire(self, expiry_timestamp):
+        """
+        Remove and return the contexts last sampled before `expiry_timestamp`.
+        Only the slots up to that time are visited.
+        """
+        expired = []
+        expiry_slot = self._slot(expiry_timestamp)
+        last_sample_time_by_context = self.last_sample_time_by_context
+        for slot in [slot for slot in self.contexts_by_slot if slot <= expiry_slot]:
+            contexts = self.contexts_by_slot[slot]
+            if slot == expiry_slot:
+                due = [context for context in contexts if last_sample_time_by_context[context] < expiry_timestamp]
+                if len(due) < len(contexts):
+                    contexts.difference_update(due)
+                    contexts = due
+                else:
+                    del self.contexts_by_slot[slot]
+            else:
+                del self.contexts_by_slot[slot]
+            for context in contexts:
+                del last_sample_time_by_context[context]
+            expired.extend(contexts)
+        return expired
+
+
+class ContextCache(object):
+    """
+    Bounded cache of the contexts resolved from metric packet lines, keyed by
+    the line without its value.
+
+    Approximates an LRU with two generations: entries found in the old
+    generation are promoted to the new one, and the old generation is
+    evicted when the new one fills half of the memory budget.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.hot = {}
+        self.cold = {}
+        self.hot_bytes = 0
+        self.cold_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.hot) + len(self.cold)
+
+    @property
+    def size(self):
+        """
+        Estimated memory used by the entries, in bytes.
+        """
+        return self.hot_bytes + self.cold_bytes
+
+    def get(self, key):
+        entry = self.hot.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        entry = self.cold.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cold_bytes -= len(key) + CONTEXT_CACHE_ENTRY_OVERHEAD
+        self.set(key, entry)
+        return entry
+
+    def set(self, key, entry):
+        if key in self.hot:
+            return
+        self.hot[key] = entry
+        self.hot_bytes += len(key) + CONTEXT_CACHE_ENTRY_OVERHEAD
+        if self.hot_bytes * 2 >= self.max_bytes:
+            self.evictions += len(self.cold)
+            self.cold = self.hot
+            self.cold_bytes = self.hot_bytes
+            self.hot = {}
+            self.hot_bytes = 0
+
+
+class ContextGuard(object):
+    """
+    Bounds the number of contexts a generation admits, in total and by metric
+    name. Samples of the contexts past a budget are folded into a single
+    overflow context for their metric name, or dropped.
+
+    The budgets apply to each generation, so they are renewed every time the
+    flushing thread retires one.
+    """
+
+    def __init__(self, max_contexts=None, max_contexts_per_name=None, fold=True, exempt_prefix=None):
+        self.max_contexts = max_contexts or sys.maxint
+        self.max_contexts_per_name = max_contexts_per_name or sys.maxint
+        self.fold = fold
+        # Metric names never rejected, e.g. internal metrics
+        self.exempt_prefix = exempt_prefix
+
+    def admit(self, generation, context):
+        """
+        Return the context to add the sample to, None if it must be dropped.
+        """
+        name = context[0]
+        # Exempt contexts do not use up the budgets
+        if self.exempt_prefix and name.startswith(self.exempt_prefix):
+            return context
+        context_count = generation.context_count_by_name.get(name, 0)
+        if context_count < self.max_contexts_per_name and len(generation.admitted_contexts) < self.max_contexts:
+            generation.admitted_contexts.add(context)
+            generation.context_count_by_name[name] = context_count + 1
+            return context
+
+        generation.rejected_by_name[name] = generation.rejected_by_name.get(name, 0) + 1
+        if self.fold:
+            return (name, (OVERFLOW_TAG,), context[2], context[3])
+        return None
+
+
 class Aggregator(object):
     """
     Abstract metric aggregator class.
@@ -430,17 +831,19 @@ class Aggregator(object):
     ALLOW_STRINGS = ['s', ]
     # Types that are not implemented and ignored
     IGNORE_TYPES = ['d', ]
+    generation_class = Generation
 
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
-        self.events = []
-        self.service_checks = []
+            utf8_decoding=False, context_cache_max_bytes=None,
+            histogram_relative_accuracy=None, set_cardinality_threshold=None,
+            set_hll_precision=None):
+        self.generation = self.generation_class()
+        # Incremented by the receive path when it starts and when it is done
+        # writing a submission: it is odd while a submission is in flight.
+        self.submission_seq = 0
         self.total_count = 0
-        self.count = 0
-        self.event_count = 0
-        self.service_check_count = 0
         self.hostname = hostname
         self.expiry_seconds = expiry_seconds
         self.formatter = formatter or api_formatter
@@ -448,18 +851,54 @@ class Aggregator(object):
 
         recent_point_threshold = recent_point_threshold or RECENT_POINT_THRESHOLD_DEFAULT
         self.recent_point_threshold = int(recent_point_threshold)
-        self.num_discarded_old_points = 0
 
         # Additional config passed when instantiating metric configs
         self.metric_config = {
             Histogram: {
                 'aggregates': histogram_aggregates,
-                'percentiles': histogram_percentiles
+                'percentiles': histogram_percentiles,
+                'relative_accuracy': histogram_relative_accuracy
+            },
+            Distribution: {
+                'relative_accuracy': histogram_relative_accuracy
+            },
+            Set: {
+                'cardinality_threshold': set_cardinality_threshold,
+                'precision': set_hll_precision
             }
         }
 
         self.utf8_decoding = utf8_decoding
 
+        # Contexts of the metric packet lines already parsed, disabled by default
+        self.context_cache = None
+        if context_cache_max_bytes:
+            self.context_cache = ContextCache(context_cache_max_bytes)
+
+    @property
+    def count(self):
+        """
+        Number of metric packets received since the last flush.
+        """
+        return self.generation.count
+
+    def begin_submission(self):
+        """
+        Called by the receive path before writing a submission, see `retire`.
+        """
+        self.submission_seq += 1
+
+    def end_submission(self):
+        self.submission_seq += 1
+
+    def retire(self):
+        """
+        Return the generation to flush. By default it is the live one: only
+        aggregators written and flushed from different threads need to swap
+        generations.
+        """
+        return self.generation
+
     def packets_per_second(self, interval):
         if interval == 0:
             return 0
@@ -506,16 +945,7 @@ class Aggregator(object):
             elif metric_type in self.IGNORE_TYPES:
                 continue
             else:
-                # Try to cast as an int first to avoid precision issues, then as a
-                # float.
-                try:
-                    value = int(raw_value)
-                except ValueError:
-                    try:
-                        value = float(raw_value)
-                    except ValueError:
-                        # Otherwise, raise an error saying it must be a number
-                        raise Exception(u'Metric value must be a number: %s, %s' % (name, raw_value))
+                value = self.parse_metric_value(name, raw_value)
 
             # Parse the optional values - sample rate & tags.
             sample_rate = 1
@@ -537,6 +967,18 @@ class Aggregator(object):
 
         return parsed_packets
 
+    def parse_metric_value(self, name, raw_value):
+        # Try to cast as an int first to avoid precision issues, then as a
+        # float.
+        try:
+            return int(raw_value)
+        except ValueError:
+            try:
+                return float(raw_value)
+            except ValueError:
+                # Otherwise, raise an error saying it must be a number
+                raise Exception(u'Metric value must be a number: %s, %s' % (name, raw_value))
+
     def _unescape_sc_content(self, string):
         return string.replace('\\n', '\n').replace('m\:', 'm:')
 
@@ -630,25 +1072,65 @@ class Aggregator(object):
         if self.utf8_decoding:
             packets = unicode(packets, 'utf-8', errors='replace')
 
+        generation = self.generation
+        context_cache = self.context_cache
         for packet in packets.splitlines():
             if not packet.strip():
                 continue
 
+            # Everything goes to the generation the submission started with,
+            # which is the one `retire` waits for
             if packet.startswith('_e'):
                 event = self.parse_event_packet(packet)
-                self.event(**event)
-                self.event_count += 1
+                generation.events.append(self._event(**event))
+                generation.event_count += 1
             elif packet.startswith('_sc'):
                 service_check = self.parse_sc_packet(packet)
-                self.service_check(**service_check)
-                self.service_check_count += 1
+                generation.service_checks.append(self._service_check(**service_check))
+                generation.service_check_count += 1
             else:
+                cache_key = None
+                if context_cache is not None:
+                    # Lines repeating the name and metadata of a line already
+                    # parsed only need their value to be parsed
+                    name_end = packet.find(':')
+                    value_end = packet.find('|', name_end)
+                    if name_end > 0 and value_end > 0:
+                        raw_value = packet[name_end + 1:value_end]
+                        if ':' not in raw_value:
+                            cache_key = packet[:name_end] + packet[value_end:]
+                            entry = context_cache.get(cache_key)
+                            if entry is not None:
+                                context, mtype, tags, sample_rate = entry
+                                if mtype in self.ALLOW_STRINGS:
+                                    value = raw_value
+                                else:
+                                    value = self.parse_metric_value(context[0], raw_value)
+                                generation.count += 1
+                                self._sample_context(context, value, mtype, tags, None, sample_rate, generation)
+                                continue
+
                 parsed_packets = self.parse_metric_packet(packet)
-                self.count += 1
+                generation.count += 1
                 for name, value, mtype, tags, sample_rate in parsed_packets:
                     hostname, device_name, tags = self._extract_magic_tags(tags)
-                    self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
-                                       device_name=device_name, sample_rate=sample_rate)
+                    context = self.get_context(name, tags, hostname, device_name)
+                    self._sample_context(context, value, mtype, tags, None, sample_rate, generation)
+                if cache_key is not None and len(parsed_packets) == 1:
+                    context_cache.set(cache_key, (context, mtype, tags, sample_rate))
+
+    def submit_packets_batch(self, batch):
+        """
+        Submit a list of datagrams received in a single wakeup of the server.
+        A malformed datagram is logged and skipped without affecting the rest
+        of the batch.
+        """
+        submit_packets = self.submit_packets
+        for packets in batch:
+            try:
+                submit_packets(packets)
+            except Exception:
+                log.exception('Error submitting datagram `%s`', packets)
 
     def _extract_magic_tags(self, tags):
         """Magic tags (host, device) override metric hostname and device_name attributes"""
@@ -672,12 +1154,36 @@ class Aggregator(object):
                 tags = tuple(tags) or None
         return hostname, device_name, tags
 
+    def get_context(self, name, tags, hostname, device_name):
+        # Avoid calling extra functions to dedupe tags if there are none
+        # Note: if you change the way that context is created, please also change create_empty_metrics,
+        #  which counts on this order
+
+        # Keep hostname with empty string to unset it
+        hostname = hostname if hostname is not None else self.hostname
+
+        if tags is None:
+            return (name, tuple(), hostname, device_name)
+        return (name, tuple(sorted(set(tags))), hostname, device_name)
+
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       device_name=None, timestamp=None, sample_rate=1):
         """ Add a metric to be aggregated """
+        context = self.get_context(name, tags, hostname, device_name)
+        self._sample_context(context, value, mtype, tags, timestamp, sample_rate)
+
+    def _sample_context(self, context, value, mtype, tags, timestamp, sample_rate, generation=None):
+        """
+        Add a sample to the metric of a context built by `get_context`, to
+        `generation` if given, otherwise to the active one.
+        """
         raise NotImplementedError()
 
     def event(self, title, text, date_happened=None, alert_type=None, aggregation_key=None, source_type_name=None, priority=None, tags=None, hostname=None):
+        self.generation.events.append(self._event(title, text, date_happened, alert_type, aggregation_key,
+                                                  source_type_name, priority, tags, hostname))
+
+    def _event(self, title, text, date_happened=None, alert_type=None, aggregation_key=None, source_type_name=None, priority=None, tags=None, hostname=None):
         event = {
             'msg_title': title,
             'msg_text': text,
@@ -701,10 +1207,15 @@ class Aggregator(object):
         else:
             event['host'] = self.hostname
 
-        self.events.append(event)
+        return event
 
     def service_check(self, check_name, status, tags=None, timestamp=None,
                       hostname=None, message=None):
+        self.generation.service_checks.append(self._service_check(check_name, status, tags, timestamp,
+                                                                  hostname, message))
+
+    def _service_check(self, check_name, status, tags=None, timestamp=None,
+                       hostname=None, message=None):
         service_check = {
             'check': check_name,
             'status': status,
@@ -720,46 +1231,76 @@ class Aggregator(object):
         if message is not None:
             service_check['message'] = message
 
-        self.service_checks.append(service_check)
+        return service_check
 
     def flush(self):
         """ Flush aggregated metrics """
         raise NotImplementedError()
 
     def flush_events(self):
-        events = self.events
-        self.events = []
+        generation = self.retire()
+        events = generation.events
+        generation.events = []
 
-        self.total_count += self.event_count
-        self.event_count = 0
+        self.total_count += generation.event_count
+        generation.event_count = 0
 
         log.debug("Received %d events since last flush" % len(events))
 
         return events
 
     def flush_service_checks(self):
-        service_checks = self.service_checks
-        self.service_checks = []
+        generation = self.retire()
+        service_checks = generation.service_checks
+        generation.service_checks = []
 
-        self.total_count += self.service_check_count
-        self.service_check_count = 0
+        self.total_count += generation.service_check_count
+        generation.service_check_count = 0
 
         log.debug("Received {0} service check runs since last flush".format(len(service_checks)))
 
         return service_checks
 
+    def submit_internal_metric(self, name, value, mtype, tags=None):
+        """
+        Add a metric of the aggregator itself, from the flushing thread.
+        """
+        self.submit_metric(name, value, mtype, tags)
+
     def send_packet_count(self, metric_name):
-        self.submit_metric(metric_name, self.count, 'g')
+        self.submit_internal_metric(metric_name, self.count, 'g')
+
+    def send_context_cache_stats(self, metric_prefix, tags=None):
+        context_cache = self.context_cache
+        if context_cache is None:
+            return
+        self.submit_internal_metric(metric_prefix + '.hits', context_cache.hits, 'g', tags)
+        self.submit_internal_metric(metric_prefix + '.misses', context_cache.misses, 'g', tags)
+        self.submit_internal_metric(metric_prefix + '.evictions', context_cache.evictions, 'g', tags)
+        self.submit_internal_metric(metric_prefix + '.entries', len(context_cache), 'g', tags)
+        self.submit_internal_metric(metric_prefix + '.bytes', context_cache.size, 'g', tags)
 
 class MetricsBucketAggregator(Aggregator):
     """
     A metric aggregator class.
+
+    The receive path writes to the active generation while the flushing
+    thread rolls up the retired ones, see `retire`.
+
+    When a context budget is configured, a `ContextGuard` bounds the number
+    of new contexts in each generation.
     """
+    # Distributions are only supported by stsstatsd
+    IGNORE_TYPES = []
+    generation_class = BucketGeneration
 
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, context_cache_max_bytes=None,
+            histogram_relative_accuracy=None, set_cardinality_threshold=None,
+            set_hll_precision=None, max_contexts=None, max_contexts_per_name=None,
+            fold_overflow_contexts=True, context_guard_exempt_prefix=None):
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -768,12 +1309,24 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            context_cache_max_bytes,
+            histogram_relative_accuracy,
+            set_cardinality_threshold,
+            set_hll_precision
         )
-        self.metric_by_bucket = {}
-        self.last_sample_time_by_context = {}
-        self.current_bucket = None
-        self.current_mbc = {}
+        # Generations retired by the flushing thread, waiting for their
+        # buckets to be complete
+        self.retired = BucketGeneration()
+        self.context_guard = None
+        if max_contexts or max_contexts_per_name:
+            self.context_guard = ContextGuard(max_contexts, max_contexts_per_name,
+                                              fold_overflow_contexts, context_guard_exempt_prefix)
+        # Counters keep reporting zeros until they expire
+        self.counter_expiry = ExpiryWheel(interval)
+        # Live counters that were not sampled in the last bucket flushed, the
+        # ones reporting zeros
+        self.idle_counters = set()
         self.last_flush_cutoff_time = 0
         self.metric_type_to_class = {
             'g': BucketGauge,
@@ -781,113 +1334,237 @@ class MetricsBucketAggregator(Aggregator):
             'h': Histogram,
             'ms': Histogram,
             's': Set,
+            'd': Distribution,
             'r': Raw
         }
 
-    def calculate_bucket_start(self, timestamp):
-        return timestamp - (timestamp % self.interval)
+    @property
+    def count(self):
+        return self.generation.count + self.retired.count
 
-    def submit_metric(self, name, value, mtype, tags=None, hostname=None,
-                      device_name=None, timestamp=None, sample_rate=1):
-        # Avoid calling extra functions to dedupe tags if there are none
-        # Note: if you change the way that context is created, please also change create_empty_metrics,
-        #  which counts on this order
+    def retire(self):
+        """
+        Swap in an empty generation for the receive path and merge the previous
+        one into the retired generation, which is returned.
 
-        # Keep hostname with empty string to unset it
-        hostname = hostname if hostname is not None else self.hostname
+        The receive path never waits: if it is writing a submission to the
+        generation being retired, the flushing thread waits for it to be done
+        so that no sample is lost.
+        """
+        generation = self.generation
+        if generation.is_empty():
+            return self.retired
+        self.generation = BucketGeneration()
 
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+        submission_seq = self.submission_seq
+        if submission_seq % 2:
+            while self.submission_seq == submission_seq:
+                sleep(SUBMISSION_WAIT_INTERVAL)
+
+        self.retired.merge(generation)
+        return self.retired
+
+    def calculate_bucket_start(self, timestamp):
+        return timestamp - (timestamp % self.interval)
+
+    def submit_internal_metric(self, name, value, mtype, tags=None):
+        """
+        Add a metric of the aggregator itself to the retired generation, which
+        only the flushing thread writes, so that it does not race the receive
+        path updating the active generation outside of a submission.
+        """
+        context = self.get_context(name, tags, None, None)
+        self._sample_context(context, value, mtype, tags, None, 1, self.retired)
 
+    def _sample_context(self, context, value, mtype, tags, timestamp, sample_rate, generation=None):
+        if generation is None:
+            generation = self.generation
         cur_time = time()
         # Check to make sure that the timestamp that is passed in (if any) is not older than
         #  recent_point_threshold.  If so, discard the point.
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
-            log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
-            self.num_discarded_old_points += 1
+            log.debug("Discarding %s - ts = %s , current ts = %s " % (context[0], timestamp, cur_time))
+            generation.num_discarded_old_points += 1
         else:
             timestamp = timestamp or cur_time
             # Keep track of the buckets using the timestamp at the start time of the bucket
             bucket_start_timestamp = self.calculate_bucket_start(timestamp)
-            if bucket_start_timestamp == self.current_bucket:
-                metric_by_context = self.current_mbc
+            if bucket_start_timestamp == generation.current_bucket:
+                metric_by_context = generation.current_mbc
             else:
-                if bucket_start_timestamp not in self.metric_by_bucket:
-                    self.metric_by_bucket[bucket_start_timestamp] = {}
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
-                self.current_bucket = bucket_start_timestamp
-                self.current_mbc = metric_by_context
+                if bucket_start_timestamp not in generation.metric_by_bucket:
+                    generation.metric_by_bucket[bucket_start_timestamp] = {}
+                metric_by_context = generation.metric_by_bucket[bucket_start_timestamp]
+                generation.current_bucket = bucket_start_timestamp
+                generation.current_mbc = metric_by_context
 
             if context not in metric_by_context:
-                metric_class = self.metric_type_to_class[mtype]
-                metric_by_context[context] = metric_class(self.formatter, name, tags,
-                    hostname, device_name, self.metric_config.get(metric_class))
+                if self.context_guard is not None and context not in generation.admitted_contexts:
+                    admitted_context = self.context_guard.admit(generation, context)
+                    if admitted_context is None:
+                        return
+                    if admitted_context is not context:
+                        context, tags = admitted_context, admitted_context[1]
+
+                if context not in metric_by_context:
+                    metric_class = self.metric_type_to_class[mtype]
+                    metric_by_context[context] = metric_class(self.formatter, context[0], tags,
+                        context[2], context[3], self.metric_config.get(metric_class))
 
             metric_by_context[context].sample(value, sample_rate, timestamp)
 
-    def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
+    def handoff(self):
+        """
+        Remove and return the complete buckets, events and service checks along
+        with the packet counts, without rolling anything up.
+        Used by sharded stsstatsd workers to hand their state over to the
+        aggregator that reports, see `merge_handoff`.
+        """
+        generation = self.retire()
+        flush_cutoff_time = self.calculate_bucket_start(time())
+        metric_by_bucket = {}
+        for bucket_start_timestamp in generation.metric_by_bucket.keys():
+            if bucket_start_timestamp < flush_cutoff_time:
+                metric_by_bucket[bucket_start_timestamp] = generation.metric_by_bucket.pop(bucket_start_timestamp)
+        # Internal metrics are written to this generation, see `submit_internal_metric`
+        generation.current_bucket = None
+
+        events, generation.events = generation.events, []
+        service_checks, generation.service_checks = generation.service_checks, []
+        handoff = {
+            'metric_by_bucket': metric_by_bucket,
+            'events': events,
+            'service_checks': service_checks,
+            'count': generation.count,
+            'event_count': generation.event_count,
+            'service_check_count': generation.service_check_count,
+            'num_discarded_old_points': generation.num_discarded_old_points,
+            'rejected_by_name': generation.rejected_by_name,
+        }
+        self.total_count += generation.count + generation.event_count + generation.service_check_count
+        generation.count = 0
+        generation.event_count = 0
+        generation.service_check_count = 0
+        generation.num_discarded_old_points = 0
+        generation.rejected_by_name = {}
+        return handoff
+
+    def merge_handoff(self, handoff):
+        """
+        Merge the state returned by the `handoff` of another aggregator: counters
+        are summed, gauges are last-write-wins, histogram samples and set values
+        are combined. The merged buckets are rolled up by the next `flush`.
+        Must be called from the flushing thread.
+        """
+        generation = self.retired
+        for bucket_start_timestamp, other_mbc in handoff['metric_by_bucket'].iteritems():
+            metric_by_context = generation.metric_by_bucket.setdefault(bucket_start_timestamp, {})
+            for context, other in other_mbc.iteritems():
+                metric = metric_by_context.get(context)
+                if metric is None:
+                    metric_class = other.__class__
+                    metric = metric_class(self.formatter, other.name, other.tags,
+                        other.hostname, other.device_name, self.metric_config.get(metric_class))
+                    metric.last_sample_time = other.last_sample_time
+                    metric_by_context[context] = metric
+                metric.merge(other)
+
+        generation.events.extend(handoff['events'])
+        generation.service_checks.extend(handoff['service_checks'])
+        generation.count += handoff['count']
+        generation.event_count += handoff['event_count']
+        generation.service_check_count += handoff['service_check_count']
+        generation.num_discarded_old_points += handoff['num_discarded_old_points']
+        for name, count in handoff.get('rejected_by_name', {}).iteritems():
+            generation.rejected_by_name[name] = generation.rejected_by_name.get(name, 0) + count
+
+    def flush_rejected_contexts(self):
+        """
+        Return the number of samples rejected by the context guard by metric
+        name since the last call.
+        """
+        generation = self.retire()
+        rejected_by_name = generation.rejected_by_name
+        generation.rejected_by_name = {}
+        return rejected_by_name
+
+    def create_empty_metrics(self, sampled_contexts, expiry_timestamp, flush_timestamp, metrics):
         # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
         #  (Set, Gauge, Histogram) do not report if no data is submitted
-        for context, last_sample_time in sample_time_by_context.items():
-            if last_sample_time < expiry_timestamp:
-                log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                self.last_sample_time_by_context.pop(context, None)
-            else:
-                # The expiration currently only applies to Counters
-                # This counts on the ordering of the context created in submit_metric not changing
-                metric = Counter(self.formatter, context[0], context[1], context[2], context[3])
-                metrics += metric.flush(flush_timestamp, self.interval)
+        # The idle counters are kept up to date with the contexts sampled or
+        # expired, the others are not visited.
+        idle_counters = self.idle_counters
+        expired = self.counter_expiry.expire(expiry_timestamp)
+        if expired:
+            log.debug("%s counters haven't been submitted in %ss. Expiring." % (len(expired), self.expiry_seconds))
+            idle_counters.difference_update(expired)
+        idle_counters.difference_update(sampled_contexts)
+
+        formatter = self.formatter
+        interval = self.interval
+        for context in idle_counters:
+            # This counts on the ordering of the context created in submit_metric not changing
+            metrics.append(formatter(
+                metric=context[0],
+                value=0,
+                timestamp=flush_timestamp,
+                tags=context[1],
+                hostname=context[2],
+                device_name=context[3],
+                metric_type=MetricTypes.RATE,
+                interval=interval,
+            ))
+
+        # The counters sampled in this bucket are idle until sampled again
+        last_sample_time_by_context = self.counter_expiry.last_sample_time_by_context
+        idle_counters.update(context for context in sampled_contexts if context in last_sample_time_by_context)
 
     def flush(self):
+        generation = self.retire()
+        metric_by_bucket = generation.metric_by_bucket
         cur_time = time()
         flush_cutoff_time = self.calculate_bucket_start(cur_time)
         expiry_timestamp = cur_time - self.expiry_seconds
 
         metrics = []
 
-        if self.metric_by_bucket:
+        if metric_by_bucket:
             # We want to process these in order so that we can check for and expired metrics and
-            #  re-create non-expired metrics.  We also mutate self.metric_by_bucket.
-            for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
-                metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
+            #  re-create non-expired metrics.  We also mutate metric_by_bucket.
+            for bucket_start_timestamp in sorted(metric_by_bucket.keys()):
+                metric_by_context = metric_by_bucket[bucket_start_timestamp]
                 if bucket_start_timestamp < flush_cutoff_time:
-                    not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
-                    # We mutate this dictionary while iterating so don't use an iterator.
-                    for context, metric in metric_by_context.items():
+                    for context, metric in metric_by_context.iteritems():
                         if metric.last_sample_time < expiry_timestamp:
                             # This should never happen
                             log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                            not_sampled_in_this_bucket.pop(context, None)
-                            self.last_sample_time_by_context.pop(context, None)
+                            self.counter_expiry.discard(context)
+                            self.idle_counters.discard(context)
                         else:
                             metrics += metric.flush(bucket_start_timestamp, self.interval)
                             if isinstance(metric, Counter):
-                                self.last_sample_time_by_context[context] = metric.last_sample_time
-                                not_sampled_in_this_bucket.pop(context, None)
+                                self.counter_expiry.touch(context, metric.last_sample_time)
                     # We need to account for Metrics that have not expired and were not flushed for this bucket
-                    self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
+                    self.create_empty_metrics(metric_by_context, expiry_timestamp, bucket_start_timestamp, metrics)
 
-                    del self.metric_by_bucket[bucket_start_timestamp]
+                    del metric_by_bucket[bucket_start_timestamp]
+            # Internal metrics are written to this generation, see `submit_internal_metric`
+            generation.current_bucket = None
         else:
             # Even if there are no metrics in this flush, there may be some non-expired counters
             #  We should only create these non-expired metrics if we've passed an interval since the last flush
             if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
-                self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp,
-                                          flush_cutoff_time-self.interval, metrics)
+                self.create_empty_metrics((), expiry_timestamp, flush_cutoff_time-self.interval, metrics)
 
         # Log a warning regarding metrics with old timestamps being submitted
-        if self.num_discarded_old_points > 0:
-            log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
-            self.num_discarded_old_points = 0
+        if generation.num_discarded_old_points > 0:
+            log.warn('%s points were discarded as a result of having an old timestamp' % generation.num_discarded_old_points)
+            generation.num_discarded_old_points = 0
 
         # Save some stats.
-        log.debug("received %s payloads since last flush" % self.count)
-        self.total_count += self.count
-        self.count = 0
-        self.current_bucket = None
-        self.current_mbc = {}
+        log.debug("received %s payloads since last flush" % generation.count)
+        self.total_count += generation.count
+        generation.count = 0
         self.last_flush_cutoff_time = flush_cutoff_time
         return metrics
 
@@ -900,7 +1577,9 @@ class MetricsAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, context_cache_max_bytes=None,
+            histogram_relative_accuracy=None, set_cardinality_threshold=None,
+            set_hll_precision=None):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -909,7 +1588,11 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            context_cache_max_bytes,
+            histogram_relative_accuracy,
+            set_cardinality_threshold,
+            set_hll_precision
         )
         self.metrics = {}
         self.metric_type_to_class = {
@@ -924,25 +1607,17 @@ class MetricsAggregator(Aggregator):
             'r': Raw,
         }
 
-    def submit_metric(self, name, value, mtype, tags=None, hostname=None,
-                      device_name=None, timestamp=None, sample_rate=1):
-        # Avoid calling extra functions to dedupe tags if there are none
-
-        # Keep hostname with empty string to unset it
-        hostname = hostname if hostname is not None else self.hostname
-
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            context = (name, tuple(sorted(set(tags))), hostname, device_name)
+    def _sample_context(self, context, value, mtype, tags, timestamp, sample_rate, generation=None):
+        if generation is None:
+            generation = self.generation
         if context not in self.metrics:
             metric_class = self.metric_type_to_class[mtype]
-            self.metrics[context] = metric_class(self.formatter, name, tags,
-                hostname, device_name, self.metric_config.get(metric_class))
+            self.metrics[context] = metric_class(self.formatter, context[0], tags,
+                context[2], context[3], self.metric_config.get(metric_class))
         cur_time = time()
         if mtype is not "r" and timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
-            log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
-            self.num_discarded_old_points += 1
+            log.debug("Discarding %s - ts = %s , current ts = %s " % (context[0], timestamp, cur_time))
+            generation.num_discarded_old_points += 1
         else:
             self.metrics[context].sample(value, sample_rate, timestamp)
 
@@ -990,14 +1665,15 @@ class MetricsAggregator(Aggregator):
                 metrics += metric.flush(timestamp, self.interval)
 
         # Log a warning regarding metrics with old timestamps being submitted
-        if self.num_discarded_old_points > 0:
-            log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
-            self.num_discarded_old_points = 0
+        generation = self.retire()
+        if generation.num_discarded_old_points > 0:
+            log.warn('%s points were discarded as a result of having an old timestamp' % generation.num_discarded_old_points)
+            generation.num_discarded_old_points = 0
 
         # Save some stats.
-        log.debug("received %s payloads since last flush" % self.count)
-        self.total_count += self.count
-        self.count = 0
+        log.debug("received %s payloads since last flush" % generation.count)
+        self.total_count += generation.count
+        generation.count = 0
         return metrics
 
 def get_formatter(config):
@@ -12,6 +12,7 @@ import os
 import platform
 import sys
 import tempfile
+import threading
 import time
 
 # 3p
@@ -40,6 +41,9 @@ STATUS_WARNING = 'WARNING'
 
 NTP_OFFSET_THRESHOLD = 60
 
+# Published statuses are written at most this often, in seconds
+STATUS_PUBLISH_INTERVAL = 1
+
 
 log = logging.getLogger(__name__)
 
@@ -140,6 +144,139 @@ def validate_api_key(config):
 
     return "API Key is valid"
 
+def write_status(status, path):
+    """
+    Pickle a status to a temporary file renamed over `path`, so that readers
+    never load a partially written status.
+
+    Statuses stay pickled: `load_latest_status` hands back instances of the
+    status classes, with their nested check statuses and arbitrary check
+    data, to the info command, the Windows GUI and the persistable stores.
+    The binary protocol of cPickle is cheap, and it runs on the publisher
+    thread rather than on the hot threads.
+    """
+    directory, name = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=name + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(status, f, pickle.HIGHEST_PROTOCOL)
+        # Readable by the info command of other users, like the file it replaces
+        os.chmod(tmp_path, 0644)
+        if Platform.is_win32() and os.path.exists(path):
+            # Windows does not rename over an existing file
+            os.remove(path)
+        os.rename(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class StatusPublisher(object):
+    """
+    Writes the published statuses from a background thread, at most once
+    every `interval` seconds per file: a status published while the previous
+    one is waiting replaces it. Publishing never waits for the disk.
+
+    A forked process gets a publisher of its own, see `get`.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, interval=STATUS_PUBLISH_INTERVAL):
+        self.interval = interval
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        # Statuses waiting to be written, and time of the last write, by path
+        self._pending = {}
+        self._last_write = {}
+        # Held while a status is written, so that it can be waited for
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self.written = 0
+        self.coalesced = 0
+
+    @classmethod
+    def get(cls):
+        instance = cls._instance
+        if instance is not None and instance.pid == os.getpid():
+            return instance
+        with cls._instance_lock:
+            if cls._instance is None or cls._instance.pid != os.getpid():
+                # The thread of the parent process does not exist in a forked
+                # one, and its locks may be held forever
+                cls._instance = cls()
+            return cls._instance
+
+    def publish(self, status, path):
+        with self._cond:
+            if path in self._pending:
+                self.coalesced += 1
+            self._pending[path] = status
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='StatusPublisher')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def discard(self, path):
+        """
+        Forget the status waiting to be written to `path`, and wait for the
+        one being written.
+        """
+        with self._cond:
+            self._pending.pop(path, None)
+        with self._write_lock:
+            pass
+
+    def flush(self):
+        """
+        Write the waiting statuses now.
+        """
+        with self._cond:
+            pending, self._pending = self._pending, {}
+            self._write_lock.acquire()
+        try:
+            self._write(pending)
+        finally:
+            self._write_lock.release()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.time()
+                    due = dict((path, status) for path, status in self._pending.iteritems()
+                               if now - self._last_write.get(path, 0) >= self.interval)
+                    if due:
+                        break
+                    if self._pending:
+                        self._cond.wait(min(self.interval - (now - self._last_write[path])
+                                            for path in self._pending))
+                    else:
+                        self._cond.wait()
+                for path in due:
+                    del self._pending[path]
+                self._write_lock.acquire()
+            try:
+                self._write(due)
+            finally:
+                self._write_lock.release()
+
+    def _write(self, statuses):
+        for path, status in statuses.iteritems():
+            log.debug("Persisting status to %s" % path)
+            try:
+                write_status(status, path)
+                self.written += 1
+            except Exception:
+                log.exception("Error persisting status")
+            self._last_write[path] = time.time()
+
+
 class AgentStatus(object):
     """
     A small class used to load and save status messages to the filesystem.
@@ -158,14 +295,20 @@ class AgentStatus(object):
         try:
             path = self._get_pickle_path(prefix)
             log.debug("Persisting status to %s" % path)
-            f = open(path, 'w')
-            try:
-                pickle.dump(self, f)
-            finally:
-                f.close()
+            write_status(self, path)
         except Exception:
             log.exception("Error persisting status")
 
+    def publish(self, prefix=""):
+        """
+        Persist the status from the background thread of the publisher, at a
+        bounded rate, for the statuses updated from hot threads.
+        """
+        try:
+            StatusPublisher.get().publish(self, self._get_pickle_path(prefix))
+        except Exception:
+            log.exception("Error publishing status")
+
     def created_seconds_ago(self):
         td = datetime.datetime.now() - self.created_at
         return td.seconds
@@ -244,7 +387,9 @@ class AgentStatus(object):
     def remove_latest_status(cls, prefix=""):
         log.debug("Removing latest status")
         try:
-            os.remove(cls._get_pickle_path(prefix))
+            path = cls._get_pickle_path(prefix)
+            StatusPublisher.get().discard(path)
+            os.remove(path)
         except OSError:
             pass
 
@@ -252,7 +397,7 @@ class AgentStatus(object):
     def load_latest_status(cls, prefix=""):
         try:
             path = cls._get_pickle_path(prefix)
-            f = open(path)
+            f = open(path, 'rb')
             try:
                 r = pickle.load(f)
                 if not isinstance(r, cls):
@@ -756,7 +901,8 @@ class DogstatsdStatus(AgentStatus):
     NAME = 'StsStatsD'
 
     def __init__(self, flush_count=0, packet_count=0, packets_per_second=0,
-                 metric_count=0, event_count=0, service_check_count=0):
+                 metric_count=0, event_count=0, service_check_count=0,
+                 rejected_context_count=0, top_rejected_contexts=None, udp_rx_queue=None, udp_drops=None):
         AgentStatus.__init__(self)
         self.flush_count = flush_count
         self.packet_count = packet_count
@@ -764,6 +910,10 @@ class DogstatsdStatus(AgentStatus):
         self.metric_count = metric_count
         self.event_count = event_count
         self.service_check_count = service_check_count
+        self.rejected_context_count = rejected_context_count
+        self.top_rejected_contexts = top_rejected_contexts or []
+        self.udp_rx_queue = udp_rx_queue
+        self.udp_drops = udp_drops
 
     def has_error(self):
         return self.flush_count == 0 and self.packet_count == 0 and self.metric_count == 0
@@ -777,6 +927,13 @@ class DogstatsdStatus(AgentStatus):
             "Event count: %s" % self.event_count,
             "Service check count: %s" % self.service_check_count,
         ]
+        if self.udp_drops is not None:
+            lines.append("UDP receive queue: %s bytes" % self.udp_rx_queue)
+            lines.append("UDP packets dropped by the kernel: %s" % self.udp_drops)
+        if self.rejected_context_count:
+            lines.append("Samples over the context budgets: %s" % self.rejected_context_count)
+            for name, count in self.top_rejected_contexts:
+                lines.append("  %s: %s" % (name, count))
         return lines
 
     def to_dict(self):
@@ -788,6 +945,10 @@ class DogstatsdStatus(AgentStatus):
             'metric_count': self.metric_count,
             'event_count': self.event_count,
             'service_check_count': self.service_check_count,
+            'rejected_context_count': self.rejected_context_count,
+            'top_rejected_contexts': self.top_rejected_contexts,
+            'udp_rx_queue': self.udp_rx_queue,
+            'udp_drops': self.udp_drops,
         })
         return status_info
 
@@ -808,7 +969,7 @@ class ForwarderStatus(AgentStatus):
     NAME = 'Forwarder'
 
     def __init__(self, queue_length=0, queue_size=0, flush_count=0, transactions_received=0,
-                 transactions_flushed=0, transactions_rejected=0):
+                 transactions_flushed=0, transactions_rejected=0, connections_opened=0, connections_reused=0):
         AgentStatus.__init__(self)
         self.queue_length = queue_length
         self.queue_size = queue_size
@@ -818,6 +979,8 @@ class ForwarderStatus(AgentStatus):
         self.hidden_username = None
         self.hidden_password = None
         self.transactions_rejected = transactions_rejected
+        self.connections_opened = connections_opened
+        self.connections_reused = connections_reused
 
     def body_lines(self):
         lines = [
@@ -827,6 +990,7 @@ class ForwarderStatus(AgentStatus):
             "Transactions received: %s" % self.transactions_received,
             "Transactions flushed: %s" % self.transactions_flushed,
             "Transactions rejected: %s" % self.transactions_rejected,
+            "Connections opened: %s, reused: %s" % (self.connections_opened, self.connections_reused),
             # "API Key Status: %s" % validate_api_key(config=get_config()),
             "",
         ]
@@ -844,7 +1008,9 @@ class ForwarderStatus(AgentStatus):
             'queue_size': self.queue_size,
             'transactions_rejected': self.transactions_rejected,
             'transactions_received': self.transactions_received,
-            'transactions_flushed': self.transactions_flushed
+            'transactions_flushed': self.transactions_flushed,
+            'connections_opened': self.connections_opened,
+            'connections_reused': self.connections_reused,
         })
         return status_info
 
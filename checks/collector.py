@@ -535,7 +535,7 @@ class Collector(object):
         # Persist the status of the collection run.
         try:
             CollectorStatus(check_statuses, emitter_statuses,
-                            self.hostname_metadata_cache).persist()
+                            self.hostname_metadata_cache).publish()
         except Exception:
             log.exception("Error persisting collector status")
 
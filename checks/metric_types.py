@@ -6,3 +6,4 @@ class MetricTypes(object):
     RATE = 'rate'
     COUNT = 'count'
     RAW = 'raw'
+    DISTRIBUTION = 'distribution'
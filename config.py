@@ -27,6 +27,7 @@ from util import check_yaml, config_to_yaml
 from utils.platform import Platform, get_os
 from utils.proxy import get_proxy
 from utils.sdk import load_manifest
+from utils.sketch import DEFAULT_RELATIVE_ACCURACY
 from utils.service_discovery.config import extract_agent_config
 from utils.service_discovery.config_stores import CONFIG_FROM_FILE, TRACE_CONFIG
 from utils.service_discovery.sd_backend import get_sd_backend, AUTO_CONFIG_DIR, SD_BACKENDS
@@ -278,6 +279,31 @@ def get_histogram_aggregates(configstr=None):
     return result
 
 
+def get_histogram_relative_accuracy(backend=None, configstr=None):
+    """
+    Return the relative accuracy of the histogram sketches, None when the
+    samples are kept in full.
+    """
+    if backend is None or backend.strip() == 'samples':
+        return None
+    if backend.strip() != 'sketch':
+        log.warning("Unknown histogram backend {0}, keeping the samples".format(backend))
+        return None
+
+    if configstr is None:
+        return DEFAULT_RELATIVE_ACCURACY
+    try:
+        relative_accuracy = float(configstr)
+        if relative_accuracy <= 0 or relative_accuracy >= 1:
+            raise ValueError
+    except ValueError:
+        log.warning("Bad histogram relative accuracy {0}, must be float in ]0;1[, using {1}"
+                    .format(configstr, DEFAULT_RELATIVE_ACCURACY))
+        return DEFAULT_RELATIVE_ACCURACY
+
+    return relative_accuracy
+
+
 def get_histogram_percentiles(configstr=None):
     if configstr is None:
         return None
@@ -468,6 +494,13 @@ def get_config(parse_args=True, cfg_path=None, options=None, can_query_registry=
         if config.has_option('Main', 'histogram_percentiles'):
             agentConfig['histogram_percentiles'] = get_histogram_percentiles(config.get('Main', 'histogram_percentiles'))
 
+        if config.has_option('Main', 'histogram_backend'):
+            relative_accuracy = None
+            if config.has_option('Main', 'histogram_relative_accuracy'):
+                relative_accuracy = config.get('Main', 'histogram_relative_accuracy')
+            agentConfig['histogram_sketch_relative_accuracy'] = get_histogram_relative_accuracy(
+                config.get('Main', 'histogram_backend'), relative_accuracy)
+
         # Disable Watchdog (optionally)
         if config.has_option('Main', 'watchdog'):
             if config.get('Main', 'watchdog').lower() in ('no', 'false'):
@@ -539,10 +572,8 @@ def get_config(parse_args=True, cfg_path=None, options=None, can_query_registry=
             agentConfig["nagios_perf_cfg"] = config.get("Main", "nagios_perf_cfg")
 
         if config.has_option("Main", "use_curl_http_client"):
-            agentConfig["use_curl_http_client"] = _is_affirmative(config.get("Main", "use_curl_http_client"))
-        else:
-            # Default to False as there are some issues with the curl client and ELB
-            agentConfig["use_curl_http_client"] = False
+            log.warning("The use_curl_http_client option is deprecated and ignored, "
+                        "the forwarder always uses its keep-alive connection pools")
 
         if config.has_section('WMI'):
             agentConfig['WMI'] = {}
@@ -10,6 +10,7 @@ from datetime import timedelta
 import logging
 import os
 from Queue import Full, Queue
+import time
 from socket import error as socket_error, gaierror
 import sys
 import threading
@@ -20,14 +21,11 @@ import zlib
 os.umask(022)
 
 # 3p
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import simplejson as json
-try:
-    import pycurl
-except ImportError:
-    # For the source install, pycurl might not be installed
-    pycurl = None
 from tornado.escape import json_decode
-import tornado.httpclient
 import tornado.httpserver
 import tornado.ioloop
 from tornado.options import define, options, parse_command_line
@@ -43,9 +41,10 @@ from config import (
     _is_affirmative
 )
 import modules
-from transaction import Transaction, TransactionManager
+from transaction import CIRCUIT_OPEN_DELAY, DEFAULT_MAX_CONCURRENCY, Transaction, TransactionManager
 from util import get_uuid
 from utils.net import DEFAULT_DNS_TTL, DNSCache
+from utils.spill import DEFAULT_MAX_AGE, DEFAULT_MAX_SIZE, OLDEST_FIRST, SpillStore
 
 
 
@@ -76,13 +75,35 @@ HEADERS_TO_REMOVE = [
 # Maximum delay before replaying a transaction
 MAX_WAIT_FOR_REPLAY = timedelta(seconds=90)
 
-# Maximum queue size in bytes (when this is reached, old messages are dropped)
+# The forwarder is unhealthy when a transaction is queued for longer, in seconds
+STATUS_MAX_AGE = 2 * MAX_WAIT_FOR_REPLAY.total_seconds()
+
+# Maximum size in bytes of the compressed payload of a batch of series
+MAX_BATCH_SIZE = 2 * 1024 * 1024  # 2MB
+
+# Maximum queue size in bytes of each endpoint and API key (when this is
+# reached, their old messages are dropped)
 MAX_QUEUE_SIZE = 30 * 1024 * 1024  # 30MB
 
 # Some responses should be rejected, rather than replayed. This list will be rejected.
 RESPONSES_TO_REJECT = [413, 400]
 
-THROTTLING_DELAY = timedelta(microseconds=1000000 / 2)  # 2 msg/second
+# Backoff of an endpoint after an error, doubled by each consecutive error
+THROTTLING_DELAY = timedelta(microseconds=1000000 / 2)
+
+# Payloads waiting to be decoded for the custom emitters, and threads decoding
+# them
+EMITTER_QUEUE_SIZE = 100
+EMITTER_DECODER_THREADS = 2
+
+
+def decode_payload(data, headers=None):
+    """
+    JSON-decode a payload posted to the forwarder, deflated or not.
+    """
+    if headers and headers.get('Content-Encoding') == 'deflate':
+        data = zlib.decompress(data)
+    return json_decode(data)
 
 
 class EmitterThread(threading.Thread):
@@ -94,6 +115,8 @@ class EmitterThread(threading.Thread):
         self.__config = kwargs.pop('config')
         self.__max_queue_size = kwargs.pop('max_queue_size', 100)
         self.__queue = Queue(self.__max_queue_size)
+        self.__lock = threading.Lock()
+        self.dropped = 0
         threading.Thread.__init__(self, *args, **kwargs)
         self.daemon = True
 
@@ -110,15 +133,27 @@ class EmitterThread(threading.Thread):
         try:
             self.__queue.put((data, headers), block=False)
         except Full:
+            with self.__lock:
+                self.dropped += 1
             self.__logger.warn('Dropping packet for %r due to backlog', self.__name)
 
 
 class EmitterManager(object):
-    """Track custom emitters"""
+    """Track custom emitters
+
+    Payloads are queued for a pool of decoder threads, which decode each of
+    them once and hand it to the thread of every emitter: the forwarder IOLoop
+    only queues them. Payloads are dropped, and counted, when a queue is full."""
 
     def __init__(self, config):
         self.agentConfig = config
         self.emitterThreads = []
+        self.decoderThreads = []
+        self._payloads = Queue(int(config.get('custom_emitters_queue_size') or EMITTER_QUEUE_SIZE))
+        self._lock = threading.Lock()
+        self.received = 0
+        self.dropped = 0
+        self.decode_errors = 0
         for emitter_spec in [s.strip() for s in self.agentConfig.get('custom_emitters', '').split(',')]:
             if len(emitter_spec) == 0:
                 continue
@@ -134,17 +169,194 @@ class EmitterManager(object):
                 self.emitterThreads.append(thread)
             except Exception:
                 logging.error('Unable to start thread for emitter: %r', emitter_spec, exc_info=True)
+        if self.emitterThreads:
+            for i in xrange(int(config.get('custom_emitters_workers') or EMITTER_DECODER_THREADS)):
+                thread = threading.Thread(target=self._decode, name='EmitterDecoder-%s' % i)
+                thread.daemon = True
+                thread.start()
+                self.decoderThreads.append(thread)
         logging.info('Done with custom emitters')
 
     def send(self, data, headers=None):
         if not self.emitterThreads:
             return  # bypass decompression/decoding
-        if headers and headers.get('Content-Encoding') == 'deflate':
-            data = zlib.decompress(data)
-        data = json_decode(data)
-        for emitterThread in self.emitterThreads:
-            logging.info('Queueing for emitter %r', emitterThread.name)
-            emitterThread.enqueue(data, headers)
+        self.received += 1
+        try:
+            self._payloads.put_nowait((data, headers))
+        except Full:
+            self.dropped += 1
+            logging.warn('Dropping payload for the custom emitters due to backlog')
+
+    def _decode(self):
+        while True:
+            data, headers = self._payloads.get()
+            try:
+                payload = decode_payload(data, headers)
+            except Exception:
+                with self._lock:
+                    self.decode_errors += 1
+                logging.error('Unable to decode a payload for the custom emitters', exc_info=True)
+                continue
+            for emitterThread in self.emitterThreads:
+                logging.debug('Queueing for emitter %r', emitterThread.name)
+                emitterThread.enqueue(payload, headers)
+
+    def get_stats(self):
+        return {
+            'received': self.received,
+            'pending': self._payloads.qsize(),
+            'dropped': self.dropped,
+            'decode_errors': self.decode_errors,
+            'emitters': dict((thread.name, thread.dropped) for thread in self.emitterThreads),
+        }
+
+
+class DNSCachingConnectionMixin(object):
+    """
+    Connects to an address of the DNS cache. The connection keeps the host
+    name for the Host header, SNI and the certificate validation.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._dns_cache = kwargs.pop('dns_cache')
+        super(DNSCachingConnectionMixin, self).__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        host = self.host
+        self.host = self._dns_cache.resolve(host)
+        try:
+            return super(DNSCachingConnectionMixin, self)._new_conn()
+        finally:
+            self.host = host
+
+
+class DNSCachingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = type('DNSCachingHTTPConnection', (DNSCachingConnectionMixin, HTTPConnectionPool.ConnectionCls), {})
+
+
+class DNSCachingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = type('DNSCachingHTTPSConnection', (DNSCachingConnectionMixin, HTTPSConnectionPool.ConnectionCls), {})
+
+
+class DNSCachingHTTPAdapter(HTTPAdapter):
+    """
+    Resolves the host names of new connections through a `DNSCache`.
+    """
+
+    def __init__(self, dns_cache, **kwargs):
+        self.dns_cache = dns_cache
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['dns_cache'] = self.dns_cache
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': DNSCachingHTTPConnectionPool,
+            'https': DNSCachingHTTPSConnectionPool,
+        }
+
+
+class PostOnRedirectSession(requests.Session):
+    """
+    Follows redirects with the original POST, see `proxy_forbid_method_switch`.
+    """
+
+    def rebuild_method(self, prepared_request, response):
+        pass
+
+
+class EndpointResponse(object):
+    """
+    Outcome of a request: the status code, or 599 and the error when no
+    response was received.
+    """
+
+    def __init__(self, url, code, error=None, request_time=None, retry_after=None):
+        self.url = url
+        self.code = code
+        self.error = error
+        self.request_time = request_time
+        # Seconds to wait before the next request, from a 429 or 503
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return "EndpointResponse(url=%r, code=%s, error=%r, request_time=%s)" % (
+            self.url.split('api_key=')[0], self.code, self.error, self.request_time)
+
+
+def parse_retry_after(value):
+    """
+    Seconds of a Retry-After header, HTTP dates are not supported.
+    """
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class EndpointClient(object):
+    """
+    Long-lived HTTP client of an endpoint. Requests are posted by
+    `max_connections` threads sharing a pool of keep-alive connections, and
+    their responses are handed back to the IOLoop.
+    """
+
+    def __init__(self, endpoint, max_connections, io_loop, verify=True, proxies=None, dns_cache=None,
+                 forbid_method_switch=False):
+        self.endpoint = endpoint
+        self.io_loop = io_loop
+        self.session = PostOnRedirectSession() if forbid_method_switch else requests.Session()
+        self.session.verify = verify
+        # Proxies come from the agent configuration only
+        self.session.trust_env = False
+        if proxies:
+            self.session.proxies = proxies
+        adapter_kwargs = dict(pool_connections=1, pool_maxsize=max_connections, pool_block=True)
+        if dns_cache is not None:
+            self.adapter = DNSCachingHTTPAdapter(dns_cache, **adapter_kwargs)
+        else:
+            self.adapter = HTTPAdapter(**adapter_kwargs)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.requests = Queue()
+        self.threads = []
+        for i in xrange(max_connections):
+            thread = threading.Thread(target=self.run, name='forwarder-%s-%s' % (urlparse(endpoint).netloc, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def post(self, url, data, headers, timeout, callback):
+        self.requests.put((url, data, headers, timeout, callback))
+
+    def run(self):
+        while True:
+            url, data, headers, timeout, callback = self.requests.get()
+            start = time.time()
+            try:
+                r = self.session.post(url, data=data, headers=headers, timeout=timeout)
+                response = EndpointResponse(url, r.status_code, r.reason if r.status_code >= 400 else None,
+                                            time.time() - start, parse_retry_after(r.headers.get('Retry-After')))
+                # Release the connection to the pool
+                r.close()
+            except Exception as e:
+                response = EndpointResponse(url, 599, e, time.time() - start)
+            self.io_loop.add_callback(callback, response)
+
+    def connection_stats(self):
+        """
+        Return the number of connections opened and of requests sent on
+        reused connections.
+        """
+        opened, requests_sent = 0, 0
+        managers = [self.adapter.poolmanager] + self.adapter.proxy_manager.values()
+        for manager in managers:
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is not None:
+                    opened += pool.num_connections
+                    requests_sent += pool.num_requests
+        return opened, max(requests_sent - opened, 0)
 
 
 class AgentTransaction(Transaction):
@@ -154,11 +366,52 @@ class AgentTransaction(Transaction):
     _emitter_manager = None
     _type = None
     _request_timeout = 20
+    # One client per endpoint, they live as long as the application
+    _clients = {}
 
     @classmethod
     def set_application(cls, app):
         cls._application = app
         cls._emitter_manager = EmitterManager(cls._application._agentConfig)
+        AgentTransaction._clients = {}
+
+    @classmethod
+    def get_client(cls, endpoint):
+        client = AgentTransaction._clients.get(endpoint)
+        if client is None:
+            app = cls._application
+            proxies = None
+            proxy_settings = app._agentConfig.get('proxy_settings')
+            if proxy_settings is not None:
+                userpass = ''
+                if proxy_settings.get('user'):
+                    userpass = "%s:%s@" % (proxy_settings['user'], proxy_settings['password'])
+                proxy_url = "http://%s%s:%s" % (userpass, proxy_settings['host'], proxy_settings['port'])
+                proxies = {'http': proxy_url, 'https': proxy_url}
+                log.debug("Configuring the forwarder to use proxy settings: %s:****@%s:%s" % (
+                    proxy_settings['user'], proxy_settings['host'], proxy_settings['port']))
+            # Verify against the configured CA bundle, the system one otherwise
+            verify = False if app.skip_ssl_validation else (app._agentConfig.get('ssl_certificate') or True)
+            client = EndpointClient(
+                endpoint,
+                cls._trManager._MAX_CONCURRENCY,
+                tornado.ioloop.IOLoop.current(),
+                verify=verify,
+                proxies=proxies,
+                dns_cache=getattr(app, '_dns_cache', None),
+                forbid_method_switch=app._agentConfig.get('proxy_forbid_method_switch'),
+            )
+            AgentTransaction._clients[endpoint] = client
+        return client
+
+    @classmethod
+    def get_connection_stats(cls):
+        opened, reused = 0, 0
+        for client in AgentTransaction._clients.values():
+            client_opened, client_reused = client.connection_stats()
+            opened += client_opened
+            reused += client_reused
+        return opened, reused
 
     @classmethod
     def set_tr_manager(cls, manager):
@@ -185,10 +438,6 @@ class AgentTransaction(Transaction):
         # Call after data has been set (size is computed in Transaction's init)
         Transaction.__init__(self)
 
-        # Emitters operate outside the regular transaction framework
-        if self._emitter_manager is not None:
-            self._emitter_manager.send(data, headers)
-
         # Insert the transaction(s) in the Manager
         for endpoint in self._endpoints:
             for api_key in self._endpoints[endpoint]:
@@ -197,76 +446,41 @@ class AgentTransaction(Transaction):
                 transaction._api_key = api_key
                 self._trManager.append(transaction)
                 log.debug("Created transaction %d" % transaction.get_id())
+
+        # Emitters operate outside the regular transaction framework, the
+        # payload is only queued for them
+        if self._emitter_manager is not None:
+            self._emitter_manager.send(data, headers)
+
         self._trManager.flush()
 
     def __sizeof__(self):
         return sys.getsizeof(self._data)
 
+    def __getstate__(self):
+        # Transactions are pickled when spilled to disk
+        state = self.__dict__.copy()
+        state['_headers'] = dict(self._headers)
+        return state
+
     def get_url(self, endpoint, api_key):
         endpoint_base_url = get_url_endpoint(endpoint)
-        if self._application.agent_dns_caching:
-            endpoint_base_url = self._application.get_from_dns_cache(endpoint_base_url)
         return "{0}/intake/{1}?api_key={2}".format(endpoint_base_url, self._msg_type, api_key)
 
     def flush(self):
-        # Getting proxy settings
-        proxy_settings = self._application._agentConfig.get('proxy_settings', None)
-
-        tornado_client_params = {
-            'method': 'POST',
-            'body': self._data,
-            'headers': self._headers,
-            'validate_cert': not self._application.skip_ssl_validation,
-            'allow_ipv6': True,
-            'request_timeout': self._request_timeout,
-        }
-
         # Remove headers that were passed by the emitter. Those don't apply anymore
-        # This is pretty hacky though as it should be done in pycurl or curl or tornado
+        headers = dict(self._headers)
         for h in HEADERS_TO_REMOVE:
-            if h in tornado_client_params['headers']:
-                del tornado_client_params['headers'][h]
+            if h in headers:
+                del headers[h]
                 log.debug("Removing {0} header.".format(h))
 
-        force_use_curl = False
-
-        if proxy_settings is not None:
-            force_use_curl = True
-            if pycurl is not None:
-                log.debug("Configuring tornado to use proxy settings: %s:****@%s:%s" % (proxy_settings['user'],
-                          proxy_settings['host'], proxy_settings['port']))
-                tornado_client_params['proxy_host'] = proxy_settings['host']
-                tornado_client_params['proxy_port'] = proxy_settings['port']
-                tornado_client_params['proxy_username'] = proxy_settings['user']
-                tornado_client_params['proxy_password'] = proxy_settings['password']
-
-                if self._application._agentConfig.get('proxy_forbid_method_switch'):
-                    # See http://stackoverflow.com/questions/8156073/curl-violate-rfc-2616-10-3-2-and-switch-from-post-to-get
-                    tornado_client_params['prepare_curl_callback'] = lambda curl: curl.setopt(pycurl.POSTREDIR, pycurl.REDIR_POST_ALL)
-
-        if (not self._application.use_simple_http_client or force_use_curl) and pycurl is not None:
-            ssl_certificate = self._application._agentConfig.get('ssl_certificate', None)
-            tornado_client_params['ca_certs'] = ssl_certificate
-
-        use_curl = force_use_curl or self._application._agentConfig.get("use_curl_http_client") and not self._application.use_simple_http_client
-
-        if use_curl:
-            if pycurl is None:
-                log.error("sts-agent is configured to use the Curl HTTP Client, but pycurl is not available on this system.")
-            else:
-                log.debug("Using CurlAsyncHTTPClient")
-                tornado.httpclient.AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
-        else:
-            log.debug("Using SimpleHTTPClient")
-        http = tornado.httpclient.AsyncHTTPClient()
-
         url = self.get_url(self._endpoint, self._api_key)
         log.debug(
             u"Sending %s to endpoint %s at %s",
             self._type, self._endpoint, url
         )
-        req = tornado.httpclient.HTTPRequest(url=url, **tornado_client_params)
-        http.fetch(req, callback=self.on_response)
+        self.get_client(self._endpoint).post(url, self._data, headers, self._request_timeout, self.on_response)
 
     def on_response(self, response):
         if response.error:
@@ -274,7 +488,7 @@ class AgentTransaction(Transaction):
             if response.code in RESPONSES_TO_REJECT:
                 self._trManager.tr_error_reject_request(self, response.code)
             else:
-                self._trManager.tr_error(self)
+                self._trManager.tr_error(self, retry_after=response.retry_after, response_code=response.code)
         else:
             self._trManager.tr_success(self)
 
@@ -289,41 +503,87 @@ class APIMetricTransaction(MetricTransaction):
 
     def get_url(self, endpoint, api_key):
         endpoint_base_url = get_url_endpoint(endpoint)
-        if self._application.agent_dns_caching:
-            endpoint_base_url = self._application.get_from_dns_cache(endpoint_base_url)
         return "{0}/api/v1/series/?api_key={1}".format(endpoint_base_url, api_key)
 
     def get_data(self):
         return self._data
 
+    def get_batch_key(self):
+        return 'series'
+
+    def merge(self, transactions):
+        """
+        Post the series of `transactions` in one payload, compressed once.
+        The transactions whose payload can't be read are left out.
+        """
+        series = []
+        members = []
+        for tr in transactions:
+            try:
+                payload = decode_payload(tr._data, tr._headers)
+            except Exception:
+                log.warning("Unable to read the payload of transaction %s, it will not be batched", tr.get_id())
+                continue
+            if not isinstance(payload, dict) or payload.keys() != ['series'] or not isinstance(payload['series'], list):
+                continue
+            series.extend(payload['series'])
+            members.append(tr)
+        if self not in members or len(members) < 2:
+            return self
+
+        batch = copy.copy(self)
+        batch._data = zlib.compress(json.dumps({'series': series}))
+        batch._headers = dict(self._headers)
+        batch._headers['Content-Type'] = 'application/json'
+        batch._headers['Content-Encoding'] = 'deflate'
+        batch._size = None
+        batch._batch = members
+        return batch
+
+
+class APISketchTransaction(MetricTransaction):
+    _type = "sketches"
+
+    def get_url(self, endpoint, api_key):
+        endpoint_base_url = get_url_endpoint(endpoint)
+        return "{0}/api/v1/sketches/?api_key={1}".format(endpoint_base_url, api_key)
+
 
 class APIServiceCheckTransaction(AgentTransaction):
     _type = "service checks"
 
     def get_url(self, endpoint, api_key):
         endpoint_base_url = get_url_endpoint(endpoint)
-        if self._application.agent_dns_caching:
-            endpoint_base_url = self._application.get_from_dns_cache(endpoint_base_url)
         return "{0}/api/v1/check_run/?api_key={1}".format(endpoint_base_url, api_key)
 
 
 class StatusHandler(tornado.web.RequestHandler):
+    """
+    JSON status of the forwarder queues, with a 503 when the forwarder is
+    unhealthy: an endpoint circuit is open, or a transaction has been queued
+    for more than `max_age` seconds. The legacy `threshold` on the queue
+    length, used by the install scripts, is still honoured.
+    """
 
     def get(self):
-        threshold = int(self.get_argument('threshold', -1))
-
         m = MetricTransaction.get_tr_manager()
+        status = m.get_status()
 
-        self.write("<table><tr><td>Id</td><td>Size</td><td>Error count</td><td>Next flush</td></tr>")
-        transactions = m.get_transactions()
-        for tr in transactions:
-            self.write("<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>" %
-                (tr.get_id(), tr.get_size(), tr.get_error_count(), tr.get_next_flush()))
-        self.write("</table>")
+        errors = m.get_health_errors(status, float(self.get_argument('max_age', STATUS_MAX_AGE)))
+        threshold = int(self.get_argument('threshold', -1))
+        if threshold >= 0 and status['queue_length'] > threshold:
+            errors.append("%s transactions queued, more than %s" % (status['queue_length'], threshold))
 
-        if threshold >= 0:
-            if len(transactions) > threshold:
-                self.set_status(503)
+        emitter_manager = AgentTransaction._emitter_manager
+        if emitter_manager is not None and emitter_manager.emitterThreads:
+            status['custom_emitters'] = emitter_manager.get_stats()
+
+        status['healthy'] = not errors
+        status['errors'] = errors
+        if errors:
+            self.set_status(503)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(status))
 
 
 class AgentInputHandler(tornado.web.RequestHandler):
@@ -370,6 +630,24 @@ class ApiInputHandler(tornado.web.RequestHandler):
             raise tornado.web.HTTPError(500)
 
 
+class ApiSketchHandler(tornado.web.RequestHandler):
+    """
+    Handler to submit the sketches of distributions
+    """
+    def post(self):
+        # read message
+        msg = self.request.body
+        headers = self.request.headers
+
+        if msg is not None:
+            # Setup a transaction for this message
+            tr = APISketchTransaction(msg, headers)
+        else:
+            raise tornado.web.HTTPError(500)
+
+        self.write("Transaction: %s" % tr.get_id())
+
+
 class ApiCheckRunHandler(tornado.web.RequestHandler):
     """
     Handler to submit Service Checks
@@ -393,8 +671,7 @@ class Application(tornado.web.Application):
     NO_PARALLELISM = 1
     DEFAULT_PARALLELISM = 5
 
-    def __init__(self, port, agentConfig, watchdog=True,
-                 skip_ssl_validation=False, use_simple_http_client=False):
+    def __init__(self, port, agentConfig, watchdog=True, skip_ssl_validation=False):
         self._port = int(port)
         self._agentConfig = agentConfig
         self._metrics = {}
@@ -410,10 +687,26 @@ class Application(tornado.web.Application):
         if len(agentConfig['endpoints']) > 1:
             max_parallelism = self.DEFAULT_PARALLELISM
 
+        # Transactions that do not fit in the queue are spilled to disk
+        self._spill_store = None
+        if agentConfig.get('forwarder_spill_path'):
+            self._spill_store = SpillStore(
+                agentConfig['forwarder_spill_path'],
+                max_size=int(agentConfig.get('forwarder_spill_max_size') or DEFAULT_MAX_SIZE),
+                max_age=int(agentConfig.get('forwarder_spill_max_age') or DEFAULT_MAX_AGE),
+                replay_policy=agentConfig.get('forwarder_spill_replay') or OLDEST_FIRST)
+
         self._tr_manager = TransactionManager(MAX_WAIT_FOR_REPLAY,
                                               MAX_QUEUE_SIZE, THROTTLING_DELAY,
-                                              max_parallelism=max_parallelism)
+                                              max_parallelism=max_parallelism,
+                                              spill_store=self._spill_store,
+                                              max_concurrency=int(agentConfig.get('forwarder_max_concurrency') or
+                                                                  DEFAULT_MAX_CONCURRENCY),
+                                              circuit_open_delay=float(agentConfig.get('forwarder_circuit_open_delay') or
+                                                                       CIRCUIT_OPEN_DELAY),
+                                              max_batch_size=int(agentConfig.get('forwarder_max_batch_size', MAX_BATCH_SIZE)))
         AgentTransaction.set_tr_manager(self._tr_manager)
+        self._tr_manager.set_connection_stats(AgentTransaction.get_connection_stats)
 
         self._watchdog = None
         self.skip_ssl_validation = skip_ssl_validation or _is_affirmative(agentConfig.get('skip_ssl_validation'))
@@ -421,7 +714,6 @@ class Application(tornado.web.Application):
         self.agent_dns_ttl = int(agentConfig.get('dns_ttl', DEFAULT_DNS_TTL))
         if self.agent_dns_caching:
             self._dns_cache = DNSCache(ttl=self.agent_dns_ttl)
-        self.use_simple_http_client = use_simple_http_client
         if self.skip_ssl_validation:
             log.info("Skipping SSL hostname validation, useful when using a transparent proxy")
 
@@ -432,17 +724,6 @@ class Application(tornado.web.Application):
                                              max_resets=WATCHDOG_HIGH_ACTIVITY_THRESHOLD)
 
 
-    def get_from_dns_cache(self, url):
-        if not self.agent_dns_caching:
-            log.debug('Caching disabled, not resolving.')
-            return url
-
-        location = urlparse(url)
-        resolve = self._dns_cache.resolve(location.netloc)
-        return "{scheme}://{ip}".format(scheme=location.scheme,
-                                        ip=resolve)
-
-
     def log_request(self, handler):
         """ Override the tornado logging method.
         If everything goes well, log level is DEBUG.
@@ -490,6 +771,7 @@ class Application(tornado.web.Application):
             (r"/intake/metrics?", MetricsAgentInputHandler),
             (r"/intake/metadata?", MetadataAgentInputHandler),
             (r"/api/v1/series/?", ApiInputHandler),
+            (r"/api/v1/sketches/?", ApiSketchHandler),
             (r"/api/v1/check_run/?", ApiCheckRunHandler),
             (r"/status/?", StatusHandler),
         ]
@@ -560,16 +842,19 @@ class Application(tornado.web.Application):
         # Start everything
         if self._watchdog:
             self._watchdog.reset()
+        if self._spill_store is not None:
+            self._spill_store.start()
         tr_sched.start()
 
         self.mloop.start()
+        self._tr_manager.stop()
         log.info("Stopped")
 
     def stop(self):
         self.mloop.stop()
 
 
-def init(skip_ssl_validation=False, use_simple_http_client=False):
+def init(skip_ssl_validation=False):
     agentConfig = get_config(parse_args=False)
 
     port = agentConfig.get('listen_port', 18123)
@@ -578,7 +863,7 @@ def init(skip_ssl_validation=False, use_simple_http_client=False):
     else:
         port = int(port)
 
-    app = Application(port, agentConfig, skip_ssl_validation=skip_ssl_validation, use_simple_http_client=use_simple_http_client)
+    app = Application(port, agentConfig, skip_ssl_validation=skip_ssl_validation)
 
     def sigterm_handler(signum, frame):
         log.info("caught sigterm. stopping")
@@ -593,20 +878,20 @@ def init(skip_ssl_validation=False, use_simple_http_client=False):
 
 def main():
     define("sslcheck", default=1, help="Verify SSL hostname, on by default")
-    define("use_simple_http_client", default=0, help="Use Tornado SimpleHTTPClient instead of CurlAsyncHTTPClient")
+    define("use_simple_http_client", default=0, help="Deprecated, ignored")
     args = parse_command_line()
     skip_ssl_validation = False
-    use_simple_http_client = False
 
     if unicode(options.sslcheck) == u"0":
         skip_ssl_validation = True
 
     if unicode(options.use_simple_http_client) == u"1":
-        use_simple_http_client = True
+        log.warning("The use_simple_http_client option is deprecated and ignored, "
+                    "the forwarder always uses its keep-alive connection pools")
 
     # If we don't have any arguments, run the server.
     if not args:
-        app = init(skip_ssl_validation, use_simple_http_client=use_simple_http_client)
+        app = init(skip_ssl_validation)
         try:
             app.run()
         except Exception:
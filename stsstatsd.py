@@ -13,16 +13,22 @@ set_no_proxy_settings()
 
 # stdlib
 import copy
+import heapq
 import os
 import logging
+import errno
+import multiprocessing
 import optparse
 import select
 import signal
 import socket
+import stat
 import string
 import sys
 import threading
+from functools import partial
 from time import sleep, time
+from Queue import Empty, Full, Queue
 from urllib import urlencode
 import zlib
 
@@ -34,7 +40,7 @@ import requests
 import simplejson as json
 
 # project
-from aggregator import get_formatter, MetricsBucketAggregator
+from aggregator import api_formatter, get_formatter, MetricsBucketAggregator
 from checks.check_status import DogstatsdStatus
 from checks.metric_types import MetricTypes
 from config import (
@@ -52,8 +58,9 @@ from daemon import (
 from util import chunks, get_uuid, plural
 from utils.hostname import get_hostname
 from utils.http import get_expvar_stats
+from utils.hyperloglog import DEFAULT_PRECISION
 from utils.net import inet_pton
-from utils.net import IPV6_V6ONLY, IPPROTO_IPV6
+from utils.net import IPV6_V6ONLY, IPPROTO_IPV6, SO_REUSEPORT, get_socket_pending_bytes, get_udp_socket_stats
 from utils.pidfile import PidFile
 from utils.watchdog import Watchdog
 
@@ -74,6 +81,26 @@ DOGSTATSD_AGGREGATOR_BUCKET_SIZE = 10
 
 WATCHDOG_TIMEOUT = 120
 UDP_SOCKET_TIMEOUT = 5
+# Batched receive: drain at most this many datagrams, for at most this many
+# seconds, on every wakeup of the server loop.
+DEFAULT_RECV_BATCH_SIZE = 1
+DEFAULT_RECV_BATCH_TIMEOUT = 0.05
+# Memory budget of the cache of parsed packet contexts, in bytes
+DEFAULT_CONTEXT_CACHE_MAX_BYTES = 16 * 1024 * 1024
+# Metric names with the most rejected contexts reported at every flush
+CONTEXT_GUARD_TOP_OFFENDERS = 10
+# Permissions of the unix socket file, clients need write access
+DEFAULT_UNIX_SOCKET_PERMS = '0722'
+# TCP listener: connections accepted at once, bytes read from a connection on
+# each wakeup, and longest line kept waiting for its newline.
+DEFAULT_TCP_MAX_CONNECTIONS = 256
+TCP_LISTEN_BACKLOG = 128
+TCP_READ_SIZE = 64 * 1024
+TCP_MAX_LINE_LENGTH = 64 * 1024
+# Sharded mode: how many handoffs per worker can wait for the reporter before
+# they get dropped, and how long to wait for workers to exit on shutdown.
+SHARD_QUEUE_SIZE_PER_WORKER = 4
+SHARD_SHUTDOWN_TIMEOUT = 2 * UDP_SOCKET_TIMEOUT
 # Since we call flush more often than the metrics aggregation interval, we should
 #  log a bunch of flushes in a row every so often.
 FLUSH_LOGGING_PERIOD = 70
@@ -81,6 +108,21 @@ FLUSH_LOGGING_INITIAL = 10
 FLUSH_LOGGING_COUNT = 5
 EVENT_CHUNK_SIZE = 50
 COMPRESS_THRESHOLD = 1024
+# Compressed size limit of the series and sketches payloads, a flush posts
+# as many payloads as needed
+DEFAULT_MAX_PAYLOAD_SIZE = 2 * 1024 * 1024
+# Payloads are posted in the background by sender threads sharing a pool of
+# keep-alive connections. Payloads are dropped when the queue is full, when
+# the intake refuses them, or after SEND_MAX_RETRIES failed attempts spaced
+# by an exponential backoff.
+DEFAULT_SENDER_THREADS = 4
+DEFAULT_SEND_QUEUE_SIZE = 100
+SEND_MAX_RETRIES = 3
+SEND_RETRY_BACKOFF = 1
+SEND_MAX_BACKOFF = 16
+SEND_TIMEOUT = 5
+# How long to keep posting the queued payloads on shutdown
+SENDER_SHUTDOWN_TIMEOUT = 5
 
 
 def add_serialization_status_metric(status, hostname):
@@ -116,27 +158,133 @@ def unicode_metrics(metrics):
     return metrics
 
 
-def serialize_metrics(metrics, hostname):
-    try:
-        metrics.append(add_serialization_status_metric("success", hostname))
-        serialized = json.dumps({"series": metrics})
-    except UnicodeDecodeError as e:
-        log.exception("Unable to serialize payload. Trying to replace bad characters. %s", e)
-        metrics.append(add_serialization_status_metric("failure", hostname))
+def deflate_bound(size):
+    """
+    Upper bound of the deflated size of `size` bytes, zlib's `deflateBound`
+    plus the stream header, checksum and the marker of a sync flush.
+    """
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 13 + 11
+
+
+class PayloadStream(object):
+    """
+    A `{"<key>": [...]}` JSON payload written item by item into a
+    `zlib.compressobj`, so that the uncompressed payload is never held in
+    memory. `add` refuses an item that could make the compressed payload
+    larger than `max_size`, unless the payload is empty. Payloads smaller
+    than COMPRESS_THRESHOLD are not compressed.
+    """
+
+    def __init__(self, key, max_size):
+        self.max_size = max_size
+        self.footer = ']}'
+        self.item_count = 0
+        # Uncompressed pieces, until the payload reaches COMPRESS_THRESHOLD
+        self.raw = ['{"%s": [' % key]
+        self.raw_size = len(self.raw[0])
+        self.compressor = None
+        self.chunks = []
+        self.compressed_size = 0
+        # Bytes written to the compressor since its last flush, which may not
+        # be part of the compressed chunks yet
+        self.pending_size = 0
+
+    def add(self, item):
+        data = ', ' + item if self.item_count else item
+        if self.compressor is not None and self._size_bound(len(data)) > self.max_size:
+            self._sync_flush()
+        if self.item_count and self._size_bound(len(data)) > self.max_size:
+            return False
+        self._write(data)
+        self.item_count += 1
+        return True
+
+    def close(self):
+        """
+        Return the body and the headers of the payload.
+        """
+        if self.compressor is None:
+            self.raw.append(self.footer)
+            return ''.join(self.raw), {'Content-Type': 'application/json'}
+        self._compress(self.footer)
+        self._append_chunk(self.compressor.flush())
+        return ''.join(self.chunks), {'Content-Type': 'application/json', 'Content-Encoding': 'deflate'}
+
+    def _size_bound(self, size):
+        if self.compressor is None:
+            return deflate_bound(self.raw_size + size + len(self.footer))
+        return self.compressed_size + deflate_bound(self.pending_size + size + len(self.footer))
+
+    def _write(self, data):
+        if self.compressor is not None:
+            self._compress(data)
+            return
+        self.raw.append(data)
+        self.raw_size += len(data)
+        if self.raw_size > COMPRESS_THRESHOLD:
+            self.compressor = zlib.compressobj()
+            raw, self.raw = ''.join(self.raw), None
+            self._compress(raw)
+
+    def _compress(self, data):
+        self._append_chunk(self.compressor.compress(data))
+        self.pending_size += len(data)
+
+    def _sync_flush(self):
+        self._append_chunk(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.pending_size = 0
+
+    def _append_chunk(self, chunk):
+        if chunk:
+            self.chunks.append(chunk)
+            self.compressed_size += len(chunk)
+
+
+def stream_payloads(key, items, max_size):
+    """
+    Yield the (body, headers) of the payloads of the JSON-encoded `items`,
+    each one at most `max_size` bytes once compressed unless it is a single
+    larger item.
+    """
+    payload = PayloadStream(key, max_size)
+    for item in items:
+        if not payload.add(item):
+            yield payload.close()
+            payload = PayloadStream(key, max_size)
+            payload.add(item)
+    if payload.item_count:
+        yield payload.close()
+
+
+def encode_metrics(metrics, hostname):
+    """
+    JSON-encode the metrics one by one, followed by the serialization status
+    metric.
+    """
+    status = "success"
+    for metric in metrics:
         try:
-            log.error(metrics)
-            serialized = json.dumps({"series": unicode_metrics(metrics)})
-        except Exception as e:
-            log.exception("Unable to serialize payload. Giving up. %s", e)
-            serialized = json.dumps({"series": [add_serialization_status_metric("permanent_failure", hostname)]})
+            yield json.dumps(metric)
+        except UnicodeDecodeError as e:
+            log.exception("Unable to serialize metric. Trying to replace bad characters. %s", e)
+            try:
+                log.error(metric)
+                encoded = json.dumps(unicode_metrics([metric])[0])
+                if status == "success":
+                    status = "failure"
+                yield encoded
+            except Exception as e:
+                log.exception("Unable to serialize metric. Giving up. %s", e)
+                status = "permanent_failure"
+    yield json.dumps(add_serialization_status_metric(status, hostname))
 
-    if len(serialized) > COMPRESS_THRESHOLD:
-        headers = {'Content-Type': 'application/json',
-                   'Content-Encoding': 'deflate'}
-        serialized = zlib.compress(serialized)
-    else:
-        headers = {'Content-Type': 'application/json'}
-    return serialized, headers
+
+def serialize_metrics(metrics, hostname, max_payload_size=DEFAULT_MAX_PAYLOAD_SIZE):
+    return stream_payloads("series", encode_metrics(metrics, hostname), max_payload_size)
+
+
+def serialize_sketches(sketches, max_payload_size=DEFAULT_MAX_PAYLOAD_SIZE):
+    return stream_payloads("sketches", (json.dumps(sketch) for sketch in sketches), max_payload_size)
 
 
 def serialize_event(event):
@@ -192,6 +340,135 @@ def get_socket_address(host, port, ipv4_only=False):
     return sockaddr
 
 
+class PayloadSender(object):
+    """
+    Posts payloads from a bounded queue in background threads, so that the
+    reporter never waits for the intake. The threads share a keep-alive
+    connection pool and retry failed posts with an exponential backoff.
+    """
+
+    def __init__(self, thread_count=None, queue_size=None, max_retries=SEND_MAX_RETRIES):
+        self.thread_count = thread_count or DEFAULT_SENDER_THREADS
+        self.queue = Queue(queue_size or DEFAULT_SEND_QUEUE_SIZE)
+        self.max_retries = max_retries
+        self.finished = threading.Event()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.thread_count)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.threads = []
+        # Counters since the last `flush_stats`
+        self.stats_lock = threading.Lock()
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def start(self):
+        for i in xrange(self.thread_count):
+            thread = threading.Thread(target=self.run, name='stsstatsd-sender-%s' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=SENDER_SHUTDOWN_TIMEOUT):
+        """
+        Post the payloads still queued, without retrying them, for at most
+        `timeout` seconds.
+        """
+        self.finished.set()
+        deadline = time() + timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time()))
+        self.session.close()
+
+    def submit(self, url, data, headers):
+        try:
+            self.queue.put_nowait((url, data, headers))
+        except Full:
+            log.warning("Too many payloads waiting to be posted, dropping one")
+            self._count('dropped')
+
+    def run(self):
+        while True:
+            try:
+                url, data, headers = self.queue.get(timeout=0.5)
+            except Empty:
+                if self.finished.isSet():
+                    return
+                continue
+            try:
+                self.post(url, data, headers)
+            except Exception:
+                log.exception("Unable to post payload.")
+                self._count('dropped')
+
+    def post(self, url, data, headers):
+        log_url = string.split(url, "api_key=")[0]
+        for attempt in xrange(self.max_retries + 1):
+            if attempt:
+                if self.finished.wait(min(SEND_RETRY_BACKOFF * 2 ** (attempt - 1), SEND_MAX_BACKOFF)):
+                    break
+                self._count('retried')
+
+            start_time = time()
+            try:
+                r = self.session.post(url, data=data, timeout=SEND_TIMEOUT, headers=headers)
+            except requests.RequestException as e:
+                log.warning("Unable to post payload to %s (attempt %s): %s", log_url, attempt + 1, e)
+                continue
+
+            duration = round((time() - start_time) * 1000.0, 4)
+            log.debug("%s POST %s (%sms)" % (r.status_code, log_url, duration))
+            if r.status_code < 400:
+                self._count('sent')
+                return
+            if r.status_code < 500 and r.status_code != 429:
+                log.error("Payload refused by %s, received status code: %s", log_url, r.status_code)
+                break
+            log.warning("Unable to post payload to %s (attempt %s), received status code: %s",
+                        log_url, attempt + 1, r.status_code)
+
+        log.error("Dropping payload for %s", log_url)
+        self._count('dropped')
+
+    def _count(self, name):
+        with self.stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def flush_stats(self):
+        """
+        Return and reset the payload counters, along with the queue size.
+        """
+        with self.stats_lock:
+            stats = {'sent': self.sent, 'retried': self.retried, 'dropped': self.dropped,
+                     'queued': self.queue.qsize()}
+            self.sent = self.retried = self.dropped = 0
+        return stats
+
+
+class CounterDeltas(object):
+    """
+    Increase since the previous call of the counters of `(name, value,
+    metric_type)` stats. The server thread only ever increments its
+    counters, and the reporting thread keeps the values it has seen, so no
+    increment is lost to a reset.
+    """
+
+    def __init__(self):
+        self.last = {}
+
+    def deltas(self, stats):
+        result = []
+        for name, value, mtype in stats:
+            if mtype == 'c':
+                last = self.last.get(name, 0)
+                self.last[name] = value
+                # A counter lower than the last one was reset by a restart
+                value = value - last if value >= last else value
+            result.append((name, value, mtype))
+        return result
+
+
 class Reporter(threading.Thread):
     """
     The reporter periodically sends the aggregated metrics to the
@@ -199,11 +476,24 @@ class Reporter(threading.Thread):
     """
 
     def __init__(self, interval, metrics_aggregator, api_host, api_key=None,
-                 use_watchdog=False, event_chunk_size=None):
+                 use_watchdog=False, event_chunk_size=None, shard_queue=None, server=None,
+                 max_payload_size=None, sender_threads=None, send_queue_size=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
         self.metrics_aggregator = metrics_aggregator
+        # In sharded mode, the workers hand their aggregated state over through this queue
+        self.shard_queue = shard_queue
+        # The server exposing socket-level stats
+        self.server = server
+        self.socket_counters = CounterDeltas()
+        # Metric names with the most samples rejected by the context guard
+        self.rejected_context_count = 0
+        self.top_rejected_contexts = []
+        # Kernel counters of the UDP socket, None where they are not available
+        self.udp_rx_queue = None
+        self.udp_drops = None
+        self.last_udp_drops = None
         self.flush_count = 0
         self.log_count = 0
         self.hostname = get_hostname()
@@ -215,6 +505,8 @@ class Reporter(threading.Thread):
         self.api_key = api_key
         self.api_host = api_host
         self.event_chunk_size = event_chunk_size or EVENT_CHUNK_SIZE
+        self.max_payload_size = max_payload_size or DEFAULT_MAX_PAYLOAD_SIZE
+        self.sender = PayloadSender(sender_threads, send_queue_size)
 
     def stop(self):
         log.info("Stopping reporter")
@@ -226,19 +518,106 @@ class Reporter(threading.Thread):
         log.debug("Watchdog enabled: %s" % bool(self.watchdog))
 
         # Persist a start-up message.
-        DogstatsdStatus().persist()
+        DogstatsdStatus().publish()
+        self.sender.start()
 
         while not self.finished.isSet():  # Use camel case isSet for 2.4 support.
             self.finished.wait(self.interval)
+            if self.shard_queue is not None:
+                self.merge_shards()
             self.metrics_aggregator.send_packet_count('stackstate.stsstatsd.packet.count')
+            self.metrics_aggregator.send_context_cache_stats('stackstate.stsstatsd.context_cache')
+            self.submit_socket_stats()
+            self.submit_context_guard_stats()
+            self.submit_sender_stats()
             self.flush()
             if self.watchdog:
                 self.watchdog.reset()
 
+        self.sender.stop()
         # Clean up the status messages.
         log.debug("Stopped reporter")
         DogstatsdStatus.remove_latest_status()
 
+    def submit_socket_stats(self):
+        if self.server is None:
+            return
+        try:
+            for name, value, mtype in self.socket_counters.deltas(self.server.socket_stats()):
+                self.metrics_aggregator.submit_internal_metric(name, value, mtype)
+        except Exception:
+            log.exception("Error collecting socket stats")
+        try:
+            self.submit_udp_stats()
+        except Exception:
+            log.exception("Error collecting the kernel stats of the UDP socket")
+
+    def submit_udp_stats(self):
+        """
+        Sample the receive queue and the drop counter of the UDP socket, which
+        are only reported by the kernel.
+        """
+        udp_stats = self.server.udp_stats()
+        if udp_stats is None:
+            return
+        self.udp_rx_queue, drops = udp_stats
+        # The counter is reset when a sharded worker restarts
+        dropped = drops - self.last_udp_drops if self.last_udp_drops is not None else drops
+        dropped = max(0, dropped)
+        self.last_udp_drops = drops
+        self.udp_drops = (self.udp_drops or 0) + dropped
+        if dropped:
+            log.warning("The kernel dropped %s packet%s, statsd_so_rcvbuf may be too small",
+                        dropped, plural(dropped))
+        self.metrics_aggregator.submit_internal_metric('stackstate.stsstatsd.udp.rx_queue', self.udp_rx_queue, 'g')
+        self.metrics_aggregator.submit_internal_metric('stackstate.stsstatsd.udp.drops', dropped, 'c')
+
+    def submit_sender_stats(self):
+        stats = self.sender.flush_stats()
+        if stats['dropped']:
+            log.warning("Dropped %s payload%s since the last flush", stats['dropped'], plural(stats['dropped']))
+        for name in ['sent', 'retried', 'dropped']:
+            self.metrics_aggregator.submit_internal_metric('stackstate.stsstatsd.payloads.%s' % name, stats[name], 'c')
+        self.metrics_aggregator.submit_internal_metric('stackstate.stsstatsd.payloads.queued', stats['queued'], 'g')
+
+    def submit_context_guard_stats(self):
+        try:
+            rejected_by_name = self.metrics_aggregator.flush_rejected_contexts()
+        except Exception:
+            log.exception("Error collecting context guard stats")
+            return
+
+        self.rejected_context_count = sum(rejected_by_name.itervalues())
+        self.top_rejected_contexts = heapq.nlargest(CONTEXT_GUARD_TOP_OFFENDERS, rejected_by_name.iteritems(),
+                                                    key=lambda item: item[1])
+        if not self.rejected_context_count:
+            return
+
+        log.warning("%s samples of new contexts were over the context budgets, top metric names: %s",
+                    self.rejected_context_count,
+                    ", ".join("%s (%s)" % (name, count) for name, count in self.top_rejected_contexts))
+        for name, count in self.top_rejected_contexts:
+            self.metrics_aggregator.submit_internal_metric('stackstate.stsstatsd.context_guard.rejected', count, 'c',
+                                                           tags=['metric_name:%s' % name])
+
+    def merge_shards(self):
+        """
+        Merge every handoff waiting in the shard queue into the aggregator, so
+        that the next flush submits a single series for all the workers.
+        """
+        merged = 0
+        while True:
+            try:
+                handoff = self.shard_queue.get_nowait()
+            except Empty:
+                break
+            try:
+                self.metrics_aggregator.merge_handoff(handoff)
+                merged += 1
+            except Exception:
+                log.exception("Error merging a worker handoff")
+        log.debug("Merged %s worker handoff%s", merged, plural(merged))
+
     def flush(self):
         try:
             self.flush_count += 1
@@ -251,7 +630,16 @@ class Reporter(threading.Thread):
             if self.flush_count % FLUSH_LOGGING_PERIOD == 0:
                 self.log_count = 0
             if count:
-                self.submit(metrics)
+                series, sketches = [], []
+                for metric in metrics:
+                    if metric['type'] == MetricTypes.DISTRIBUTION:
+                        sketches.append(metric)
+                    else:
+                        series.append(metric)
+                if series:
+                    self.submit(series)
+                if sketches:
+                    self.submit_sketches(sketches)
 
             events = self.metrics_aggregator.flush_events()
             event_count = len(events)
@@ -280,7 +668,11 @@ class Reporter(threading.Thread):
                 metric_count=count,
                 event_count=event_count,
                 service_check_count=service_check_count,
-            ).persist()
+                rejected_context_count=self.rejected_context_count,
+                top_rejected_contexts=self.top_rejected_contexts,
+                udp_rx_queue=self.udp_rx_queue,
+                udp_drops=self.udp_drops,
+            ).publish()
 
         except Exception:
             if self.finished.isSet():
@@ -289,12 +681,23 @@ class Reporter(threading.Thread):
                 log.exception("Error flushing metrics")
 
     def submit(self, metrics):
-        body, headers = serialize_metrics(metrics, self.hostname)
         params = {}
         if self.api_key:
             params['api_key'] = self.api_key
         url = '%s/api/v1/series?%s' % (self.api_host, urlencode(params))
-        self.submit_http(url, body, headers)
+        for body, headers in serialize_metrics(metrics, self.hostname, self.max_payload_size):
+            self.submit_http(url, body, headers)
+
+    def submit_sketches(self, sketches):
+        """
+        Distributions are sent as sketches, merged by the backend across hosts.
+        """
+        params = {}
+        if self.api_key:
+            params['api_key'] = self.api_key
+        url = '%s/api/v1/sketches?%s' % (self.api_host, urlencode(params))
+        for body, headers in serialize_sketches(sketches, self.max_payload_size):
+            self.submit_http(url, body, headers)
 
     def submit_events(self, events):
         headers = {'Content-Type':'application/json'}
@@ -318,24 +721,8 @@ class Reporter(threading.Thread):
 
     def submit_http(self, url, data, headers):
         headers["DD-Dogstatsd-Version"] = get_version()
-        log.debug("Posting payload to %s" % string.split(url, "api_key=")[0])
-        try:
-            start_time = time()
-            r = requests.post(url, data=data, timeout=5, headers=headers)
-            r.raise_for_status()
-
-            if r.status_code >= 200 and r.status_code < 205:
-                log.debug("Payload accepted")
-
-            status = r.status_code
-            duration = round((time() - start_time) * 1000.0, 4)
-            log.debug("%s POST %s (%sms)" % (status, string.split(url, "api_key=")[0], duration))
-        except Exception:
-            log.exception("Unable to post payload.")
-            try:
-                log.error("Received status code: {0}".format(r.status_code))
-            except Exception:
-                pass
+        log.debug("Queueing payload for %s" % string.split(url, "api_key=")[0])
+        self.sender.submit(url, data, headers)
 
     def submit_service_checks(self, service_checks):
         headers = {'Content-Type':'application/json'}
@@ -348,18 +735,190 @@ class Reporter(threading.Thread):
         self.submit_http(url, json.dumps(service_checks), headers)
 
 
+class TcpConnection(object):
+    __slots__ = ('sock', 'peer', 'partial', 'packets', 'bytes', 'connected_at', 'last_stats_packets',
+                 'last_stats_time')
+
+    def __init__(self, sock, peer):
+        self.sock = sock
+        self.peer = peer
+        # Last line of the stream, until its newline is received
+        self.partial = ''
+        self.packets = 0
+        self.bytes = 0
+        self.connected_at = self.last_stats_time = time()
+        self.last_stats_packets = 0
+
+
+class TcpListener(object):
+    """
+    Newline-delimited statsd packets over TCP, for producers sending bursts
+    too large for UDP. Connections are read by the select loop of the server
+    only, so when the aggregator lags the unread bytes fill the kernel
+    buffers and TCP flow control blocks the producers instead of losing
+    packets.
+    """
+
+    def __init__(self, host, port, max_connections=None, reuse_port=False):
+        self.host = host
+        self.port = port
+        self.max_connections = int(max_connections or DEFAULT_TCP_MAX_CONNECTIONS)
+        self.reuse_port = reuse_port
+        self.socket = None
+        self.connections = {}
+        # Sockets to select on: the listening socket and the connections
+        self.sockets = []
+        self.packets = 0
+        self.rejected_connections = 0
+
+    def bind(self):
+        ipv4_only = False
+        try:
+            self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+            self.socket.setsockopt(IPPROTO_IPV6, IPV6_V6ONLY, 0)
+        except Exception:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            ipv4_only = True
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Sharded workers share the port, the kernel balances connections between them
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.socket.setblocking(0)
+        self.socket.bind(get_socket_address(self.host, int(self.port), ipv4_only=ipv4_only))
+        self.socket.listen(TCP_LISTEN_BACKLOG)
+        self.sockets = [self.socket]
+
+    def owns(self, sock):
+        return sock is self.socket or sock in self.connections
+
+    def read(self, sock):
+        """
+        Accept a connection or read from one, return the complete lines read.
+        """
+        if sock is self.socket:
+            self._accept()
+            return None
+
+        connection = self.connections[sock]
+        try:
+            data = sock.recv(TCP_READ_SIZE)
+        except socket.error as e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
+            log.warning('Error reading from TCP connection %s: %s', connection.peer, e)
+            data = ''
+        if not data:
+            # The last line does not need a newline
+            self.close_connection(connection)
+            lines = connection.partial
+        else:
+            connection.bytes += len(data)
+            data = connection.partial + data
+            end = data.rfind('\n')
+            if end == -1:
+                lines, connection.partial = '', data
+            else:
+                lines, connection.partial = data[:end], data[end + 1:]
+            if len(connection.partial) > TCP_MAX_LINE_LENGTH:
+                log.warning('Closing TCP connection %s: line longer than %s bytes', connection.peer,
+                            TCP_MAX_LINE_LENGTH)
+                self.close_connection(connection)
+        if not lines:
+            return None
+        packets = lines.count('\n') + 1
+        connection.packets += packets
+        self.packets += packets
+        return lines
+
+    def _accept(self):
+        try:
+            sock, peer = self.socket.accept()
+        except socket.error as e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        if len(self.connections) >= self.max_connections:
+            log.warning('Refusing TCP connection from %s: %s connections already open', peer, self.max_connections)
+            self.rejected_connections += 1
+            sock.close()
+            return
+        sock.setblocking(0)
+        log.debug('Accepted TCP connection from %s', peer)
+        self.connections[sock] = TcpConnection(sock, peer)
+        self.sockets = [self.socket] + self.connections.keys()
+
+    def close_connection(self, connection):
+        self.connections.pop(connection.sock, None)
+        self.sockets = [self.socket] + self.connections.keys()
+        try:
+            connection.sock.close()
+        except socket.error:
+            pass
+        duration = max(time() - connection.connected_at, 0.001)
+        log.debug('Closed TCP connection from %s: %s packets, %s bytes in %.1fs (%.0f packets/s)',
+                  connection.peer, connection.packets, connection.bytes, duration, connection.packets / duration)
+
+    def close(self):
+        for connection in self.connections.values():
+            self.close_connection(connection)
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        self.sockets = []
+
+    def stats(self):
+        """
+        Internal metrics: the open connections, the packets received and the
+        connections rejected since the listener was bound, and the throughput
+        of every connection since the last call as a histogram. The counters
+        are only incremented by the server thread, the caller reports their
+        increase with `CounterDeltas`.
+        """
+        now = time()
+        stats = [
+            ('stackstate.stsstatsd.tcp.connections', len(self.connections), 'g'),
+            ('stackstate.stsstatsd.tcp.packets', self.packets, 'c'),
+            ('stackstate.stsstatsd.tcp.rejected_connections', self.rejected_connections, 'c'),
+        ]
+        # The packets of a connection are never reset either, the last ones
+        # seen are only written here
+        for connection in self.connections.values():
+            elapsed = now - connection.last_stats_time
+            if elapsed > 0:
+                stats.append(('stackstate.stsstatsd.tcp.connection_packets_per_second',
+                              (connection.packets - connection.last_stats_packets) / elapsed, 'h'))
+            connection.last_stats_packets = connection.packets
+            connection.last_stats_time = now
+        return stats
+
+
 class Server(object):
     """
     A statsd udp server.
     """
-    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None, so_rcvbuf=None):
+    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None, so_rcvbuf=None,
+                 recv_batch_size=None, recv_batch_timeout=None, reuse_port=False,
+                 socket_path=None, socket_perms=None, tcp_port=None, tcp_max_connections=None):
         self.sockaddr = None
         self.socket = None
+        self.socket_inode = None
         self.metrics_aggregator = metrics_aggregator
         self.host = host
         self.port = port
         self.buffer_size = 1024 * 8
         self.so_rcvbuf = so_rcvbuf
+        self.recv_batch_size = max(1, int(recv_batch_size or DEFAULT_RECV_BATCH_SIZE))
+        self.recv_batch_timeout = float(recv_batch_timeout or DEFAULT_RECV_BATCH_TIMEOUT)
+        self.reuse_port = reuse_port
+        self.socket_path = socket_path
+        self.socket_perms = int(str(socket_perms or DEFAULT_UNIX_SOCKET_PERMS), 8)
+        self.uds_socket = None
+        self.uds_packets = 0
+        self.uds_dropped = 0
+        self.uds_backlog = 0
+        self.tcp_port = tcp_port
+        self.tcp_max_connections = tcp_max_connections
+        self.tcp = None
 
         self.running = False
 
@@ -400,6 +959,11 @@ class Server(object):
 
         self.socket.setblocking(0)
 
+        # Let several processes bind the same port, the kernel balances
+        # datagrams between them.
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
         #let's get the sockaddr
         self.sockaddr = get_socket_address(self.host, int(self.port), ipv4_only=ipv4_only)
 
@@ -408,14 +972,49 @@ class Server(object):
         except TypeError:
             log.error('Unable to start StsStatsD server loop, exiting...')
             return
+        # Identifies the socket in /proc/net/udp
+        self.socket_inode = os.fstat(self.socket.fileno()).st_ino
 
         log.info('Listening on socket address: %s', str(self.sockaddr))
 
+        sockets = [self.socket]
+        if self.socket_path:
+            try:
+                self.uds_socket = self._bind_unix_socket()
+                sockets.append(self.uds_socket)
+                log.info('Listening on unix socket: %s', self.socket_path)
+            except Exception:
+                log.exception('Unable to listen on unix socket %s', self.socket_path)
+        if self.tcp_port:
+            try:
+                tcp = TcpListener(self.host, self.tcp_port, self.tcp_max_connections, self.reuse_port)
+                tcp.bind()
+                self.tcp = tcp
+                log.info('Listening on TCP port %s', self.tcp_port)
+            except Exception:
+                log.exception('Unable to listen on TCP port %s', self.tcp_port)
+
+        try:
+            if self.recv_batch_size > 1:
+                log.info('Receiving up to %s datagrams per wakeup (%ss budget)',
+                         self.recv_batch_size, self.recv_batch_timeout)
+                self._run_batched(sockets)
+            else:
+                self._run(sockets)
+        finally:
+            if self.uds_socket is not None:
+                self._close_unix_socket()
+            if self.tcp is not None:
+                self.tcp.close()
+
+    def _run(self, sockets):
         # Inline variables for quick look-up.
         buffer_size = self.buffer_size
         aggregator_submit = self.metrics_aggregator.submit_packets
-        sock = [self.socket]
-        socket_recv = self.socket.recv
+        begin_submission = self.metrics_aggregator.begin_submission
+        end_submission = self.metrics_aggregator.end_submission
+        uds_socket = self.uds_socket
+        tcp = self.tcp
         select_select = select.select
         select_error = select.error
         timeout = UDP_SOCKET_TIMEOUT
@@ -427,10 +1026,29 @@ class Server(object):
         message = None
         while self.running:
             try:
-                ready = select_select(sock, [], [], timeout)
-                if ready[0]:
-                    message = socket_recv(buffer_size)
-                    aggregator_submit(message)
+                ready = select_select(sockets if tcp is None else sockets + tcp.sockets, [], [], timeout)
+                for sock in ready[0]:
+                    if tcp is not None and tcp.owns(sock):
+                        message = tcp.read(sock)
+                        if message:
+                            begin_submission()
+                            try:
+                                aggregator_submit(message)
+                            finally:
+                                end_submission()
+                        continue
+                    if sock is uds_socket:
+                        message = self._receive_unix(sock)
+                        self._sample_unix_backlog()
+                        if message is None:
+                            continue
+                    else:
+                        message = sock.recv(buffer_size)
+                    begin_submission()
+                    try:
+                        aggregator_submit(message)
+                    finally:
+                        end_submission()
 
                     if should_forward:
                         forward_udp_sock.send(message)
@@ -444,10 +1062,379 @@ class Server(object):
             except Exception:
                 log.exception('Error receiving datagram `%s`', message)
 
+    def _run_batched(self, sockets):
+        """
+        Select loop draining every pending datagram on each wakeup, so that a
+        burst empties the kernel receive buffer instead of waiting for one
+        `select` call per datagram.
+        """
+        # Inline variables for quick look-up.
+        aggregator_submit_batch = self.metrics_aggregator.submit_packets_batch
+        aggregator_submit_metric = self.metrics_aggregator.submit_metric
+        begin_submission = self.metrics_aggregator.begin_submission
+        end_submission = self.metrics_aggregator.end_submission
+        receive_batch = self._receive_batch
+        uds_socket = self.uds_socket
+        tcp = self.tcp
+        select_select = select.select
+        select_error = select.error
+        timeout = UDP_SOCKET_TIMEOUT
+        should_forward = self.should_forward
+        forward_udp_sock = self.forward_udp_sock
+
+        self.running = True
+        messages = None
+        while self.running:
+            try:
+                ready = select_select(sockets if tcp is None else sockets + tcp.sockets, [], [], timeout)
+                for sock in ready[0]:
+                    if tcp is not None and tcp.owns(sock):
+                        messages = tcp.read(sock)
+                        if messages:
+                            begin_submission()
+                            try:
+                                aggregator_submit_batch([messages])
+                            finally:
+                                end_submission()
+                        continue
+                    messages = receive_batch(sock)
+                    if sock is uds_socket:
+                        self._sample_unix_backlog()
+                    if not messages:
+                        continue
+                    begin_submission()
+                    try:
+                        aggregator_submit_batch(messages)
+                        aggregator_submit_metric('stackstate.stsstatsd.packets_per_wakeup', len(messages), 'h')
+                    finally:
+                        end_submission()
+
+                    if should_forward:
+                        for message in messages:
+                            forward_udp_sock.send(message)
+            except select_error as se:
+                # Ignore interrupted system calls from sigterm.
+                errno_ = se[0]
+                if errno_ != 4:
+                    raise
+            except (KeyboardInterrupt, SystemExit):
+                break
+            except Exception:
+                log.exception('Error receiving datagrams `%s`', messages)
+
+    def _receive_batch(self, sock=None):
+        """
+        Read pending datagrams until the socket would block, `recv_batch_size`
+        datagrams have been read or `recv_batch_timeout` seconds have elapsed.
+        """
+        messages = []
+        sock = sock or self.socket
+        if sock is self.uds_socket:
+            socket_recv = partial(self._receive_unix, sock)
+        else:
+            socket_recv = partial(sock.recv, self.buffer_size)
+        batch_size = self.recv_batch_size
+        deadline = time() + self.recv_batch_timeout
+        while len(messages) < batch_size:
+            try:
+                message = socket_recv()
+            except socket.error as e:
+                if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if message is not None:
+                messages.append(message)
+            if time() > deadline:
+                break
+        return messages
+
+    def _receive_unix(self, sock):
+        """
+        Read a datagram from the unix socket. A datagram larger than the read
+        buffer would be truncated into an invalid packet: it is counted as
+        dropped and None is returned.
+        """
+        message = sock.recv(self.buffer_size + 1)
+        self.uds_packets += 1
+        if len(message) > self.buffer_size:
+            self.uds_dropped += 1
+            log.debug('Dropped a datagram larger than %s bytes on the unix socket', self.buffer_size)
+            return None
+        return message
+
+    def _sample_unix_backlog(self):
+        """
+        Record the bytes left in the receive queue of the unix socket after a
+        wakeup, non-zero when the server does not keep up with its clients.
+        """
+        pending = get_socket_pending_bytes(self.uds_socket)
+        if pending:
+            self.uds_backlog = max(self.uds_backlog, pending)
+
+    def _bind_unix_socket(self):
+        """
+        Bind a unix datagram socket on `socket_path`, replacing a stale socket
+        file left behind by a previous run.
+        """
+        if os.path.exists(self.socket_path):
+            if not stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                raise Exception('%s exists and is not a socket' % self.socket_path)
+            os.unlink(self.socket_path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if self.so_rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, int(self.so_rcvbuf))
+        sock.setblocking(0)
+        sock.bind(self.socket_path)
+        os.chmod(self.socket_path, self.socket_perms)
+        return sock
+
+    def _close_unix_socket(self):
+        try:
+            self.uds_socket.close()
+            os.unlink(self.socket_path)
+        except Exception:
+            log.debug('Unable to remove unix socket %s', self.socket_path, exc_info=True)
+        self.uds_socket = None
+
+    def socket_stats(self):
+        """
+        Return the socket-level internal metrics as `(name, value, metric_type)`
+        tuples. The counters are totals since the server started, the caller
+        reports their increase with `CounterDeltas`.
+
+        The kernel does not drop on unix datagram sockets: when the receive
+        queue is full, clients block or get EAGAIN, which the server cannot
+        see. The drops reported are the datagrams the server discarded because
+        they did not fit in its read buffer. The backlog is the largest number
+        of bytes the FIONREAD ioctl found still queued after a wakeup; Linux
+        only reports the head datagram of the queue, so it tells whether the
+        server keeps up rather than the depth of the queue.
+        """
+        stats = []
+        if self.uds_socket is not None:
+            stats.append(('stackstate.stsstatsd.uds.packets', self.uds_packets, 'c'))
+            stats.append(('stackstate.stsstatsd.uds.dropped', self.uds_dropped, 'c'))
+            stats.append(('stackstate.stsstatsd.uds.backlog', self.uds_backlog, 'g'))
+            # The largest backlog since the last call: a sample racing with
+            # the reset only lowers this gauge once
+            self.uds_backlog = 0
+        if self.tcp is not None:
+            stats.extend(self.tcp.stats())
+        return stats
+
+    def udp_stats(self):
+        """
+        Bytes in the receive queue of the UDP socket and datagrams dropped by
+        the kernel since it was bound, None where they are not available.
+        """
+        if self.socket_inode is None:
+            return None
+        return get_udp_socket_stats(inode=self.socket_inode)
+
+    def prefork(self):
+        # Runs in the reporting process, nothing to fork
+        pass
+
     def stop(self):
         self.running = False
 
 
+class ShardHandoff(threading.Thread):
+    """
+    Runs in a sharded worker: periodically hands the complete buckets of the
+    worker's aggregator over to the reporting process, and stops the worker's
+    server if the reporting process went away.
+    """
+
+    def __init__(self, interval, metrics_aggregator, shard_queue, server, parent_pid, index=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.index = index
+        self.interval = interval
+        self.finished = threading.Event()
+        self.metrics_aggregator = metrics_aggregator
+        self.shard_queue = shard_queue
+        self.server = server
+        self.parent_pid = parent_pid
+        self.socket_counters = CounterDeltas()
+
+    def stop(self):
+        self.finished.set()
+
+    def run(self):
+        while not self.finished.isSet():
+            self.finished.wait(self.interval)
+            if os.getppid() != self.parent_pid:
+                log.error("Reporting process %s is gone, stopping worker %s", self.parent_pid, os.getpid())
+                self.server.stop()
+                break
+            self.hand_off()
+
+    def hand_off(self):
+        tags = ['shard:%s' % self.index]
+        try:
+            self.metrics_aggregator.send_context_cache_stats('stackstate.stsstatsd.context_cache', tags=tags)
+            self.submit_socket_stats(tags)
+            handoff = self.metrics_aggregator.handoff()
+            if not (handoff['metric_by_bucket'] or handoff['events'] or handoff['service_checks'] or handoff['count']
+                    or handoff['rejected_by_name']):
+                return
+            self.shard_queue.put(handoff, timeout=self.interval)
+        except Full:
+            log.warning("Reporter is lagging behind, dropping a handoff of worker %s", os.getpid())
+        except Exception:
+            log.exception("Error handing metrics over to the reporter")
+
+    def submit_socket_stats(self, tags):
+        try:
+            for name, value, mtype in self.socket_counters.deltas(self.server.socket_stats()):
+                self.metrics_aggregator.submit_internal_metric(name, value, mtype, tags=tags)
+        except Exception:
+            log.exception("Error collecting socket stats")
+
+
+def run_shard(parent_pid, index, shard_queue, handoff_interval, aggregator_args, aggregator_kwargs, server_args,
+              server_kwargs):
+    """
+    Entry point of a sharded worker process: run a statsd server bound with
+    SO_REUSEPORT and feed the reporting process through `shard_queue`.
+    """
+    # The parent process handles interruptions and terminates its workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Don't block the exit of the worker on handoffs the reporter won't read
+    shard_queue.cancel_join_thread()
+
+    # Workers use the default formatter, the reporting aggregator re-formats
+    # everything it merges.
+    aggregator = MetricsBucketAggregator(*aggregator_args, formatter=api_formatter, **aggregator_kwargs)
+    server = Server(aggregator, *server_args, reuse_port=True, **server_kwargs)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+
+    handoff = ShardHandoff(handoff_interval, aggregator, shard_queue, server, parent_pid, index)
+    handoff.start()
+    try:
+        server.start()
+    finally:
+        handoff.stop()
+
+
+class ShardedServer(object):
+    """
+    Runs `workers` statsd servers in their own processes, all bound to the same
+    port with SO_REUSEPORT so that parsing scales past a single core. Every
+    worker aggregates into its own MetricsBucketAggregator and hands the result
+    over to the reporting process through `shard_queue`.
+
+    The workers are forked, and restarted, by a supervisor process forked by
+    `prefork` before the reporting process starts any thread: a child forked
+    while another thread holds a lock, of the logging module or of a
+    connection pool, deadlocks on it.
+    """
+
+    def __init__(self, workers, shard_queue, handoff_interval, aggregator_args, aggregator_kwargs,
+                 server_args, server_kwargs):
+        self.sockaddr = None
+        self.workers = int(workers)
+        self.shard_queue = shard_queue
+        self.handoff_interval = handoff_interval
+        self.aggregator_args = aggregator_args
+        self.aggregator_kwargs = aggregator_kwargs
+        self.server_args = server_args
+        self.server_kwargs = server_kwargs
+        self.processes = []
+        self.supervisor = None
+        self.running = False
+
+    def _spawn(self, index):
+        server_kwargs = self.server_kwargs
+        if index > 0:
+            # A unix socket can only be bound once, the first worker serves it
+            server_kwargs = dict(server_kwargs, socket_path=None)
+        process = multiprocessing.Process(
+            target=run_shard,
+            name='stsstatsd-worker-%s' % index,
+            args=(os.getpid(), index, self.shard_queue, self.handoff_interval, self.aggregator_args,
+                  self.aggregator_kwargs, self.server_args, server_kwargs)
+        )
+        process.daemon = True
+        process.start()
+        return process
+
+    def prefork(self):
+        """
+        Fork the supervisor of the workers, to be called before the reporting
+        process starts any thread.
+        """
+        if self.supervisor is not None:
+            return
+        # Not daemonic: daemonic processes can't fork the workers
+        self.supervisor = multiprocessing.Process(target=self._supervise, name='stsstatsd-supervisor',
+                                                  args=(os.getpid(),))
+        self.supervisor.start()
+
+    def _supervise(self, parent_pid):
+        """
+        Entry point of the supervisor process: spawn the workers and restart
+        them until stopped or until the reporting process is gone.
+        """
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        self.running = True
+        self.processes = [self._spawn(i) for i in xrange(self.workers)]
+        log.info('Started %s StsStatsD workers on port %s', self.workers, self.server_args[1])
+
+        try:
+            while self.running:
+                if os.getppid() != parent_pid:
+                    log.error("Reporting process %s is gone, stopping the StsStatsD workers", parent_pid)
+                    break
+                for i, process in enumerate(self.processes):
+                    if not process.is_alive() and self.running:
+                        log.error('StsStatsD worker %s exited with code %s, restarting it', process.pid, process.exitcode)
+                        self.processes[i] = self._spawn(i)
+                sleep(1)
+        finally:
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+            for process in self.processes:
+                process.join(SHARD_SHUTDOWN_TIMEOUT)
+
+    def start(self):
+        """
+        Run until stopped, or until the supervisor of the workers exits.
+        """
+        self.prefork()
+        self.running = True
+        try:
+            while self.running:
+                if not self.supervisor.is_alive():
+                    # Forking it again would fork a process running threads
+                    log.error('StsStatsD worker supervisor exited with code %s, stopping',
+                              self.supervisor.exitcode)
+                    break
+                sleep(1)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            if self.supervisor.is_alive():
+                self.supervisor.terminate()
+            self.supervisor.join(2 * SHARD_SHUTDOWN_TIMEOUT)
+
+    def stop(self):
+        self.running = False
+
+    def socket_stats(self):
+        # Every worker submits its own stats, tagged with its shard, through
+        # the merged aggregates, see `ShardHandoff.submit_socket_stats`
+        return []
+
+    def udp_stats(self):
+        # The sockets of the workers share the port
+        return get_udp_socket_stats(port=int(self.server_args[1]))
+
+
 class Dogstatsd(Daemon):
     """ This class is the dogstatsd daemon. """
 
@@ -467,6 +1454,10 @@ class Dogstatsd(Daemon):
         # Handle Keyboard Interrupt
         signal.signal(signal.SIGINT, self._handle_sigterm)
 
+        # Fork the processes of the server, if any, while this process runs
+        # a single thread
+        self.server.prefork()
+
         # Start the reporting thread before accepting data
         self.reporter.start()
 
@@ -585,8 +1576,24 @@ def init5(agent_config=None, use_watchdog=False, use_forwarder=False, args=None)
     forward_to_host = agent_config.get('statsd_forward_host')
     forward_to_port = agent_config.get('statsd_forward_port')
     event_chunk_size = agent_config.get('event_chunk_size')
+    max_payload_size = int(agent_config.get('statsd_max_payload_size') or DEFAULT_MAX_PAYLOAD_SIZE)
+    sender_threads = int(agent_config.get('statsd_sender_threads') or DEFAULT_SENDER_THREADS)
+    send_queue_size = int(agent_config.get('statsd_send_queue_size') or DEFAULT_SEND_QUEUE_SIZE)
     recent_point_threshold = agent_config.get('recent_point_threshold', None)
     so_rcvbuf = agent_config.get('statsd_so_rcvbuf', None)
+    recv_batch_size = agent_config.get('statsd_recv_batch_size', None)
+    recv_batch_timeout = agent_config.get('statsd_recv_batch_timeout', None)
+    workers = int(agent_config.get('statsd_workers') or 1)
+    max_contexts = int(agent_config.get('statsd_max_contexts') or 0)
+    max_contexts_per_metric = int(agent_config.get('statsd_max_contexts_per_metric') or 0)
+    context_overflow = agent_config.get('statsd_context_overflow') or 'fold'
+    context_cache_max_bytes = agent_config.get('statsd_context_cache_max_bytes')
+    if context_cache_max_bytes in (None, ''):
+        context_cache_max_bytes = DEFAULT_CONTEXT_CACHE_MAX_BYTES
+    socket_path = agent_config.get('dogstatsd_socket') or None
+    socket_perms = agent_config.get('dogstatsd_socket_perms') or None
+    tcp_port = int(agent_config.get('statsd_tcp_port') or 0) or None
+    tcp_max_connections = agent_config.get('statsd_tcp_max_connections') or None
     server_host = agent_config['bind_host']
 
     target = agent_config['dd_url']
@@ -600,18 +1607,38 @@ def init5(agent_config=None, use_watchdog=False, use_forwarder=False, args=None)
     # server and reporting threads.
     assert 0 < interval
 
+    aggregator_kwargs = dict(
+        recent_point_threshold=recent_point_threshold,
+        histogram_aggregates=agent_config.get('histogram_aggregates'),
+        histogram_percentiles=agent_config.get('histogram_percentiles'),
+        histogram_relative_accuracy=agent_config.get('histogram_sketch_relative_accuracy'),
+        set_cardinality_threshold=int(agent_config.get('statsd_set_cardinality_threshold') or 0),
+        set_hll_precision=int(agent_config.get('statsd_set_hll_precision') or DEFAULT_PRECISION),
+        max_contexts=max_contexts,
+        max_contexts_per_name=max_contexts_per_metric,
+        fold_overflow_contexts=context_overflow.strip() != 'drop',
+        context_guard_exempt_prefix='stackstate.stsstatsd.',
+        utf8_decoding=agent_config['utf8_decoding'],
+        context_cache_max_bytes=int(context_cache_max_bytes)
+    )
+    reporting_aggregator_kwargs = aggregator_kwargs
+    if workers > 1:
+        # Packets are parsed by the workers only
+        reporting_aggregator_kwargs = dict(aggregator_kwargs, context_cache_max_bytes=None)
+        # The contexts of the workers are merged by the reporting process:
+        # share the total budget between them.
+        if max_contexts:
+            aggregator_kwargs = dict(aggregator_kwargs, max_contexts=-(-max_contexts // workers))
     aggregator = MetricsBucketAggregator(
         hostname,
         aggregator_interval,
-        recent_point_threshold=recent_point_threshold,
         formatter=get_formatter(agent_config),
-        histogram_aggregates=agent_config.get('histogram_aggregates'),
-        histogram_percentiles=agent_config.get('histogram_percentiles'),
-        utf8_decoding=agent_config['utf8_decoding']
+        **reporting_aggregator_kwargs
     )
 
-    # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size)
+    shard_queue = None
+    if workers > 1:
+        shard_queue = multiprocessing.Queue(workers * SHARD_QUEUE_SIZE_PER_WORKER)
 
     # NOTICE: when `non_local_traffic` is passed we need to bind to any interface on the box. The forwarder uses
     # Tornado which takes care of sockets creation (more than one socket can be used at once depending on the
@@ -622,7 +1649,20 @@ def init5(agent_config=None, use_watchdog=False, use_forwarder=False, args=None)
     if non_local_traffic:
         server_host = '0.0.0.0'
 
-    server = Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port, so_rcvbuf=so_rcvbuf)
+    server_kwargs = dict(forward_to_host=forward_to_host, forward_to_port=forward_to_port, so_rcvbuf=so_rcvbuf,
+                         recv_batch_size=recv_batch_size, recv_batch_timeout=recv_batch_timeout,
+                         socket_path=socket_path, socket_perms=socket_perms, tcp_port=tcp_port,
+                         tcp_max_connections=tcp_max_connections)
+    if workers > 1:
+        server = ShardedServer(workers, shard_queue, interval, (hostname, aggregator_interval), aggregator_kwargs,
+                               (server_host, port), server_kwargs)
+    else:
+        server = Server(aggregator, server_host, port, **server_kwargs)
+
+    # Start the reporting thread.
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size,
+                        shard_queue=shard_queue, server=server, max_payload_size=max_payload_size,
+                        sender_threads=sender_threads, send_queue_size=send_queue_size)
 
     return reporter, server
 
@@ -2,6 +2,16 @@
 """
 Performance tests for the agent/dogstatsd metrics aggregator.
 """
+# stdlib
+import gc
+import resource
+import sys
+import time
+
+# 3p
+import mock
+
+# project
 from aggregator import MetricsAggregator, MetricsBucketAggregator
 
 
@@ -51,6 +61,61 @@ class TestAggregatorPerf(object):
                     ma.set('set.%s' % j, float(i))
             ma.flush()
 
+    def test_dogstatsd_context_memory(self):
+        """
+        Bytes per context of 500k contexts of each type, measured on the metric
+        objects and on the RSS of the process.
+        """
+        context_count = 500000
+        # Keep every aggregator so that each one is measured on fresh memory
+        aggregators = []
+        for metric_type in ['g', 'c', 'h', 's']:
+            ma = MetricsBucketAggregator('my.host')
+            aggregators.append(ma)
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            for i in xrange(context_count):
+                ma.submit_packets('metric:1|%s|#id:%s' % (metric_type, i))
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+            metrics = [metric for contexts in ma.generation.metric_by_bucket.itervalues()
+                       for metric in contexts.itervalues()]
+            object_size = sum(sys.getsizeof(metric) + sys.getsizeof(getattr(metric, '__dict__', None))
+                              for metric in metrics)
+            print "%s: %d bytes per metric object, %d bytes of RSS per context" % (
+                metric_type, object_size / context_count, (rss_after - rss_before) * 1024 / context_count)
+
+    def test_dogstatsd_flush_idle_counters(self):
+        """
+        Time of a flush with 1000 sampled counters, as the number of other
+        counter contexts grows: expired by a previous flush, due to expire in
+        this one, or idle and reporting zeros. Only the last ones are visited,
+        once per zero reported.
+        """
+        last_sample_offsets = [('expired', 400), ('expiring', 305), ('idle', 100)]
+        for idle_count in [0, 50000, 100000, 200000]:
+            for state, last_sample_offset in last_sample_offsets:
+                ma = MetricsBucketAggregator('my.host', interval=10, expiry_seconds=300)
+                now = time.time()
+                with mock.patch('aggregator.time', return_value=now - last_sample_offset):
+                    for i in xrange(idle_count):
+                        ma.submit_packets('idle:1|c|#id:%s' % i)
+                for flush_offset in [last_sample_offset - 10, 20]:
+                    with mock.patch('aggregator.time', return_value=now - flush_offset):
+                        ma.flush()
+                with mock.patch('aggregator.time', return_value=now - 10):
+                    for i in xrange(1000):
+                        ma.submit_packets('counter:1|c|#id:%s' % i)
+
+                # Leave out the garbage of the previous runs
+                metrics = None
+                gc.collect()
+                with mock.patch('aggregator.time', return_value=now):
+                    start = time.time()
+                    metrics = ma.flush()
+                    duration = time.time() - start
+                print "%s %s counters: %.1fms, %s metrics, %.2fus per metric" % (
+                    idle_count, state, duration * 1000, len(metrics), duration * 1000000 / len(metrics))
+
     def create_event_packet(self, title, text):
         p = "_e{{{title_len},{text_len}}}:{title}|{text}".format(
             title_len=len(title),
@@ -110,4 +175,6 @@ if __name__ == '__main__':
     t = TestAggregatorPerf()
     #t.test_dogstatsd_aggregation_perf()
     #t.test_checksd_aggregation_perf()
+    #t.test_dogstatsd_context_memory()
+    #t.test_dogstatsd_flush_idle_counters()
     t.test_dogstatsd_utf8_events()
@@ -0,0 +1,294 @@
+"""
+Load tests of a live stsstatsd: UDP traffic, recorded or synthetic, is sent
+at a target rate to a `Server` and its `Reporter` running in this process.
+
+    # Record the traffic sent to port 8125 for 60s
+    python -m tests.core.benchmark_stsstatsd record --port 8125 --duration 60 --file traffic.bin
+    # Replay it at 50k packets/s for 30s, or at its recorded pace without --rate
+    python -m tests.core.benchmark_stsstatsd replay --file traffic.bin --rate 50000 --duration 30
+    # Synthetic traffic over 100k contexts
+    python -m tests.core.benchmark_stsstatsd synthetic --contexts 100000 --rate 50000 --duration 30
+
+Reports the sustained packets per second, the drop rate (from the packets
+sent and received, and from the kernel counters on Linux), the flush latency
+percentiles and the RSS of the process.
+"""
+# stdlib
+import optparse
+import random
+import resource
+import socket
+import struct
+import sys
+import threading
+import time
+
+# 3p
+import mock
+
+# project
+from aggregator import MetricsBucketAggregator
+from checks.check_status import DogstatsdStatus
+from stsstatsd import Reporter, Server
+from utils.net import get_udp_socket_stats
+
+# Header of a recorded datagram: seconds since the start of the recording
+# and length of the datagram
+RECORD_HEADER = struct.Struct('!dI')
+RECV_BUFFER_SIZE = 8 * 1024
+# The sender checks the pace of the traffic every this many packets
+SEND_PACING_BATCH = 100
+
+
+def record(path, host, port, duration):
+    """
+    Write the datagrams received on `host`:`port` for `duration` seconds to
+    `path`, returns their count.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    sock.settimeout(0.5)
+    count = 0
+    start = time.time()
+    with open(path, 'wb') as f:
+        while time.time() - start < duration:
+            try:
+                datagram = sock.recv(RECV_BUFFER_SIZE)
+            except socket.timeout:
+                continue
+            f.write(RECORD_HEADER.pack(time.time() - start, len(datagram)))
+            f.write(datagram)
+            count += 1
+    sock.close()
+    return count
+
+
+def read_recording(path):
+    """
+    Yield the (offset, datagram) tuples of a recording.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            offset, length = RECORD_HEADER.unpack(header)
+            yield offset, f.read(length)
+
+
+def synthetic_packets(contexts, metric_types=('c', 'g', 'h', 's'), seed=42):
+    """
+    Return packets spread over `contexts` contexts, one metric type per
+    context, to be replayed in a loop.
+    """
+    rand = random.Random(seed)
+    packets = []
+    for i in xrange(contexts):
+        metric_type = metric_types[i % len(metric_types)]
+        packets.append('stsstatsd.bench.%s:%s|%s|#context:%s,env:bench' % (
+            metric_type, rand.randint(0, 1000), metric_type, i))
+    rand.shuffle(packets)
+    return packets
+
+
+def get_rss():
+    """
+    Current RSS of the process in bytes, its peak where /proc is not available.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+
+class LoadTest(object):
+    """
+    A live stsstatsd: a `Server` and a `Reporter` flushing every
+    `flush_interval` seconds, whose payloads are serialized but not posted.
+    Its status is not published either, not to clobber that of a stsstatsd
+    running on the same host.
+    """
+
+    def __init__(self, flush_interval=1, so_rcvbuf=None, recv_batch_size=None, **aggregator_kwargs):
+        self.aggregator = MetricsBucketAggregator('bench.host', interval=flush_interval, **aggregator_kwargs)
+        self.server = Server(self.aggregator, '127.0.0.1', 0, so_rcvbuf=so_rcvbuf, recv_batch_size=recv_batch_size)
+        self.reporter = Reporter(flush_interval, self.aggregator, 'http://localhost')
+        self.reporter.submit_http = lambda url, data, headers: None
+
+        self.received = 0
+        self.flush_latencies = []
+        self._count_datagrams()
+        self._time_flushes()
+        self._status_patches = [mock.patch.object(DogstatsdStatus, 'publish'),
+                                mock.patch.object(DogstatsdStatus, 'remove_latest_status')]
+
+    def _count_datagrams(self):
+        submit_packets = self.aggregator.submit_packets
+
+        def counting_submit_packets(packets):
+            self.received += 1
+            return submit_packets(packets)
+        self.aggregator.submit_packets = counting_submit_packets
+
+    def _time_flushes(self):
+        flush = self.reporter.flush
+
+        def timed_flush():
+            start = time.time()
+            flush()
+            self.flush_latencies.append(time.time() - start)
+        self.reporter.flush = timed_flush
+
+    def start(self):
+        for patch in self._status_patches:
+            patch.start()
+        self.server_thread = threading.Thread(target=self.server.start)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        while not self.server.running:
+            time.sleep(0.01)
+        self.port = self.server.socket.getsockname()[1]
+        self.reporter.start()
+
+    def stop(self):
+        self.server.stop()
+        self.server_thread.join()
+        self.reporter.stop()
+        self.reporter.join()
+        for patch in self._status_patches:
+            patch.stop()
+
+    def run(self, datagrams, duration, rate=None):
+        """
+        Send the (offset, datagram) tuples in a loop for `duration` seconds, at
+        `rate` packets per second or at the pace of their offsets, and return
+        the report of the run.
+        """
+        self.start()
+        kernel_before = get_udp_socket_stats(self.port)
+        rss_before = get_rss()
+        sent = self._send(datagrams, duration, rate)
+        # Let the server drain its socket
+        time.sleep(0.5)
+        kernel_after = get_udp_socket_stats(self.port)
+        self.stop()
+
+        report = {
+            'duration': duration,
+            'sent': sent,
+            'received': self.received,
+            'packets_per_second': self.received / float(duration),
+            'drop_rate': 1 - self.received / float(sent) if sent else 0.0,
+            'kernel_drops': kernel_after[1] - kernel_before[1] if kernel_before and kernel_after else None,
+            'flush_count': len(self.flush_latencies),
+            'rss': get_rss(),
+            'rss_growth': get_rss() - rss_before,
+        }
+        for p in [0.5, 0.95, 0.99]:
+            report['flush_p%s' % int(p * 100)] = percentile(self.flush_latencies, p)
+        return report
+
+    def _send(self, datagrams, duration, rate):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        address = ('127.0.0.1', self.port)
+        sent = 0
+        start = time.time()
+        loop_start = start
+        while True:
+            for offset, datagram in datagrams:
+                if sent % SEND_PACING_BATCH == 0:
+                    now = time.time()
+                    if now - start >= duration:
+                        return sent
+                    # Wait until the packet is due
+                    due = start + sent / float(rate) if rate else loop_start + offset
+                    if due > now:
+                        time.sleep(due - now)
+                try:
+                    sock.sendto(datagram, address)
+                    sent += 1
+                except socket.error:
+                    # Full socket buffer of the sender, which may not drain
+                    if time.time() - start >= duration:
+                        return sent
+            loop_start = time.time()
+
+
+def format_report(report):
+    def ms(seconds):
+        return '%.1fms' % (seconds * 1000) if seconds is not None else 'n/a'
+    lines = [
+        'sent %(sent)s packets in %(duration)ss, received %(received)s' % report,
+        'sustained %.0f packets/s, %.2f%% dropped, kernel drops: %s' % (
+            report['packets_per_second'], report['drop_rate'] * 100,
+            report['kernel_drops'] if report['kernel_drops'] is not None else 'n/a'),
+        '%s flushes: p50 %s, p95 %s, p99 %s' % (
+            report['flush_count'], ms(report['flush_p50']), ms(report['flush_p95']), ms(report['flush_p99'])),
+        'RSS %.1fMB (+%.1fMB)' % (report['rss'] / 1048576.0, report['rss_growth'] / 1048576.0),
+    ]
+    return '\n'.join(lines)
+
+
+class TestStsstatsdLoad(object):
+
+    DURATION = 5
+    RATE = 20000
+
+    def test_synthetic_load(self):
+        for contexts in [1000, 100000]:
+            datagrams = [(0, packet) for packet in synthetic_packets(contexts)]
+            report = LoadTest().run(datagrams, self.DURATION, self.RATE)
+            print '%s contexts:\n%s' % (contexts, format_report(report))
+
+    def test_batched_receive_load(self):
+        datagrams = [(0, packet) for packet in synthetic_packets(10000)]
+        report = LoadTest(recv_batch_size=64).run(datagrams, self.DURATION, self.RATE)
+        print format_report(report)
+
+
+def main(args):
+    parser = optparse.OptionParser(usage="%prog record|replay|synthetic [options]")
+    parser.add_option('--file', help="recording to write or to replay")
+    parser.add_option('--host', default='127.0.0.1', help="address to record the traffic on")
+    parser.add_option('--port', type='int', default=8125, help="port to record the traffic on")
+    parser.add_option('--duration', type='float', default=30, help="in seconds")
+    parser.add_option('--rate', type='float', help="packets per second, as fast as possible with 0")
+    parser.add_option('--contexts', type='int', default=10000, help="contexts of the synthetic traffic")
+    parser.add_option('--types', default='c,g,h,s', help="metric types of the synthetic traffic")
+    parser.add_option('--recv-batch-size', type='int', help="statsd_recv_batch_size of the server")
+    parser.add_option('--so-rcvbuf', type='int', help="statsd_so_rcvbuf of the server")
+    options, args = parser.parse_args(args)
+    if len(args) != 1 or args[0] not in ('record', 'replay', 'synthetic'):
+        parser.error("expected a single command: record, replay or synthetic")
+    command = args[0]
+    if command in ('record', 'replay') and not options.file:
+        parser.error("%s needs a --file" % command)
+
+    if command == 'record':
+        count = record(options.file, options.host, options.port, options.duration)
+        print 'recorded %s datagrams to %s' % (count, options.file)
+        return
+
+    if command == 'replay':
+        datagrams = list(read_recording(options.file))
+    else:
+        datagrams = [(0, packet) for packet in synthetic_packets(options.contexts, options.types.split(','))]
+        if options.rate is None:
+            options.rate = 0
+    load_test = LoadTest(so_rcvbuf=options.so_rcvbuf, recv_batch_size=options.recv_batch_size)
+    print format_report(load_test.run(datagrams, options.duration, options.rate))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,53 @@
+"""
+Performance tests for the forwarder transaction queue.
+"""
+# stdlib
+from datetime import datetime, timedelta
+import random
+import time
+
+# project
+from transaction import Transaction, TransactionManager
+
+
+class WaitingTransaction(Transaction):
+    """
+    A transaction waiting for its replay after an intake error.
+    """
+    def __init__(self, size, replay_in):
+        Transaction.__init__(self)
+        self._size = size
+        self._endpoint = 'https://example.com'
+        self._next_flush = datetime.utcnow() + timedelta(seconds=replay_in)
+
+
+class TestTransactionManagerPerf(object):
+
+    QUEUED_TRANSACTIONS = 100000
+    TRANSACTION_SIZE = 300
+
+    def test_backlog_perf(self):
+        manager = TransactionManager(timedelta(seconds=90), self.QUEUED_TRANSACTIONS * self.TRANSACTION_SIZE,
+                                     timedelta(seconds=0))
+        rand = random.Random(42)
+
+        start = time.time()
+        for _ in xrange(self.QUEUED_TRANSACTIONS):
+            manager.append(WaitingTransaction(self.TRANSACTION_SIZE, rand.randint(60, 120)))
+        print 'append %s transactions: %.2fs' % (self.QUEUED_TRANSACTIONS, time.time() - start)
+
+        start = time.time()
+        for _ in xrange(1000):
+            manager.flush()
+        print '1000 flushes without due transactions: %.3fs' % (time.time() - start)
+
+        start = time.time()
+        for _ in xrange(10000):
+            manager.append(WaitingTransaction(self.TRANSACTION_SIZE, rand.randint(60, 120)))
+        print 'append 10000 transactions to a full queue: %.2fs' % (time.time() - start)
+        assert manager._total_count == self.QUEUED_TRANSACTIONS
+
+        start = time.time()
+        for tr in rand.sample(manager.get_transactions(), 10000):
+            manager._remove(tr)
+        print 'remove 10000 transactions: %.2fs' % (time.time() - start)
@@ -10,7 +10,14 @@ import nose.tools as nt
 
 
 # project
-from aggregator import DEFAULT_HISTOGRAM_AGGREGATES, get_formatter, MetricsAggregator
+from aggregator import (
+    CONTEXT_CACHE_ENTRY_OVERHEAD,
+    ContextCache,
+    DEFAULT_HISTOGRAM_AGGREGATES,
+    get_formatter,
+    MetricsAggregator,
+    Set,
+)
 
 
 class TestMetricsAggregator(unittest.TestCase):
@@ -167,7 +174,7 @@ class TestMetricsAggregator(unittest.TestCase):
         import stsstatsd
         from aggregator import api_formatter
 
-        serialized = stsstatsd.serialize_metrics([api_formatter("foo", 12, 1, ('tag',), 'host')], "test-host")
+        serialized = next(stsstatsd.serialize_metrics([api_formatter("foo", 12, 1, ('tag',), 'host')], "test-host"))
         assert '"tags": ["tag"]' in serialized[0]
 
     def test_counter(self):
@@ -464,6 +471,20 @@ class TestMetricsAggregator(unittest.TestCase):
         assert counter['points'][0][1] == 2
         assert gauge['points'][0][1] == 1
 
+    def test_datagram_batch_submission(self):
+        stats = MetricsAggregator('myhost')
+        stats.submit_packets_batch([
+            'counter:1|c',
+            'missing.type:2',
+            'counter:1|c\ngauge:1|g',
+        ])
+
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal(2, len(metrics))
+        counter, gauge = metrics
+        assert counter['points'][0][1] == 2
+        assert gauge['points'][0][1] == 1
+
     def test_monokey_batching_notags(self):
         # The min is not enabled by default
         stats = MetricsAggregator(
@@ -908,3 +929,108 @@ class TestMetricsAggregator(unittest.TestCase):
 
         nt.assert_equals(third['metric'], 'line_ending.windows')
         nt.assert_equals(third['points'][0][1], 300)
+
+    def test_context_cache(self):
+        packets = [
+            'cache.counter:1|c',
+            'cache.counter:2|c|#b:2,a:1',
+            'cache.counter:3|c|@0.5|#a:1,b:2',
+            'cache.counter:4|c|#host:other,a:1',
+            'cache.gauge:1.5|g|#device:sda',
+            'cache.histogram:5|h|#a:1',
+            'cache.set:user:1|s',
+            'cache.set:user2|s',
+            'cache.multi:1|c:2|g',
+            'cache.tag:1|c|#url:http://host:80',
+        ]
+        cached = MetricsAggregator('myhost', context_cache_max_bytes=1024 * 1024)
+        uncached = MetricsAggregator('myhost')
+        for _ in xrange(3):
+            for packet in packets:
+                try:
+                    cached.submit_packets(packet)
+                except Exception:
+                    pass
+                try:
+                    uncached.submit_packets(packet)
+                except Exception:
+                    pass
+
+        # Repeated lines skip the parsing but are aggregated the same way
+        def values(metrics):
+            return [(m['metric'], m['host'], m['device_name'], m['tags'], m['points'][0][1])
+                    for m in self.sort_metrics(metrics)]
+        nt.assert_equal(values(cached.flush()), values(uncached.flush()))
+        nt.assert_equal(cached.total_count, uncached.total_count)
+        nt.assert_true(cached.context_cache.hits > 0)
+
+        # Values are still validated on a cache hit
+        self.assertRaises(Exception, cached.submit_packets, 'cache.counter:abc|c')
+
+    def test_context_cache_eviction(self):
+        cache = ContextCache(4 * (CONTEXT_CACHE_ENTRY_OVERHEAD + 1))
+        cache.set('a', 1)
+        nt.assert_equal(cache.get('a'), 1)
+        nt.assert_equal(cache.get('b'), None)
+
+        # Filling half of the budget moves the entries to the old generation
+        cache.set('b', 2)
+        nt.assert_equal(len(cache.hot), 0)
+        nt.assert_equal(len(cache), 2)
+        # A hit promotes the entry
+        nt.assert_equal(cache.get('a'), 1)
+        nt.assert_equal(cache.hot, {'a': 1})
+        cache.set('c', 3)
+        nt.assert_equal(cache.evictions, 1)
+        nt.assert_equal(cache.get('b'), None)
+        nt.assert_equal(cache.get('c'), 3)
+
+        nt.assert_equal(cache.hits, 3)
+        nt.assert_equal(cache.misses, 2)
+        nt.assert_equal(cache.size, len(cache) * (CONTEXT_CACHE_ENTRY_OVERHEAD + 1))
+
+    def test_set_cardinality_threshold(self):
+        stats = MetricsAggregator('myhost', set_cardinality_threshold=100, set_hll_precision=12)
+
+        for i in xrange(50):
+            stats.submit_packets('small.set:%s|s' % i)
+        for i in xrange(5000):
+            stats.submit_packets('large.set:%s|s' % i)
+            stats.submit_packets('large.set:%s|s' % i)
+
+        small, large = [stats.metrics[(name, (), 'myhost', None)] for name in ('small.set', 'large.set')]
+        nt.assert_equal(small.hll, None)
+        nt.assert_equal(large.values, set())
+        nt.assert_equal(len(large.hll.registers), 4096)
+
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        nt.assert_equal(metrics['small.set'], 50)
+        self.assert_almost_equal(metrics['large.set'], 5000, 5000 * 0.05)
+
+        # The exact count is used again after a flush
+        stats.submit_packets('large.set:a|s')
+        nt.assert_equal(large.hll, None)
+        nt.assert_equal(stats.flush()[0]['points'][0][1], 1)
+
+    def test_set_merge(self):
+        extra_config = {'cardinality_threshold': 10, 'precision': 14}
+        sets = [Set(None, 'my.set', None, 'myhost', None, extra_config) for _ in xrange(3)]
+        for i, metric in enumerate(sets):
+            for value in xrange(i * 5, i * 5 + (15 if i == 1 else 5)):
+                metric.sample(value, 1)
+        exact, approximate, other_exact = sets
+        nt.assert_true(approximate.hll is not None)
+
+        # Merging a counter switches to a counter
+        exact.merge(approximate)
+        nt.assert_equal(exact.values, set())
+        exact.merge(other_exact)
+        nt.assert_equal(exact.hll.count(), 20)
+
+        # Merging exact values over the threshold switches to a counter
+        other_exact.merge(Set(None, 'my.set', None, 'myhost', None, extra_config))
+        nt.assert_equal(other_exact.hll, None)
+        for value in xrange(20):
+            other_exact.values.add(value)
+        other_exact.merge(other_exact)
+        nt.assert_equal(other_exact.hll.count(), 20)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 # stdlib
+import cPickle as pickle
 import random
+import threading
 import time
 import unittest
 
@@ -9,8 +11,9 @@ from nose.plugins.attrib import attr
 import nose.tools as nt
 
 # project
-from aggregator import DEFAULT_HISTOGRAM_AGGREGATES
+from aggregator import DEFAULT_HISTOGRAM_AGGREGATES, ExpiryWheel
 from stsstatsd import MetricsBucketAggregator
+from utils.sketch import QuantileSketch
 
 @attr(requires='core_integration')
 class TestUnitMetricsBucketAggregator(unittest.TestCase):
@@ -124,7 +127,7 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         import stsstatsd
         from aggregator import api_formatter
 
-        serialized = stsstatsd.serialize_metrics([api_formatter("foo", 12, 1, ('tag',), 'host')], "test-host")
+        serialized = next(stsstatsd.serialize_metrics([api_formatter("foo", 12, 1, ('tag',), 'host')], "test-host"))
         self.assertTrue('"tags": ["tag"]' in serialized[0], serialized)
 
     def test_counter(self):
@@ -603,6 +606,38 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         for p in [p95, pavg, pmed, pmax, pmin]:
             nt.assert_equal(p['points'][0][1], 5)
 
+    def test_distribution(self):
+        ag_interval = self.interval
+        reporting = MetricsBucketAggregator('myhost', interval=ag_interval)
+        workers = [MetricsBucketAggregator('myhost', interval=ag_interval) for _ in xrange(2)]
+
+        self.wait_for_bucket_boundary(ag_interval)
+        for i, worker in enumerate(workers):
+            for value in xrange(i * 50 + 1, (i + 1) * 50 + 1):
+                worker.submit_packets('my.dist:%s|d|#env:test' % value)
+        workers[0].submit_packets('my.dist:1000|d|@0.5|#env:test')
+
+        self.sleep_for_interval_length(ag_interval)
+        for worker in workers:
+            reporting.merge_handoff(worker.handoff())
+        metrics = reporting.flush()
+
+        # A single sketch of all the samples, not per-host aggregates
+        nt.assert_equal(len(metrics), 1)
+        dist = metrics[0]
+        nt.assert_equal(dist['metric'], 'my.dist')
+        nt.assert_equal(dist['type'], 'distribution')
+        nt.assert_equal(dist['tags'], ('env:test',))
+        sketch = QuantileSketch.from_dict(dist['points'][0][1])
+        nt.assert_equal(sketch.count, 102)
+        nt.assert_equal(sketch.sum, 5050 + 2000)
+        nt.assert_equal(sketch.max, 1000)
+        self.assert_almost_equal(sketch.quantile(0.5), 51, 1)
+
+        # Distributions are reset
+        self.sleep_for_interval_length(ag_interval)
+        assert not reporting.flush()
+
     def test_histogram_buckets(self):
         ag_interval = 1
         # The min is not enabled by default
@@ -839,6 +874,23 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         nt.assert_equal(metrics[0]['points'][0][1], 123)
 
 
+    def test_idle_counters(self):
+        ag_interval = self.interval
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval)
+        stats.submit_packets('my.idle:1|c')
+        stats.submit_packets('my.busy:1|c')
+        self.sleep_for_interval_length(ag_interval)
+        nt.assert_equal(len(stats.flush()), 2)
+        idle_contexts = set([('my.idle', (), 'myhost', None), ('my.busy', (), 'myhost', None)])
+        nt.assert_equal(stats.idle_counters, idle_contexts)
+
+        stats.submit_packets('my.busy:2|c')
+        self.sleep_for_interval_length(ag_interval)
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics], [('my.busy', 2), ('my.idle', 0)])
+        # Sampled counters are idle again once their bucket is flushed
+        nt.assert_equal(stats.idle_counters, idle_contexts)
+
     def test_diagnostic_stats(self):
         stats = MetricsBucketAggregator('myhost', interval=self.interval)
         for i in xrange(10):
@@ -1035,6 +1087,200 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         nt.assert_equal(h1['points'][0][0], h4['points'][0][0])
         nt.assert_equal(h1['points'][0][0], h5['points'][0][0])
 
+    def test_merge_handoff(self):
+        ag_interval = self.interval
+        reporting = MetricsBucketAggregator('myhost', interval=ag_interval)
+        workers = [MetricsBucketAggregator('myhost', interval=ag_interval) for _ in xrange(2)]
+
+        self.wait_for_bucket_boundary(ag_interval)
+        for i, worker in enumerate(workers):
+            worker.submit_packets('my.counter:%s|c' % (i + 1))
+            worker.submit_packets('my.gauge:%s|g' % (i + 1))
+            worker.submit_packets('my.histogram:%s|h' % (i + 1))
+            worker.submit_packets('my.histogram:%s|h' % (i + 3))
+            worker.submit_packets('my.set:%s|s' % i)
+            worker.submit_packets('my.set:common|s')
+            worker.submit_packets('_e{5,4}:title|text')
+
+        # Metrics are not handed over before their bucket is complete
+        handoff = workers[0].handoff()
+        nt.assert_equal(handoff['metric_by_bucket'], {})
+        reporting.merge_handoff(handoff)
+
+        self.sleep_for_interval_length(ag_interval)
+        for worker in workers:
+            # Handoffs go through a multiprocessing queue
+            reporting.merge_handoff(pickle.loads(pickle.dumps(worker.handoff(), pickle.HIGHEST_PROTOCOL)))
+            nt.assert_equal(worker.retired.metric_by_bucket, {})
+
+        metrics = self.sort_metrics(reporting.flush())
+        values = dict((m['metric'], m['points'][0][1]) for m in metrics)
+        nt.assert_equal(values['my.counter'], 3)
+        # Last write wins
+        nt.assert_equal(values['my.gauge'], 2)
+        nt.assert_equal(values['my.histogram.count'], 4)
+        nt.assert_equal(values['my.histogram.max'], 4)
+        nt.assert_equal(values['my.histogram.avg'], 2.5)
+        nt.assert_equal(values['my.set'], 3)
+        nt.assert_equal(len(reporting.flush_events()), 2)
+        nt.assert_equal(reporting.total_count, 14)
+
+    def test_flush_waits_for_submission_in_flight(self):
+        ag_interval = self.interval
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval)
+        stats.submit_packets('my.counter:1|c')
+        self.sleep_for_interval_length(ag_interval)
+
+        flushed = []
+        stats.begin_submission()
+        flusher = threading.Thread(target=lambda: flushed.extend(stats.flush()))
+        flusher.start()
+        flusher.join(0.1)
+        # The flusher swapped generations but waits for the submission to be over
+        nt.assert_true(flusher.is_alive())
+        stats.submit_packets('my.counter:2|c')
+        stats.end_submission()
+        flusher.join(1)
+
+        nt.assert_false(flusher.is_alive())
+        nt.assert_equal(len(flushed), 1)
+        nt.assert_equal(flushed[0]['points'][0][1], 1)
+
+        # The sample written during the flush is reported with the next one
+        self.sleep_for_interval_length(ag_interval)
+        metrics = stats.flush()
+        nt.assert_equal(sum(m['points'][0][1] for m in metrics), 2)
+        nt.assert_equal(stats.total_count, 2)
+
+    def test_submission_keeps_its_generation(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        generation = stats.generation
+        parse_sc_packet = stats.parse_sc_packet
+
+        def swap(packet):
+            # The flusher retires the generation in the middle of the submission
+            stats.generation = stats.generation_class()
+            return parse_sc_packet(packet)
+        stats.parse_sc_packet = swap
+
+        stats.begin_submission()
+        stats.submit_packets('_e{5,4}:title|text\n_sc|check|0\nmy.counter:1|c')
+        stats.end_submission()
+
+        nt.assert_equal((len(generation.events), generation.event_count), (1, 1))
+        nt.assert_equal((len(generation.service_checks), generation.service_check_count), (1, 1))
+        nt.assert_equal(generation.count, 1)
+        nt.assert_equal(len(generation.metric_by_bucket), 1)
+        nt.assert_true(stats.generation.is_empty())
+
+    def test_internal_metrics(self):
+        ag_interval = self.interval
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval)
+        stats.begin_submission()
+        stats.submit_packets('my.counter:1|c')
+        stats.submit_internal_metric('my.internal', 3, 'g', tags=['shard:1'])
+        stats.end_submission()
+
+        # The receive path keeps its generation to itself
+        nt.assert_equal([context[0] for mbc in stats.generation.metric_by_bucket.itervalues() for context in mbc],
+                        ['my.counter'])
+        self.sleep_for_interval_length(ag_interval)
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics], [('my.counter', 1), ('my.internal', 3)])
+        nt.assert_equal(metrics[1]['tags'], ['shard:1'])
+
+    def test_concurrent_flush(self):
+        ag_interval = self.interval
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval)
+        submissions = 20000
+
+        def receive():
+            for _ in xrange(submissions):
+                stats.begin_submission()
+                try:
+                    stats.submit_packets('my.counter:1|c\n_e{5,4}:title|text')
+                finally:
+                    stats.end_submission()
+
+        receiver = threading.Thread(target=receive)
+        receiver.start()
+        metrics = []
+        events = []
+        internal_submissions = 0
+        while receiver.is_alive():
+            # Internal metrics are submitted by the flushing thread
+            stats.submit_internal_metric('my.internal', 1, 'c')
+            internal_submissions += 1
+            metrics += stats.flush()
+            events += stats.flush_events()
+            time.sleep(0.01)
+        receiver.join()
+        self.sleep_for_interval_length(ag_interval)
+        metrics += stats.flush()
+        events += stats.flush_events()
+
+        # Every sample is flushed exactly once
+        nt.assert_equal(sum(m['points'][0][1] for m in metrics if m['metric'] == 'my.counter'), submissions)
+        nt.assert_equal(sum(m['points'][0][1] for m in metrics if m['metric'] == 'my.internal'),
+                        internal_submissions)
+        nt.assert_equal(len(events), submissions)
+        nt.assert_equal(stats.total_count, 2 * submissions)
+
+    def test_context_guard(self):
+        ag_interval = self.interval
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval, max_contexts=5, max_contexts_per_name=3,
+                                        context_guard_exempt_prefix='internal.')
+        self.wait_for_bucket_boundary(ag_interval)
+        # Exempt contexts do not use up the budgets
+        stats.submit_metric('internal.metric', 1, 'c')
+        for i in xrange(10):
+            stats.submit_packets('requests:1|c|#request_id:%s' % i)
+        stats.submit_packets('requests:1|c|#request_id:0')
+        stats.submit_packets('latency:1|c|#region:a')
+        stats.submit_packets('latency:1|c|#region:b')
+        stats.submit_packets('latency:1|c|#region:c')
+        nt.assert_equal(len(stats.generation.admitted_contexts), 5)
+
+        self.sleep_for_interval_length(ag_interval)
+        metrics = self.sort_metrics(stats.flush())
+        contexts = [(m['metric'], m['tags'], m['points'][0][1]) for m in metrics]
+        nt.assert_equal(contexts, [
+            ('internal.metric', None, 1),
+            ('latency', ('region:a',), 1),
+            ('latency', ('region:b',), 1),
+            # Over the global budget
+            ('latency', ('stackstate.overflow:true',), 1),
+            ('requests', ('request_id:0',), 2),
+            ('requests', ('request_id:1',), 1),
+            ('requests', ('request_id:2',), 1),
+            # Over the budget of the metric name
+            ('requests', ('stackstate.overflow:true',), 7),
+        ])
+        nt.assert_equal(stats.flush_rejected_contexts(), {'requests': 7, 'latency': 1})
+        nt.assert_equal(stats.flush_rejected_contexts(), {})
+
+        # Budgets apply to every flush interval
+        stats.submit_packets('requests:1|c|#request_id:10')
+        nt.assert_equal(stats.generation.admitted_contexts, set([('requests', ('request_id:10',), 'myhost', None)]))
+
+    def test_context_guard_drop(self):
+        ag_interval = self.interval
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval, max_contexts_per_name=1,
+                                        fold_overflow_contexts=False)
+        self.wait_for_bucket_boundary(ag_interval)
+        stats.submit_packets('requests:1|c|#request_id:1')
+        stats.submit_packets('requests:1|c|#request_id:2')
+        handoff = stats.handoff()
+
+        self.sleep_for_interval_length(ag_interval)
+        reporting = MetricsBucketAggregator('myhost', interval=ag_interval)
+        reporting.merge_handoff(handoff)
+        reporting.merge_handoff(stats.handoff())
+        metrics = reporting.flush()
+        nt.assert_equal([(m['metric'], m['tags']) for m in metrics], [('requests', ('request_id:1',))])
+        # Rejections are handed over with the metrics
+        nt.assert_equal(reporting.flush_rejected_contexts(), {'requests': 1})
+
     def test_calculate_bucket_start(self):
         stats = MetricsBucketAggregator('myhost', interval=10)
         nt.assert_equal(stats.calculate_bucket_start(13284283), 13284280)
@@ -1042,3 +1288,23 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         stats = MetricsBucketAggregator('myhost', interval=5)
         nt.assert_equal(stats.calculate_bucket_start(13284287), 13284285)
         nt.assert_equal(stats.calculate_bucket_start(13284280), 13284280)
+
+
+class TestExpiryWheel(unittest.TestCase):
+    def test_expire(self):
+        wheel = ExpiryWheel(10)
+        wheel.touch('a', 100)
+        wheel.touch('b', 105)
+        wheel.touch('c', 112)
+        wheel.touch('d', 125)
+        # Contexts move to the slot of their last sample
+        wheel.touch('a', 131)
+        wheel.discard('d')
+        nt.assert_equal(sorted(wheel), ['a', 'b', 'c'])
+        nt.assert_equal(sorted(wheel.contexts_by_slot), [10, 11, 13])
+
+        nt.assert_equal(wheel.expire(112), ['b'])
+        nt.assert_equal(wheel.expire(120), ['c'])
+        nt.assert_equal(list(wheel), ['a'])
+        nt.assert_equal(wheel.contexts_by_slot, {13: set(['a'])})
+        nt.assert_equal(wheel.expire(131), [])
@@ -1,4 +1,12 @@
+# stdlib
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import time
+
 # 3p
+import mock
 from nose.plugins.attrib import attr
 import nose.tools as nt
 
@@ -11,6 +19,7 @@ from checks.check_status import (
     STATUS_ERROR,
     STATUS_WARNING,
     STATUS_OK,
+    StatusPublisher,
 )
 
 
@@ -91,3 +100,48 @@ def test_persistence_fail():
 
     status = CollectorStatus.load_latest_status()
     assert not status
+
+
+def test_status_publisher():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'CollectorStatus.pickle')
+        publisher = StatusPublisher(interval=60)
+        publisher.publish(CollectorStatus(metadata=[0]), path)
+        for _ in xrange(100):
+            if publisher.written:
+                break
+            time.sleep(0.01)
+        nt.assert_equal(publisher.written, 1)
+
+        # Written at most once per interval, the latest status wins
+        publisher.publish(CollectorStatus(metadata=[1]), path)
+        publisher.publish(CollectorStatus(metadata=[2]), path)
+        time.sleep(0.1)
+        nt.assert_equal(publisher.written, 1)
+        nt.assert_equal(publisher.coalesced, 1)
+        publisher.flush()
+        nt.assert_equal(publisher.written, 2)
+        with open(path, 'rb') as f:
+            nt.assert_equal(pickle.load(f).host_metadata, [2])
+        # No temporary file left behind
+        nt.assert_equal(os.listdir(tmpdir), ['CollectorStatus.pickle'])
+        nt.assert_equal(os.stat(path).st_mode & 0777, 0644)
+
+        publisher.publish(CollectorStatus(metadata=[3]), path)
+        publisher.discard(path)
+        publisher.flush()
+        nt.assert_equal(publisher.written, 2)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_status_publisher_fork():
+    publisher = StatusPublisher.get()
+    nt.assert_true(StatusPublisher.get() is publisher)
+    with mock.patch('os.getpid', return_value=publisher.pid + 1):
+        forked = StatusPublisher.get()
+        nt.assert_true(forked is not publisher)
+        nt.assert_true(forked._write_lock is not publisher._write_lock)
+        nt.assert_true(StatusPublisher.get() is forked)
+    StatusPublisher._instance = publisher
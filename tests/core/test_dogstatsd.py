@@ -1,23 +1,44 @@
 # stdlib
 from unittest import TestCase
 import os
+import random
+import select
+import shutil
 import socket
+import stat
+import tempfile
 import threading
+import time
 import Queue
+import zlib
 from collections import defaultdict
 
 # 3p
 import mock
+import requests
+import simplejson as json
 import unittest
 
 # project
 from stsstatsd import mapto_v6, get_socket_address
+from aggregator import api_formatter, MetricsBucketAggregator
+from checks.check_status import DogstatsdStatus
+from checks.metric_types import MetricTypes
 from stsstatsd import (
+    CounterDeltas,
+    Dogstatsd,
+    PayloadSender,
+    Reporter,
     Server,
+    ShardHandoff,
+    TCP_MAX_LINE_LENGTH,
+    TcpListener,
     init5,
-    init6
+    init6,
+    serialize_metrics,
 )
 from utils.net import IPV6_V6ONLY, IPPROTO_IPV6
+from utils.sketch import QuantileSketch
 
 
 class TestFunctions(TestCase):
@@ -49,6 +70,39 @@ class TestFunctions(TestCase):
         args, _ = s.call_args
         self.assertEqual(args[1], '0.0.0.0')
 
+    @mock.patch('stsstatsd.Server')
+    @mock.patch('stsstatsd.ShardedServer')
+    def test_init_with_workers(self, sharded, s):
+        cfg = defaultdict(str)
+        cfg['use_dogstatsd'] = True
+        cfg['statsd_workers'] = '4'
+        cfg['statsd_max_contexts'] = '1001'
+        cfg['statsd_max_contexts_per_metric'] = '100'
+
+        reporter, _ = init5(cfg)
+
+        self.assertFalse(s.called)
+        sharded.assert_called_once()
+        args, _ = sharded.call_args
+        self.assertEqual(args[0], 4)
+        # The reporter merges what the workers hand over
+        self.assertIs(reporter.shard_queue, args[1])
+        # Only the workers parse packets
+        self.assertIsNone(reporter.metrics_aggregator.context_cache)
+        self.assertTrue(args[4]['context_cache_max_bytes'])
+        # The total context budget is shared by the workers
+        self.assertEqual(args[4]['max_contexts'], 251)
+        self.assertEqual(args[4]['max_contexts_per_name'], 100)
+
+    def test_prefork_before_threads(self):
+        calls = mock.Mock()
+        daemon = Dogstatsd(os.path.join(tempfile.gettempdir(), 'stsstatsd-test.pid'), calls.server, calls.reporter,
+                           autorestart=False)
+        daemon.run()
+        # The server processes are forked before the reporter thread starts
+        names = [name for name, _, _ in calls.mock_calls]
+        self.assertEqual(names[:3], ['server.prefork', 'reporter.start', 'server.start'])
+
     @mock.patch('stsstatsd.get_config_path')
     def test_init6(self, gcp):
         cfg = defaultdict(str)
@@ -76,6 +130,483 @@ class TestFunctions(TestCase):
         self.assertEqual(kwargs['so_rcvbuf'], '1024')
 
 
+class TestBatchedReceive(TestCase):
+    def setUp(self):
+        self.sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.setblocking(0)
+        self.server = Server(mock.MagicMock(), 'localhost', '1234', recv_batch_size=3)
+        self.server.socket = receiver
+
+    def tearDown(self):
+        self.sender.close()
+        self.server.socket.close()
+
+    def test_receive_batch(self):
+        for i in xrange(5):
+            self.sender.send('metric:%s|c' % i)
+
+        self.assertEqual(self.server._receive_batch(), ['metric:0|c', 'metric:1|c', 'metric:2|c'])
+        self.assertEqual(self.server._receive_batch(), ['metric:3|c', 'metric:4|c'])
+        self.assertEqual(self.server._receive_batch(), [])
+
+    def test_receive_batch_time_budget(self):
+        self.server.recv_batch_timeout = -1
+        for i in xrange(3):
+            self.sender.send('metric:%s|c' % i)
+
+        # The budget is exhausted after the first datagram
+        self.assertEqual(self.server._receive_batch(), ['metric:0|c'])
+
+    @mock.patch('stsstatsd.Server')
+    def test_init_with_batch_size(self, s):
+        cfg = defaultdict(str)
+        cfg['use_dogstatsd'] = True
+        cfg['statsd_recv_batch_size'] = '64'
+
+        init5(cfg)
+
+        _, kwargs = s.call_args
+        self.assertEqual(kwargs['recv_batch_size'], '64')
+
+
+class TestContextGuardStats(TestCase):
+    @mock.patch('stsstatsd.get_hostname', return_value='myhost')
+    def test_submit_context_guard_stats(self, _):
+        aggregator = MetricsBucketAggregator('myhost', interval=10, max_contexts_per_name=1,
+                                             context_guard_exempt_prefix='stackstate.stsstatsd.')
+        reporter = Reporter(10, aggregator, 'http://localhost')
+        for name in ['a', 'b', 'c']:
+            for i in xrange(ord(name) - ord('a') + 2):
+                aggregator.submit_packets('%s:1|c|#id:%s' % (name, i))
+
+        with mock.patch('stsstatsd.CONTEXT_GUARD_TOP_OFFENDERS', 2):
+            reporter.submit_context_guard_stats()
+
+        self.assertEqual(reporter.rejected_context_count, 6)
+        self.assertEqual(reporter.top_rejected_contexts, [('c', 3), ('b', 2)])
+        contexts = aggregator.retired.metric_by_bucket.values()[0]
+        self.assertEqual(
+            sorted(context[1] for context in contexts if context[0] == 'stackstate.stsstatsd.context_guard.rejected'),
+            [('metric_name:b',), ('metric_name:c',)]
+        )
+
+        status = DogstatsdStatus(rejected_context_count=reporter.rejected_context_count,
+                                 top_rejected_contexts=reporter.top_rejected_contexts)
+        self.assertEqual(status.body_lines()[-3:], ["Samples over the context budgets: 6", "  c: 3", "  b: 2"])
+        self.assertEqual(status.to_dict()['top_rejected_contexts'], [('c', 3), ('b', 2)])
+
+
+class TestUdpStats(TestCase):
+    @mock.patch('stsstatsd.get_hostname', return_value='myhost')
+    def test_submit_udp_stats(self, _):
+        aggregator = MetricsBucketAggregator('myhost', interval=10)
+        server = mock.Mock()
+        server.socket_stats.return_value = []
+        server.udp_stats.side_effect = [(2048, 3), (0, 10), (512, 2)]
+        reporter = Reporter(10, aggregator, 'http://localhost', server=server)
+
+        with mock.patch.object(aggregator, 'submit_internal_metric') as submit_metric:
+            for _ in xrange(3):
+                reporter.submit_socket_stats()
+
+        self.assertEqual(submit_metric.call_args_list, [
+            mock.call('stackstate.stsstatsd.udp.rx_queue', 2048, 'g'),
+            mock.call('stackstate.stsstatsd.udp.drops', 3, 'c'),
+            mock.call('stackstate.stsstatsd.udp.rx_queue', 0, 'g'),
+            mock.call('stackstate.stsstatsd.udp.drops', 7, 'c'),
+            # The counter was reset by a worker restart
+            mock.call('stackstate.stsstatsd.udp.rx_queue', 512, 'g'),
+            mock.call('stackstate.stsstatsd.udp.drops', 0, 'c'),
+        ])
+        self.assertEqual(reporter.udp_drops, 10)
+
+        status = DogstatsdStatus(udp_rx_queue=reporter.udp_rx_queue, udp_drops=reporter.udp_drops)
+        self.assertEqual(status.body_lines()[-2:], ["UDP receive queue: 512 bytes",
+                                                    "UDP packets dropped by the kernel: 10"])
+        self.assertEqual(status.to_dict()['udp_drops'], 10)
+        self.assertNotIn("UDP receive queue: None bytes", DogstatsdStatus().body_lines())
+
+    @unittest.skipIf(not os.path.exists('/proc/net/udp'), "/proc/net/udp is only available on Linux")
+    def test_server_udp_stats(self):
+        server = Server(mock.MagicMock(), '127.0.0.1', 0)
+        self.assertEqual(server.udp_stats(), None)
+
+        thread = threading.Thread(target=server.start)
+        thread.start()
+        try:
+            while not server.running:
+                time.sleep(0.01)
+            self.assertEqual(server.udp_stats(), (0, 0))
+        finally:
+            server.stop()
+            thread.join()
+
+
+class TestShardHandoff(TestCase):
+    def test_socket_stats(self):
+        server = mock.Mock()
+        server.socket_stats.side_effect = [
+            [('stackstate.stsstatsd.uds.packets', 5, 'c'), ('stackstate.stsstatsd.uds.backlog', 10, 'g')],
+            [('stackstate.stsstatsd.uds.packets', 8, 'c'), ('stackstate.stsstatsd.uds.backlog', 0, 'g')],
+            [('stackstate.stsstatsd.uds.packets', 8, 'c'), ('stackstate.stsstatsd.uds.backlog', 0, 'g')],
+        ]
+        shard_queue = Queue.Queue()
+        worker = MetricsBucketAggregator('myhost', interval=1, formatter=api_formatter)
+        handoff = ShardHandoff(1, worker, shard_queue, server, os.getppid(), index=1)
+        reporting = MetricsBucketAggregator('myhost', interval=1)
+
+        # Only the complete buckets are handed over
+        for _ in xrange(3):
+            handoff.hand_off()
+            time.sleep(1.1)
+        while not shard_queue.empty():
+            reporting.merge_handoff(shard_queue.get_nowait())
+
+        packets = [metric for metric in reporting.flush() if metric['metric'] == 'stackstate.stsstatsd.uds.packets']
+        self.assertTrue(packets)
+        for metric in packets:
+            self.assertEqual(metric['tags'], ['shard:1'])
+        # The worker submits the increase of its counters
+        self.assertEqual(sum(metric['points'][0][1] for metric in packets), 8)
+
+
+class TestSerialization(TestCase):
+    def test_single_small_payload(self):
+        payloads = list(serialize_metrics([api_formatter('foo', 12, 1, ('tag',), 'host')], 'myhost'))
+
+        self.assertEqual(len(payloads), 1)
+        body, headers = payloads[0]
+        self.assertNotIn('Content-Encoding', headers)
+        series = json.loads(body)['series']
+        self.assertEqual([metric['metric'] for metric in series],
+                         ['foo', 'stackstate.stsstatsd.serialization_status'])
+        self.assertEqual(series[1]['tags'], ['status:success'])
+
+    def test_split_payloads(self):
+        random.seed(42)
+        metrics = [api_formatter('metric.%s' % i, random.random(), 1, ('id:%s' % random.random(),), 'host')
+                   for i in xrange(20000)]
+
+        payloads = list(serialize_metrics(metrics, 'myhost', max_payload_size=64 * 1024))
+
+        self.assertTrue(len(payloads) > 1)
+        names = []
+        for body, headers in payloads:
+            self.assertEqual(headers['Content-Encoding'], 'deflate')
+            self.assertTrue(len(body) <= 64 * 1024)
+            names.extend(metric['metric'] for metric in json.loads(zlib.decompress(body))['series'])
+        self.assertEqual(names, ['metric.%s' % i for i in xrange(20000)] + ['stackstate.stsstatsd.serialization_status'])
+
+    def test_unicode_error(self):
+        metrics = [api_formatter('foo\xe9', 1, 1, None, 'host'), api_formatter('bar', 1, 1, None, 'host')]
+
+        body, _ = next(serialize_metrics(metrics, 'myhost'))
+
+        series = json.loads(body)['series']
+        self.assertEqual([metric['metric'] for metric in series],
+                         [u'foo\ufffd', 'bar', 'stackstate.stsstatsd.serialization_status'])
+        self.assertEqual(series[2]['tags'], ['status:failure'])
+
+
+class TestPayloadSender(TestCase):
+    def setUp(self):
+        self.sender = PayloadSender(thread_count=2, queue_size=2, max_retries=2)
+        self.sender.session = mock.MagicMock()
+
+    def test_retry(self):
+        self.sender.session.post.side_effect = [requests.ConnectionError(), mock.Mock(status_code=503),
+                                                mock.Mock(status_code=202)]
+
+        with mock.patch('stsstatsd.SEND_RETRY_BACKOFF', 0):
+            self.sender.post('http://localhost/api/v1/series?api_key=key', 'body', {})
+
+        self.assertEqual(self.sender.session.post.call_count, 3)
+        self.assertEqual(self.sender.flush_stats(), {'sent': 1, 'retried': 2, 'dropped': 0, 'queued': 0})
+        self.assertEqual(self.sender.flush_stats()['retried'], 0)
+
+    def test_drop(self):
+        self.sender.session.post.return_value = mock.Mock(status_code=500)
+        with mock.patch('stsstatsd.SEND_RETRY_BACKOFF', 0):
+            self.sender.post('http://localhost', 'body', {})
+        self.assertEqual(self.sender.session.post.call_count, 3)
+
+        # Refused payloads are not retried
+        self.sender.session.post.return_value = mock.Mock(status_code=403)
+        self.sender.post('http://localhost', 'body', {})
+        self.assertEqual(self.sender.session.post.call_count, 4)
+
+        # The queue is bounded
+        for _ in xrange(3):
+            self.sender.submit('http://localhost', 'body', {})
+        self.assertEqual(self.sender.flush_stats(), {'sent': 0, 'retried': 2, 'dropped': 3, 'queued': 2})
+
+    def test_send_in_background(self):
+        posted = threading.Event()
+        self.sender.session.post.side_effect = lambda *args, **kwargs: posted.set() or mock.Mock(status_code=202)
+
+        self.sender.start()
+        self.sender.submit('http://localhost', 'body', {})
+        self.assertTrue(posted.wait(5))
+        self.sender.stop()
+
+        self.assertFalse(any(thread.is_alive() for thread in self.sender.threads))
+        self.assertEqual(self.sender.flush_stats()['sent'], 1)
+
+
+class TestReporterSketches(TestCase):
+    @mock.patch('stsstatsd.DogstatsdStatus')
+    @mock.patch('stsstatsd.get_hostname', return_value='myhost')
+    def test_flush_distributions_as_sketches(self, *_):
+        aggregator = MetricsBucketAggregator('myhost', interval=10)
+        reporter = Reporter(10, aggregator, 'http://localhost', api_key='key')
+        sketch = QuantileSketch()
+        sketch.add(1)
+        metrics = [
+            api_formatter('my.gauge', 1, 100, None, 'myhost', metric_type=MetricTypes.GAUGE),
+            api_formatter('my.dist', sketch.to_dict(), 100, None, 'myhost', metric_type=MetricTypes.DISTRIBUTION),
+        ]
+
+        with mock.patch.object(aggregator, 'flush', return_value=metrics), \
+                mock.patch.object(reporter, 'submit_http') as submit_http:
+            reporter.flush()
+
+        urls = [call[0][0] for call in submit_http.call_args_list]
+        self.assertEqual(urls, ['http://localhost/api/v1/series?api_key=key',
+                                'http://localhost/api/v1/sketches?api_key=key'])
+        series = json.loads(submit_http.call_args_list[0][0][1])['series']
+        self.assertNotIn('my.dist', [metric['metric'] for metric in series])
+        sketches = json.loads(submit_http.call_args_list[1][0][1])['sketches']
+        self.assertEqual([metric['metric'] for metric in sketches], ['my.dist'])
+        self.assertEqual(sketches[0]['points'][0][1]['count'], 1)
+
+
+class TestUnixSocket(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, 'stsstatsd.sock')
+        self.server = Server(mock.MagicMock(), 'localhost', '1234', socket_path=self.socket_path,
+                             recv_batch_size=10)
+
+    def tearDown(self):
+        if self.server.uds_socket is not None:
+            self.server._close_unix_socket()
+        shutil.rmtree(self.tmpdir)
+
+    def test_bind(self):
+        self.server.uds_socket = self.server._bind_unix_socket()
+
+        mode = os.stat(self.socket_path).st_mode
+        self.assertTrue(stat.S_ISSOCK(mode))
+        self.assertEqual(stat.S_IMODE(mode), 0722)
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        client.sendto('metric:1|c', self.socket_path)
+        client.sendto('metric:2|c', self.socket_path)
+        client.close()
+        self.assertEqual(self.server._receive_batch(self.server.uds_socket), ['metric:1|c', 'metric:2|c'])
+
+        self.server._close_unix_socket()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_bind_stale_socket(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(self.socket_path)
+        stale.close()
+
+        self.server.uds_socket = self.server._bind_unix_socket()
+        self.assertTrue(stat.S_ISSOCK(os.stat(self.socket_path).st_mode))
+
+    def test_bind_refuses_regular_file(self):
+        open(self.socket_path, 'w').close()
+        self.assertRaises(Exception, self.server._bind_unix_socket)
+        self.assertTrue(os.path.isfile(self.socket_path))
+
+    def test_socket_stats(self):
+        self.assertEqual(self.server.socket_stats(), [])
+
+        self.server.uds_socket = self.server._bind_unix_socket()
+        self.server.uds_packets = 12
+        self.server.uds_dropped = 2
+        self.server.uds_backlog = 5
+        self.assertEqual(self.server.socket_stats(), [
+            ('stackstate.stsstatsd.uds.packets', 12, 'c'),
+            ('stackstate.stsstatsd.uds.dropped', 2, 'c'),
+            ('stackstate.stsstatsd.uds.backlog', 5, 'g'),
+        ])
+        # The counters are never reset, the reporter submits their increase
+        self.assertEqual(self.server.uds_packets, 12)
+        self.assertEqual(self.server.uds_backlog, 0)
+
+        reporter = Reporter(10, mock.Mock(), 'http://localhost', server=self.server)
+        self.server.udp_stats = mock.Mock(return_value=None)
+        reporter.submit_socket_stats()
+        self.server.uds_packets += 3
+        reporter.submit_socket_stats()
+        self.assertEqual(reporter.metrics_aggregator.submit_internal_metric.call_args_list, [
+            mock.call('stackstate.stsstatsd.uds.packets', 12, 'c'),
+            mock.call('stackstate.stsstatsd.uds.dropped', 2, 'c'),
+            mock.call('stackstate.stsstatsd.uds.backlog', 0, 'g'),
+            mock.call('stackstate.stsstatsd.uds.packets', 3, 'c'),
+            mock.call('stackstate.stsstatsd.uds.dropped', 0, 'c'),
+            mock.call('stackstate.stsstatsd.uds.backlog', 0, 'g'),
+        ])
+
+    def test_oversized_datagram_dropped(self):
+        self.server.uds_socket = self.server._bind_unix_socket()
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        client.sendto('metric:1|c', self.socket_path)
+        client.sendto('m' * (self.server.buffer_size + 1), self.socket_path)
+        client.sendto('metric:2|c', self.socket_path)
+        client.close()
+        self.assertEqual(self.server._receive_batch(self.server.uds_socket), ['metric:1|c', 'metric:2|c'])
+        self.assertEqual(self.server.uds_packets, 3)
+        self.assertEqual(self.server.uds_dropped, 1)
+
+    def test_backlog(self):
+        self.server.recv_batch_size = 1
+        self.server.uds_socket = self.server._bind_unix_socket()
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        client.sendto('metric:1|c', self.socket_path)
+        client.sendto('metric:22|c', self.socket_path)
+        client.close()
+        self.assertEqual(self.server._receive_batch(self.server.uds_socket), ['metric:1|c'])
+        self.server._sample_unix_backlog()
+        self.assertEqual(self.server.uds_backlog, len('metric:22|c'))
+        self.server._receive_batch(self.server.uds_socket)
+        self.server._sample_unix_backlog()
+        self.assertEqual(self.server.uds_backlog, len('metric:22|c'))
+
+    @mock.patch('stsstatsd.Server')
+    def test_init_with_socket(self, s):
+        cfg = defaultdict(str)
+        cfg['use_dogstatsd'] = True
+        cfg['dogstatsd_socket'] = self.socket_path
+        cfg['dogstatsd_socket_perms'] = '0700'
+
+        reporter, _ = init5(cfg)
+
+        _, kwargs = s.call_args
+        self.assertEqual(kwargs['socket_path'], self.socket_path)
+        self.assertEqual(kwargs['socket_perms'], '0700')
+        self.assertEqual(reporter.server, s.return_value)
+
+
+class TestTcpListener(TestCase):
+    def setUp(self):
+        self.listener = TcpListener('127.0.0.1', 0, max_connections=2)
+        self.listener.bind()
+        self.address = ('127.0.0.1', self.listener.socket.getsockname()[1])
+
+    def tearDown(self):
+        self.listener.close()
+
+    def _read(self):
+        """
+        Handle the ready sockets of the listener once, return the lines read.
+        """
+        lines = []
+        ready, _, _ = select.select(self.listener.sockets, [], [], 1)
+        for sock in ready:
+            message = self.listener.read(sock)
+            if message:
+                lines.extend(message.split('\n'))
+        return lines
+
+    def _connect(self):
+        client = socket.create_connection(self.address)
+        self._read()
+        return client
+
+    def test_framing(self):
+        client = self._connect()
+        self.assertEqual(len(self.listener.connections), 1)
+
+        client.sendall('metric:1|c\nmetric:2|c\nmetric:')
+        time.sleep(0.05)
+        self.assertEqual(self._read(), ['metric:1|c', 'metric:2|c'])
+
+        # The partial line is completed by the next read, the last line by the end of the stream
+        client.sendall('3|c\nmetric:4|c')
+        client.close()
+        time.sleep(0.05)
+        self.assertEqual(self._read(), ['metric:3|c'])
+        self.assertEqual(self._read(), ['metric:4|c'])
+        self.assertEqual(self.listener.connections, {})
+
+    def test_concurrent_connections(self):
+        clients = [self._connect() for _ in xrange(2)]
+        # Over max_connections
+        rejected = self._connect()
+        self.assertEqual(len(self.listener.connections), 2)
+        self.assertEqual(rejected.recv(1), '')
+
+        for i, client in enumerate(clients):
+            client.sendall('metric:%s|c\n' % i)
+        time.sleep(0.05)
+        self.assertEqual(sorted(self._read()), ['metric:0|c', 'metric:1|c'])
+
+        stats = self.listener.stats()
+        self.assertEqual(stats[:3], [
+            ('stackstate.stsstatsd.tcp.connections', 2, 'g'),
+            ('stackstate.stsstatsd.tcp.packets', 2, 'c'),
+            ('stackstate.stsstatsd.tcp.rejected_connections', 1, 'c'),
+        ])
+        throughputs = stats[3:]
+        self.assertEqual(len(throughputs), 2)
+        for name, value, metric_type in throughputs:
+            self.assertEqual(name, 'stackstate.stsstatsd.tcp.connection_packets_per_second')
+            self.assertEqual(metric_type, 'h')
+            self.assertTrue(value > 0)
+        # Totals, the reporter submits their increase
+        self.assertEqual(self.listener.stats()[1], ('stackstate.stsstatsd.tcp.packets', 2, 'c'))
+        counters = CounterDeltas()
+        self.assertEqual(counters.deltas(self.listener.stats())[1], ('stackstate.stsstatsd.tcp.packets', 2, 'c'))
+        self.assertEqual(counters.deltas(self.listener.stats())[1], ('stackstate.stsstatsd.tcp.packets', 0, 'c'))
+
+        for client in clients:
+            client.close()
+
+    def test_line_too_long(self):
+        client = self._connect()
+        client.sendall('x' * (TCP_MAX_LINE_LENGTH + 1))
+        for _ in xrange(10):
+            if not self.listener.connections:
+                break
+            self._read()
+        self.assertEqual(self.listener.connections, {})
+        client.close()
+
+    def test_server_submits_lines(self):
+        aggregator = mock.MagicMock()
+        server = Server(aggregator, '127.0.0.1', 0, tcp_port=self.address[1] + 1)
+        server.tcp = self.listener
+        client = self._connect()
+        client.sendall('metric:1|c\nmetric:2|c\n')
+        client.close()
+        time.sleep(0.05)
+
+        def stop(*args):
+            server.running = False
+        aggregator.submit_packets.side_effect = stop
+        server.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server._run([server.socket])
+        aggregator.submit_packets.assert_called_once_with('metric:1|c\nmetric:2|c')
+        server.socket.close()
+
+    @mock.patch('stsstatsd.Server')
+    def test_init_with_tcp_port(self, s):
+        cfg = defaultdict(str)
+        cfg['use_dogstatsd'] = True
+        cfg['statsd_tcp_port'] = '8126'
+
+        init5(cfg)
+
+        _, kwargs = s.call_args
+        self.assertEqual(kwargs['tcp_port'], 8126)
+
+
 @unittest.skip("StackState: These don't work on travis due to absence of ipv6. Skip for now because we do not use dogstatsd.")
 class TestServer(TestCase):
     def test_init(self):
@@ -3,7 +3,7 @@ import unittest
 
 # project
 from aggregator import Histogram, MetricsAggregator
-from config import get_histogram_aggregates, get_histogram_percentiles
+from config import get_histogram_aggregates, get_histogram_percentiles, get_histogram_relative_accuracy
 
 class TestHistogram(unittest.TestCase):
     def test_default(self):
@@ -152,3 +152,58 @@ class TestHistogram(unittest.TestCase):
         self.assertEquals(value_by_type['max'], 19, value_by_type)
         self.assertEquals(value_by_type['sum'], 190, value_by_type)
         self.assertEquals(value_by_type['95percentile'], 18, value_by_type)
+
+    def test_sketch(self):
+        stats = MetricsAggregator(
+            'myhost',
+            histogram_aggregates=get_histogram_aggregates('min, max, median, avg, sum, count'),
+            histogram_percentiles=get_histogram_percentiles('0.5, 0.95, 0.99'),
+            histogram_relative_accuracy=get_histogram_relative_accuracy('sketch', '0.01')
+        )
+
+        for i in xrange(1, 50001):
+            stats.submit_packets('myhistogram:{0}|h'.format(i))
+
+        metrics = stats.flush()
+
+        value_by_type = {}
+        for k in metrics:
+            value_by_type[k['metric'][len('myhistogram')+1:]] = k['points'][0][1]
+
+        # Exact aggregates
+        self.assertEquals(value_by_type['min'], 1, value_by_type)
+        self.assertEquals(value_by_type['max'], 50000, value_by_type)
+        self.assertEquals(value_by_type['sum'], 1250025000, value_by_type)
+        self.assertEquals(value_by_type['avg'], 25000.5, value_by_type)
+        self.assertEquals(value_by_type['count'], 50000, value_by_type)
+        # Approximated ones
+        for name, expected in [('median', 25000), ('50percentile', 25000),
+                               ('95percentile', 47500), ('99percentile', 49500)]:
+            self.assertTrue(abs(value_by_type[name] - expected) <= 0.01 * expected, (name, value_by_type))
+
+    def test_sketch_merge(self):
+        extra_config = {'relative_accuracy': 0.01}
+        histograms = [Histogram(None, 'myhistogram', None, 'myhost', None, extra_config) for _ in xrange(2)]
+        histograms.append(Histogram(None, 'myhistogram', None, 'myhost', None))
+        for i, histogram in enumerate(histograms):
+            for value in xrange(10):
+                histogram.sample(value + i * 10, 1)
+
+        merged, sketched, exact = histograms
+        merged.merge(sketched)
+        merged.merge(exact)
+        self.assertEquals(merged.count, 30)
+        self.assertEquals(merged.sketch.count, 30)
+        self.assertEquals((merged.sketch.min, merged.sketch.max, merged.sketch.sum), (0, 29, 435))
+
+        exact.merge(sketched)
+        self.assertEquals(exact.samples, [])
+        self.assertEquals(exact.sketch.count, 20)
+
+    def test_relative_accuracy_config(self):
+        self.assertEquals(get_histogram_relative_accuracy(None), None)
+        self.assertEquals(get_histogram_relative_accuracy('samples', '0.05'), None)
+        self.assertEquals(get_histogram_relative_accuracy('unknown'), None)
+        self.assertEquals(get_histogram_relative_accuracy('sketch'), 0.01)
+        self.assertEquals(get_histogram_relative_accuracy('sketch', '0.05'), 0.05)
+        self.assertEquals(get_histogram_relative_accuracy('sketch', '2'), 0.01)
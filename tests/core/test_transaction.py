@@ -1,25 +1,52 @@
 # stdlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import copy
 from datetime import datetime, timedelta
+import Queue
+import shutil
+from SocketServer import ThreadingMixIn
+import tempfile
 import threading
 import time
 import unittest
+import zlib
 
 # 3rd party
+import mock
 from nose.plugins.attrib import attr
 #import requests
 #import simplejson as json
+import simplejson as json
+from tornado.testing import AsyncHTTPTestCase
 from tornado.web import Application
 
 # project
 #from config import get_version
 from stsagent import (
-    #APIMetricTransaction,
+    AgentTransaction,
+    APIMetricTransaction,
+    APISketchTransaction,
+    ApiSketchHandler,
     #APIServiceCheckTransaction,
+    EmitterManager,
+    EndpointClient,
     MAX_QUEUE_SIZE,
     MetricTransaction,
+    StatusHandler,
     THROTTLING_DELAY,
 )
-from transaction import Transaction, TransactionManager
+from transaction import (
+    CIRCUIT_OPEN_DELAY,
+    CircuitBreaker,
+    EndpointThrottle,
+    HEAP_COMPACTION_MIN_SIZE,
+    LatencyHistogram,
+    ThroughputCounter,
+    Transaction,
+    TransactionManager,
+    TransactionQueue,
+)
+from utils.spill import SpillStore
 
 
 class memTransaction(Transaction):
@@ -68,6 +95,73 @@ class SleepingTransaction(Transaction):
         self._trManager.flush_next()
 
 
+class RetryAfterTransaction(memTransaction):
+    def __init__(self, size, manager, endpoint, retry_after=None):
+        memTransaction.__init__(self, size, manager)
+        self._endpoint = endpoint
+        self.retry_after = retry_after
+
+    def flush(self):
+        self._flush_count += 1
+        if self.retry_after is None:
+            self._trManager.tr_success(self)
+        else:
+            self._trManager.tr_error(self, retry_after=self.retry_after)
+        self._trManager.flush_next()
+
+
+class BatchableTransaction(memTransaction):
+    # Batches with more members are rejected as too large
+    max_members = None
+    failing = False
+    # Batches with these items are rejected as invalid
+    invalid_items = ()
+
+    def __init__(self, size, manager, items):
+        memTransaction.__init__(self, size, manager)
+        self.items = items
+        self.requests = []
+
+    def get_batch_key(self):
+        return 'items'
+
+    def merge(self, transactions):
+        batch = copy.copy(self)
+        batch.items = [item for tr in transactions for item in tr.items]
+        batch._batch = list(transactions)
+        return batch
+
+    def flush(self):
+        self.requests.append(self.items)
+        if self.failing:
+            self._trManager.tr_error(self)
+        elif self.max_members is not None and len(self.get_members()) > self.max_members:
+            self._trManager.tr_error_reject_request(self, 413)
+        elif set(self.items) & set(self.invalid_items):
+            self._trManager.tr_error_reject_request(self, 400)
+        else:
+            self._trManager.tr_success(self)
+        self._trManager.flush_next()
+
+
+class SpillableTransaction(Transaction):
+    _trManager = None
+    failing = False
+
+    def __init__(self, size, name):
+        Transaction.__init__(self)
+        self._size = size
+        self._endpoint = 'https://example.com'
+        self.name = name
+
+    def flush(self):
+        if self.failing:
+            self._trManager.tr_error(self, response_code=503)
+        else:
+            self._trManager.tr_success(self)
+        self._trManager.flush_next()
+
+
 @attr(requires='core_integration')
 class TestTransaction(unittest.TestCase):
 
@@ -90,22 +184,22 @@ class TestTransaction(unittest.TestCase):
 
         # There should be exactly step transaction in the list, with
         # a flush count of 1
-        self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        self.assertEqual(len(trManager.get_transactions()), step)
+        for tr in trManager.get_transactions():
             self.assertEqual(tr._flush_count, 1)
 
         # Try to add one more
         trManager.append(memTransaction(oneTrSize + 10, trManager))
 
         # At this point, transaction one (the oldest) should have been removed from the list
-        self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        self.assertEqual(len(trManager.get_transactions()), step)
+        for tr in trManager.get_transactions():
             self.assertNotEqual(tr._id, 1)
 
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), step)
+        self.assertEqual(len(trManager.get_transactions()), step)
         # Check and allow transactions to be flushed
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             tr.is_flushable = True
             # Last transaction has been flushed only once
             if tr._id == step + 1:
@@ -114,7 +208,7 @@ class TestTransaction(unittest.TestCase):
                 self.assertEqual(tr._flush_count, 2)
 
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), 0)
+        self.assertEqual(len(trManager.get_transactions()), 0)
 
     def testThrottling(self):
         """Test throttling while flushing"""
@@ -151,7 +245,6 @@ class TestTransaction(unittest.TestCase):
         app.skip_ssl_validation = False
         app.agent_dns_caching = False
         app._agentConfig = config
-        app.use_simple_http_client = True
 
         trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
                                        THROTTLING_DELAY, max_endpoint_errors=100)
@@ -186,7 +279,6 @@ class TestTransaction(unittest.TestCase):
 #         app.skip_ssl_validation = False
 #         app.agent_dns_caching = False
 #         app._agentConfig = config
-#         app.use_simple_http_client = True
 #
 #         trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
 #                                        THROTTLING_DELAY, max_endpoint_errors=100)
@@ -249,7 +341,8 @@ class TestTransaction(unittest.TestCase):
 
     def test_endpoint_error(self):
         trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
-                                       timedelta(seconds=0), max_endpoint_errors=2)
+                                       timedelta(seconds=0), max_endpoint_errors=2,
+                                       circuit_open_delay=0)
 
         step = 10
         oneTrSize = (MAX_QUEUE_SIZE / step) - 1
@@ -260,32 +353,34 @@ class TestTransaction(unittest.TestCase):
 
         # There should be exactly step transaction in the list,
         # and only 2 of them with a flush count of 1
-        self.assertEqual(len(trManager._transactions), step)
+        self.assertEqual(len(trManager.get_transactions()), step)
         flush_count = 0
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             flush_count += tr._flush_count
         self.assertEqual(flush_count, 2)
 
-        # If we retry to flush, two OTHER transactions should be tried
+        # If we retry to flush, the circuit is half-open: a single OTHER
+        # transaction is tried as a probe
         trManager.flush()
 
-        self.assertEqual(len(trManager._transactions), step)
+        self.assertEqual(len(trManager.get_transactions()), step)
         flush_count = 0
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             flush_count += tr._flush_count
             self.assertIn(tr._flush_count, [0, 1])
-        self.assertEqual(flush_count, 4)
+        self.assertEqual(flush_count, 3)
 
         # Finally when it's possible to flush, everything should go smoothly
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             tr.is_flushable = True
 
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), 0)
+        self.assertEqual(len(trManager.get_transactions()), 0)
 
     def test_drop_repeated_error(self):
         trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
-                                       timedelta(seconds=0), max_endpoint_errors=1)
+                                       timedelta(seconds=0), max_endpoint_errors=1,
+                                       circuit_open_delay=0)
 
         # Fail it once
         oneTrSize = 10
@@ -293,11 +388,20 @@ class TestTransaction(unittest.TestCase):
 
         # It should still be there after flush
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), 1)
+        self.assertEqual(len(trManager.get_transactions()), 1)
 
-        #Try again, now it should be gone
+        # The probes of the circuit don't count
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), 0)
+        self.assertEqual(len(trManager.get_transactions()), 1)
+
+        #Try again once the endpoint is back, now it should be gone
+        probe = memTransaction(oneTrSize, trManager)
+        probe.is_flushable = True
+        probe._next_flush = datetime(1970, 1, 1)
+        trManager.append(probe)
+        trManager.flush()
+        self.assertEqual(len(trManager.get_transactions()), 0)
+        self.assertEqual(trManager._transactions_rejected, 1)
 
     @attr('unix')
     def test_parallelism(self):
@@ -352,7 +456,6 @@ class TestTransaction(unittest.TestCase):
         app = Application()
         app.skip_ssl_validation = False
         app._agentConfig = config
-        app.use_simple_http_client = True
         trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
                                        THROTTLING_DELAY, max_endpoint_errors=100)
         trManager._flush_without_ioloop = True  # Use blocking API to emulate tornado ioloop
@@ -362,6 +465,700 @@ class TestTransaction(unittest.TestCase):
 
         MetricTransaction({}, {})
         # 2 endpoints = 2 transactions
-        self.assertEqual(len(trManager._transactions), 2)
-        self.assertEqual(trManager._transactions[0]._endpoint, 'https://app.datadoghq.com')
-        self.assertEqual(trManager._transactions[1]._endpoint, 'https://app.example.com')
+        self.assertEqual(len(trManager.get_transactions()), 2)
+        self.assertEqual(trManager.get_transactions()[0]._endpoint, 'https://app.datadoghq.com')
+        self.assertEqual(trManager.get_transactions()[1]._endpoint, 'https://app.example.com')
+
+
+class TestEndpointThrottle(unittest.TestCase):
+
+    def test_additive_increase(self):
+        throttle = EndpointThrottle(initial_limit=1, max_limit=3)
+        self.assertTrue(throttle.available(0))
+        throttle.on_send()
+        self.assertFalse(throttle.available(0))
+
+        throttle.on_success(0.1)
+        self.assertEqual(throttle.limit, 2)
+        # About one more request in flight per window of successes
+        for _ in xrange(2):
+            throttle.on_send()
+            throttle.on_success(0.1)
+        self.assertAlmostEqual(throttle.limit, 2.9)
+        for _ in xrange(2):
+            throttle.on_send()
+            throttle.on_success(0.1)
+        self.assertEqual(throttle.limit, 3)
+
+    def test_no_increase_when_slow(self):
+        throttle = EndpointThrottle(initial_limit=2)
+        throttle.on_send()
+        throttle.on_success(0.1)
+        limit = throttle.limit
+        throttle.on_send()
+        throttle.on_success(2)
+        self.assertEqual(throttle.limit, limit)
+
+    def test_multiplicative_decrease(self):
+        throttle = EndpointThrottle(initial_limit=8, backoff_delay=1)
+        for _ in xrange(8):
+            throttle.on_send()
+
+        # The requests sent before the decrease do not decrease the limit again
+        throttle.on_error(sent_at=10, now=11)
+        throttle.on_error(sent_at=10, now=11)
+        self.assertEqual(throttle.limit, 4)
+        # Exponential backoff
+        self.assertEqual(throttle.blocked_until, 13)
+        self.assertFalse(throttle.available(12))
+        throttle.on_error(sent_at=12, now=12)
+        self.assertEqual(throttle.limit, 2)
+        self.assertEqual(throttle.blocked_until, 16)
+
+    def test_no_decrease_when_not_congested(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_endpoint_errors=100)
+        throttle = trManager.get_queue(memTransaction(10, trManager)).throttle
+        throttle.limit = 8
+        for code in [403, 404, 429, 503, None]:
+            tr = memTransaction(10, trManager)
+            trManager.append(tr)
+            throttle.on_send()
+            trManager._running_flushes += 1
+            tr._sent_at = time.time()
+            trManager.tr_error(tr, response_code=code)
+            if code in (403, 404):
+                self.assertEqual(throttle.limit, 8)
+        self.assertEqual(throttle.limit, 1)
+        self.assertEqual(throttle.errors, 5)
+
+    def test_retry_after(self):
+        throttle = EndpointThrottle(initial_limit=1, backoff_delay=1)
+        throttle.on_send()
+        throttle.on_error(sent_at=10, now=10, retry_after=30)
+        self.assertEqual(throttle.blocked_until, 40)
+        self.assertEqual(throttle.limit, 1)
+        self.assertTrue(throttle.available(40))
+
+    def test_blocked_endpoint(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_endpoint_errors=100)
+        throttled = RetryAfterTransaction(10, trManager, 'https://a.example.com', retry_after=60)
+        waiting = RetryAfterTransaction(10, trManager, 'https://a.example.com')
+        other = RetryAfterTransaction(10, trManager, 'https://b.example.com')
+        for tr in [waiting, other, throttled]:
+            trManager.append(tr)
+
+        trManager.flush()
+        # The 429 blocks its endpoint only
+        self.assertEqual(throttled._flush_count, 1)
+        self.assertEqual(waiting._flush_count, 0)
+        self.assertEqual(other._flush_count, 1)
+        self.assertEqual(trManager._trs_to_flush, [waiting])
+        self.assertEqual(trManager._next_unblocked(time.time()) > 50, True)
+        state = trManager.get_queue(throttled).throttle.to_dict(time.time())
+        self.assertEqual(state['errors'], 1)
+        self.assertTrue(state['blocked_for'] > 50)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_open_and_probe(self):
+        breaker = CircuitBreaker(failure_threshold=2, open_delay=10, max_open_delay=30)
+        self.assertFalse(breaker.on_failure(0))
+        self.assertTrue(breaker.available(0))
+        self.assertTrue(breaker.on_failure(0))
+        self.assertFalse(breaker.available(9))
+
+        # Half-open, a single probe is let through
+        self.assertTrue(breaker.available(10))
+        breaker.on_send()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.available(10))
+        # A failed probe opens it for twice as long
+        self.assertTrue(breaker.on_failure(11))
+        self.assertEqual(breaker.open_until, 31)
+        self.assertTrue(breaker.available(31))
+        breaker.on_send()
+        breaker.on_failure(31)
+        self.assertEqual(breaker.open_until, 61)
+
+        self.assertTrue(breaker.available(61))
+        breaker.on_send()
+        self.assertTrue(breaker.on_success())
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.delay, 10)
+        self.assertEqual(breaker.opened, 3)
+
+    def test_failing_endpoint_isolated(self):
+        trManager = TransactionManager(timedelta(seconds=0), 100, timedelta(seconds=0),
+                                       max_endpoint_errors=2)
+        down = [RetryAfterTransaction(30, trManager, 'https://down.example.com', retry_after=0)
+                for _ in xrange(3)]
+        up = [RetryAfterTransaction(30, trManager, 'https://up.example.com') for _ in xrange(3)]
+        for tr in down + up:
+            trManager.append(tr)
+
+        trManager.flush()
+        # The circuit of the failing endpoint opens after 2 errors
+        self.assertEqual(sum(tr._flush_count for tr in down), 2)
+        self.assertEqual([tr._flush_count for tr in up], [1, 1, 1])
+        self.assertEqual(trManager.get_queue(down[0]).breaker.state, CircuitBreaker.OPEN)
+
+        # The queue of the failing endpoint is full, it only evicts its own transactions
+        for _ in xrange(3):
+            trManager.append(RetryAfterTransaction(30, trManager, 'https://down.example.com', retry_after=0))
+        up = [RetryAfterTransaction(30, trManager, 'https://up.example.com') for _ in xrange(3)]
+        for tr in up:
+            trManager.append(tr)
+        self.assertEqual(len(trManager.get_queue(down[0]).transactions), 3)
+        self.assertEqual(len(trManager.get_queue(up[0]).transactions), 3)
+
+        # While its circuit is open, it's left alone
+        trManager.flush()
+        self.assertEqual(sum(tr._flush_count for tr in down), 2)
+        self.assertEqual([tr._flush_count for tr in up], [1, 1, 1])
+        self.assertEqual(len(trManager.get_transactions()), 3)
+
+
+class TestBatch(unittest.TestCase):
+
+    def _flush(self, trManager, trs):
+        requests = []
+        for tr in trs:
+            trManager.append(tr)
+            tr.requests = requests
+        trManager.flush()
+        return requests
+
+    def test_merge(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_batch_size=30)
+        trs = [BatchableTransaction(10, trManager, [i]) for i in xrange(5)]
+        requests = self._flush(trManager, trs)
+        # Batches of at most 30 bytes, the newest transactions first
+        self.assertEqual(requests, [[4, 3, 2], [1, 0]])
+        self.assertEqual(len(trManager.get_transactions()), 0)
+        self.assertEqual(trManager._transactions_flushed, 5)
+
+    def test_split_rejected_batch(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_batch_size=100)
+        trs = [BatchableTransaction(10, trManager, [i]) for i in xrange(5)]
+        for tr in trs:
+            tr.max_members = 2
+        requests = self._flush(trManager, trs)
+        self.assertEqual(requests, [[4, 3, 2, 1, 0], [2, 1, 0], [1, 0], [2], [4, 3]])
+        self.assertEqual(len(trManager.get_transactions()), 0)
+        self.assertEqual(trManager._transactions_rejected, 0)
+
+    def test_attribute_invalid_batch(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_batch_size=100)
+        trs = [BatchableTransaction(10, trManager, [i]) for i in xrange(4)]
+        for tr in trs:
+            tr.invalid_items = (2,)
+        requests = self._flush(trManager, trs)
+        # Each transaction is sent again on its own, only the invalid one is rejected
+        self.assertEqual(requests, [[3, 2, 1, 0], [0], [1], [2], [3]])
+        self.assertEqual(len(trManager.get_transactions()), 0)
+        self.assertEqual(trManager._transactions_rejected, 1)
+
+    def test_merge_off_ioloop(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_batch_size=100)
+        trs = [BatchableTransaction(10, trManager, [i]) for i in xrange(3)]
+        callbacks = Queue.Queue()
+        io_loop = mock.Mock(_running=True)
+        io_loop.add_callback.side_effect = lambda callback, *args: callbacks.put((callback, args))
+        with mock.patch('tornado.ioloop.IOLoop.current', return_value=io_loop):
+            requests = self._flush(trManager, trs)
+            # Nothing is sent until the merged batch is back on the IOLoop
+            self.assertEqual(requests, [])
+            callback, args = callbacks.get(timeout=5)
+            callback(*args)
+        self.assertEqual(requests, [[2, 1, 0]])
+        self.assertEqual(len(trManager.get_transactions()), 0)
+
+    def test_batch_error(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_batch_size=100, max_endpoint_errors=100)
+        trs = [BatchableTransaction(10, trManager, [i]) for i in xrange(3)]
+        for tr in trs:
+            tr.failing = True
+        trs[0]._error_count = 3
+        requests = self._flush(trManager, trs)
+        # The members of the batch get its error count, that of the freshest
+        # one plus the failure
+        self.assertEqual(requests, [[2, 1, 0]])
+        self.assertEqual([tr.get_error_count() for tr in trs], [3, 1, 1])
+        self.assertEqual(len(trManager.get_transactions()), 3)
+
+    def test_merge_series(self):
+        trManager = mock.Mock()
+        trManager.append.side_effect = lambda tr: tr.set_id(trManager.append.call_count)
+        APIMetricTransaction.set_tr_manager(trManager)
+        APIMetricTransaction.set_endpoints({'https://app.example.com': ['api_key']})
+        APIMetricTransaction(json.dumps({'series': [{'metric': 'a'}]}), {'Content-Type': 'application/json'})
+        APIMetricTransaction(zlib.compress(json.dumps({'series': [{'metric': 'b'}, {'metric': 'c'}]})),
+                             {'Content-Type': 'application/json', 'Content-Encoding': 'deflate'})
+        APIMetricTransaction('not a payload', {})
+        trs = [call[0][0] for call in trManager.append.call_args_list]
+
+        batch = trs[0].merge(trs)
+        self.assertEqual(batch.get_members(), trs[:2])
+        self.assertEqual(batch._headers['Content-Encoding'], 'deflate')
+        self.assertEqual(json.loads(zlib.decompress(batch.get_data())),
+                         {'series': [{'metric': 'a'}, {'metric': 'b'}, {'metric': 'c'}]})
+        # Nothing to merge it with
+        self.assertIs(trs[2].merge(trs), trs[2])
+
+
+class TestStatus(unittest.TestCase):
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram(bounds=[1, 2, 4])
+        self.assertEqual(histogram.percentile(0.5), None)
+        for value in [0.5, 0.7, 1.5, 3, 10]:
+            histogram.add(value)
+        self.assertEqual(histogram.percentile(0.5), 2)
+        self.assertEqual(histogram.percentile(0.9), 10)
+        self.assertEqual(histogram.percentile(0.1), 1)
+
+    def test_throughput(self):
+        counter = ThroughputCounter(window=10, slots=5)
+        counter.add(10, 1000, now=100)
+        counter.add(10, 1000, now=105)
+        self.assertEqual(counter.rates(now=109), (2, 200))
+        # The first slot is out of the window
+        self.assertEqual(counter.rates(now=110), (1, 100))
+        self.assertEqual(counter.rates(now=1000), (0, 0))
+
+    def test_status(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0),
+                                       max_endpoint_errors=100)
+        trs = [memTransaction(10, trManager) for _ in xrange(3)]
+        for tr in trs:
+            tr._created_at = time.time() - 60
+            trManager.append(tr)
+        trs[0].is_flushable = True
+        trManager.flush()
+
+        status = trManager.get_status()
+        self.assertEqual(status['queue_length'], 2)
+        self.assertEqual(status['transactions_flushed'], 1)
+        endpoint = status['endpoints'][0]
+        self.assertEqual(endpoint['queue_length'], 2)
+        self.assertEqual(endpoint['queue_size'], 20)
+        self.assertEqual(endpoint['delivered'], 1)
+        self.assertEqual(endpoint['retries'], 2)
+        self.assertTrue(60 <= endpoint['oldest_age'] < 61)
+        self.assertTrue(40 < endpoint['latency']['p50'] <= 61)
+        self.assertEqual(trManager.get_health_errors(status, 120), [])
+        self.assertEqual(len(trManager.get_health_errors(status, 30)), 1)
+
+
+class TestStatusHandler(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return Application([(r"/status/?", StatusHandler)])
+
+    def test_health_check(self):
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE, timedelta(seconds=0))
+        MetricTransaction._trManager = trManager
+        response = self.fetch('/status')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['healthy'], True)
+
+        tr = memTransaction(10, trManager)
+        tr._created_at = time.time() - 600
+        trManager.append(tr)
+        response = self.fetch('/status')
+        self.assertEqual(response.code, 503)
+        status = json.loads(response.body)
+        self.assertEqual(status['queue_length'], 1)
+        self.assertEqual(len(status['errors']), 1)
+        self.assertEqual(self.fetch('/status?max_age=3600').code, 200)
+        self.assertEqual(self.fetch('/status?max_age=3600&threshold=0').code, 503)
+
+
+class TestSketchHandler(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return Application([(r"/api/v1/sketches/?", ApiSketchHandler)])
+
+    def test_post_sketches(self):
+        trManager = mock.Mock()
+        trManager.append.side_effect = lambda tr: tr.set_id(trManager.append.call_count)
+        endpoints = {'https://intake.example.com': ['key1', 'key2']}
+        with mock.patch.object(AgentTransaction, '_trManager', trManager), \
+                mock.patch.object(AgentTransaction, '_endpoints', endpoints), \
+                mock.patch.object(AgentTransaction, '_emitter_manager', None):
+            response = self.fetch('/api/v1/sketches?api_key=foo', method='POST', body='{"sketches": []}',
+                                  headers={'Content-Type': 'application/json'})
+
+        self.assertEqual(response.code, 200)
+        transactions = [call[0][0] for call in trManager.append.call_args_list]
+        self.assertEqual(len(transactions), 2)
+        for tr in transactions:
+            self.assertIsInstance(tr, APISketchTransaction)
+            self.assertEqual(tr._data, '{"sketches": []}')
+        self.assertEqual(sorted(tr.get_url(tr._endpoint, tr._api_key) for tr in transactions), [
+            'https://intake.example.com/api/v1/sketches/?api_key=key1',
+            'https://intake.example.com/api/v1/sketches/?api_key=key2',
+        ])
+        trManager.flush.assert_called_once_with()
+
+
+class TestTransactionQueue(unittest.TestCase):
+
+    def _queue(self, count):
+        queue = TransactionQueue()
+        trs = []
+        for i in xrange(count):
+            tr = Transaction()
+            tr.set_id(i + 1)
+            tr._next_flush = datetime(2017, 1, 1, 0, 0, i)
+            queue.append(tr)
+            trs.append(tr)
+        return queue, trs
+
+    def test_pop_due(self):
+        queue, trs = self._queue(5)
+
+        self.assertEqual(queue.pop_due(datetime(2017, 1, 1, 0, 0, 2)), trs[:3])
+        # Due transactions are not selected again until they are rescheduled
+        self.assertEqual(queue.pop_due(datetime(2017, 1, 1, 0, 0, 2)), [])
+        trs[0]._next_flush = datetime(2017, 1, 1, 0, 0, 10)
+        queue.reschedule(trs[0])
+        trs[3]._next_flush = datetime(2017, 1, 1, 0, 0, 11)
+        queue.reschedule(trs[3])
+        queue.remove(trs[4])
+
+        self.assertEqual(queue.pop_due(datetime(2017, 1, 1, 0, 0, 10)), [trs[0]])
+        self.assertEqual(queue.pop_due(datetime(2017, 1, 1, 0, 1)), [trs[3]])
+        self.assertEqual(list(queue), trs[:4])
+
+    def test_evict(self):
+        queue, trs = self._queue(4)
+        trs[1]._next_flush = datetime(2017, 1, 1, 0, 1)
+        queue.reschedule(trs[1])
+        trs[2]._next_flush = trs[0]._next_flush
+        queue.reschedule(trs[2])
+
+        # Latest next flush first, then oldest
+        self.assertEqual(queue.evict(), trs[1])
+        self.assertEqual(queue.evict(), trs[3])
+        self.assertEqual(queue.evict(), trs[0])
+        self.assertEqual(list(queue), [trs[2]])
+        self.assertFalse(queue.remove(trs[0]))
+        # Transactions being flushed are not evicted until rescheduled
+        self.assertEqual(queue.pop_due(datetime(2017, 1, 2)), [trs[2]])
+        self.assertEqual(queue.evict(), None)
+        queue.reschedule(trs[2])
+        self.assertEqual(queue.evict(), trs[2])
+        self.assertEqual(queue.evict(), None)
+
+    def test_compaction(self):
+        queue, trs = self._queue(10)
+        for _ in xrange(HEAP_COMPACTION_MIN_SIZE):
+            queue.reschedule(trs[0])
+        self.assertTrue(len(queue._schedule) <= HEAP_COMPACTION_MIN_SIZE)
+        self.assertEqual(queue.pop_due(datetime(2017, 1, 2)), trs)
+
+
+class TestSpill(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _manager(self, max_endpoint_errors=100, circuit_open_delay=CIRCUIT_OPEN_DELAY):
+        store = SpillStore(self.tmpdir, fsync_interval=0.01)
+        store.start()
+        trManager = TransactionManager(timedelta(seconds=0), 100, timedelta(seconds=0),
+                                       max_endpoint_errors=max_endpoint_errors, spill_store=store,
+                                       circuit_open_delay=circuit_open_delay)
+        SpillableTransaction._trManager = trManager
+        return trManager, store
+
+    def _wait(self, condition):
+        for _ in xrange(100):
+            if condition():
+                return
+            time.sleep(0.01)
+
+    def test_spill_and_replay(self):
+        trManager, store = self._manager()
+        for i in xrange(5):
+            trManager.append(SpillableTransaction(30, i))
+        # The queue holds 3 transactions, the 2 evicted ones are on disk
+        self.assertEqual(len(trManager.get_transactions()), 3)
+        self.assertEqual(trManager._transactions_spilled, 2)
+        self._wait(lambda: store.count == 2)
+
+        # Delivering the queue makes room to replay them from the next flush
+        trManager.flush()
+        self.assertEqual(len(trManager.get_transactions()), 0)
+        trManager.flush()
+        self.assertTrue(store._replay_requested)
+        self._wait(lambda: not store._replay_requested)
+        trManager.flush()
+        self.assertEqual(trManager._transactions_unspilled, 2)
+        self.assertEqual(store.count, 0)
+        store.stop()
+
+    def test_in_flight_not_spilled(self):
+        trManager, store = self._manager()
+        trManager.append(SpillableTransaction(60, 0))
+        # The transaction is in flight until its response is handled
+        with mock.patch.object(SpillableTransaction, 'flush'):
+            trManager.flush()
+        in_flight = trManager.get_transactions()[0]
+
+        trManager.append(SpillableTransaction(60, 1))
+        self.assertEqual(trManager._transactions_spilled, 0)
+        self.assertEqual([tr.name for tr in trManager.get_transactions()], [0, 1])
+
+        trManager.tr_success(in_flight)
+        self.assertEqual([tr.name for tr in trManager.get_transactions()], [1])
+        self.assertEqual(trManager._total_size, 60)
+        store.stop()
+
+    def test_replayed_oldest_age(self):
+        trManager, store = self._manager()
+        old = SpillableTransaction(30, 0)
+        old._created_at = time.time() - 600
+        trManager._spill(old)
+        self._wait(lambda: store.count == 1)
+        trManager.append(SpillableTransaction(30, 1))
+        trManager.flush()
+
+        # Replayed after a newer transaction, it's still the oldest one
+        trManager.append(SpillableTransaction(30, 2))
+        with mock.patch.object(SpillableTransaction, 'flush'):
+            trManager.flush()
+            self._wait(lambda: not store._replay_requested)
+            trManager.flush()
+        self.assertEqual([tr.name for tr in trManager.get_transactions()], [2, 0])
+        endpoint = trManager.get_status()['endpoints'][0]
+        self.assertTrue(600 <= endpoint['oldest_age'] < 601)
+        self.assertEqual(len(trManager.get_health_errors(trManager.get_status(), 300)), 1)
+        store.stop()
+
+    def test_spill_failing_transactions(self):
+        trManager, store = self._manager(max_endpoint_errors=1, circuit_open_delay=0)
+        trManager.append(SpillableTransaction(30, 0))
+        # The endpoint stays down past the error limit, its probes don't age
+        # the transaction
+        SpillableTransaction.failing = True
+        try:
+            for _ in xrange(10):
+                trManager.flush()
+            self.assertEqual(len(trManager.get_transactions()), 1)
+            self.assertEqual(trManager._transactions_spilled, 0)
+
+            # The endpoint is back but keeps failing it, it goes to disk
+            probe = SpillableTransaction(30, 1)
+            probe.failing = False
+            probe._next_flush = datetime(1970, 1, 1)
+            trManager.append(probe)
+            trManager.flush()
+        finally:
+            SpillableTransaction.failing = False
+        self.assertEqual(trManager.get_transactions(), [])
+        self.assertEqual(trManager._transactions_spilled, 1)
+        self.assertEqual(trManager._transactions_rejected, 0)
+        self._wait(lambda: store.count == 1)
+
+        # Replayed once it goes through
+        for _ in xrange(10):
+            trManager.flush()
+            self._wait(lambda: not store._replay_requested)
+            if trManager._transactions_flushed == 2:
+                break
+        self.assertEqual(trManager._transactions_unspilled, 1)
+        self.assertEqual(trManager._transactions_flushed, 2)
+        self.assertEqual(trManager.get_transactions(), [])
+        store.stop()
+
+    def test_stop_waits_for_the_store(self):
+        store = SpillStore(self.tmpdir, fsync_interval=0.01, max_pending=1)
+        store.start()
+        trManager = TransactionManager(timedelta(seconds=0), 1000, timedelta(seconds=0), spill_store=store)
+        for i in xrange(20):
+            trManager.append(SpillableTransaction(30, i))
+        # More transactions than the store queues, none is dropped
+        trManager.stop()
+        self.assertEqual(trManager._transactions_spilled, 20)
+        self.assertEqual(store.dropped, 0)
+        self.assertEqual(store.count, 20)
+
+    def test_replay_by_queue(self):
+        trManager, store = self._manager()
+        down = SpillableTransaction(30, 'down')
+        down._endpoint = 'https://down.example.com'
+        trManager.append(down)
+        for i in xrange(4):
+            trManager.append(SpillableTransaction(30, i))
+        trManager._spill(down)
+        self._wait(lambda: store.count == 2)
+        trManager.get_queue(down).breaker.state = CircuitBreaker.OPEN
+
+        with mock.patch.object(store, 'request_replay') as request_replay:
+            trManager._unspill()
+        # Nothing was delivered to example.com yet, and down.example.com is down
+        self.assertEqual(request_replay.call_count, 0)
+        for tr in trManager.get_transactions()[1:3]:
+            trManager.tr_success(tr)
+        with mock.patch.object(store, 'request_replay') as request_replay:
+            trManager._unspill()
+        # Up to the room left in the queue of example.com
+        request_replay.assert_called_once_with(trManager.get_queue(SpillableTransaction(0, 0)).spill_key, 20)
+        store.stop()
+
+    def test_recover_after_restart(self):
+        trManager, store = self._manager()
+        for i in xrange(2):
+            trManager.append(SpillableTransaction(30, i))
+        trManager.stop()
+
+        trManager, store = self._manager()
+        self.assertEqual(store.count, 2)
+        # Nothing is queued, replay from disk right away
+        trManager._unspill()
+        self._wait(lambda: not store._replay_requested)
+        trManager._unspill()
+        self.assertEqual(sorted(tr.name for tr in trManager.get_transactions()), [0, 1])
+        store.stop()
+
+
+class IntakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    hosts = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.hosts.append(self.headers['Host'])
+        code = 413 if self.path.startswith('/too-large') else 202
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class IntakeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestEndpointClient(unittest.TestCase):
+
+    def setUp(self):
+        IntakeHandler.hosts = []
+        self.server = IntakeServer(('127.0.0.1', 0), IntakeHandler)
+        self.port = self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        # Run the callbacks in the client threads, they are queued for the test
+        self.responses = Queue.Queue()
+        self.io_loop = mock.Mock()
+        self.io_loop.add_callback.side_effect = lambda callback, response: callback(response)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _post(self, client, url):
+        client.post(url, 'payload', {'Content-Type': 'application/json'}, 5, self.responses.put)
+        return self.responses.get(timeout=5)
+
+    def test_keep_alive(self):
+        client = EndpointClient('http://127.0.0.1:%s' % self.port, 2, self.io_loop)
+        url = 'http://127.0.0.1:%s/api/v1/series/?api_key=foo' % self.port
+
+        for _ in xrange(3):
+            response = self._post(client, url)
+            self.assertEqual(response.code, 202)
+            self.assertIsNone(response.error)
+        self.assertEqual(client.connection_stats(), (1, 2))
+
+        response = self._post(client, 'http://127.0.0.1:%s/too-large' % self.port)
+        self.assertEqual(response.code, 413)
+        self.assertTrue(response.error)
+
+    def test_dns_caching(self):
+        dns_cache = mock.Mock()
+        dns_cache.resolve.return_value = '127.0.0.1'
+        client = EndpointClient('http://intake.example.com:%s' % self.port, 1, self.io_loop, dns_cache=dns_cache)
+
+        for _ in xrange(2):
+            response = self._post(client, 'http://intake.example.com:%s/intake/' % self.port)
+            self.assertEqual(response.code, 202)
+        # Resolved once per connection, the host name is kept in the requests
+        dns_cache.resolve.assert_called_once_with('intake.example.com')
+        self.assertEqual(IntakeHandler.hosts, ['intake.example.com:%s' % self.port] * 2)
+
+    def test_connection_error(self):
+        self.server.shutdown()
+        self.server.server_close()
+        client = EndpointClient('http://127.0.0.1:%s' % self.port, 1, self.io_loop)
+        response = self._post(client, 'http://127.0.0.1:%s/intake/' % self.port)
+        self.assertEqual(response.code, 599)
+        self.assertTrue(response.error)
+
+    @mock.patch.object(AgentTransaction, '_trManager', mock.Mock(_MAX_CONCURRENCY=1))
+    def test_verify(self):
+        app = mock.Mock(skip_ssl_validation=False, _dns_cache=None, _agentConfig={'ssl_certificate': '/etc/ca.pem'})
+        AgentTransaction.set_application(app)
+        self.assertEqual(AgentTransaction.get_client('https://a.example.com').session.verify, '/etc/ca.pem')
+        # No bundle configured, use the system one
+        app._agentConfig['ssl_certificate'] = None
+        AgentTransaction.set_application(app)
+        self.assertIs(AgentTransaction.get_client('https://a.example.com').session.verify, True)
+        app.skip_ssl_validation = True
+        AgentTransaction.set_application(app)
+        self.assertIs(AgentTransaction.get_client('https://a.example.com').session.verify, False)
+
+
+class RecordingEmitter(object):
+    payloads = Queue.Queue()
+
+    def __call__(self, data, logger, config):
+        self.payloads.put(data)
+
+
+class TestEmitterManager(unittest.TestCase):
+
+    def test_decode_once(self):
+        config = {'custom_emitters': 'first.py, second.py', 'custom_emitters_workers': '1'}
+        with mock.patch('stsagent.modules.load', return_value=RecordingEmitter):
+            manager = EmitterManager(config)
+        manager.send(zlib.compress(json.dumps({'series': []})), {'Content-Encoding': 'deflate'})
+        manager.send('not a payload', {})
+
+        first = RecordingEmitter.payloads.get(timeout=1)
+        second = RecordingEmitter.payloads.get(timeout=1)
+        self.assertEqual(first, {'series': []})
+        # Both emitters get the same decoded payload
+        self.assertIs(first, second)
+        for _ in xrange(100):
+            if manager.decode_errors:
+                break
+            time.sleep(0.01)
+        self.assertEqual(manager.get_stats()['decode_errors'], 1)
+        self.assertEqual(manager.get_stats()['received'], 2)
+
+    def test_drop_when_full(self):
+        config = {'custom_emitters': 'first.py', 'custom_emitters_queue_size': '1'}
+        with mock.patch('stsagent.modules.load', return_value=RecordingEmitter), \
+                mock.patch('threading.Thread.start'):
+            manager = EmitterManager(config)
+        # Nothing decodes the payloads, the second one does not fit
+        manager.send('{}')
+        manager.send('{}')
+        self.assertEqual(manager.dropped, 1)
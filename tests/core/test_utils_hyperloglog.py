@@ -0,0 +1,43 @@
+# stdlib
+from unittest import TestCase
+
+# project
+from utils.hyperloglog import HyperLogLog
+
+
+class TestHyperLogLog(TestCase):
+    def test_count(self):
+        for precision, cardinality in [(14, 10), (14, 100000), (10, 50000)]:
+            hll = HyperLogLog(precision)
+            for i in xrange(cardinality):
+                hll.add('user%s' % i)
+                # Duplicates are not counted
+                hll.add('user%s' % i)
+            error = 3 * 1.04 / (2 ** precision) ** 0.5
+            self.assertTrue(abs(hll.count() - cardinality) <= error * cardinality,
+                            (precision, cardinality, hll.count()))
+            self.assertEqual(len(hll.registers), 2 ** precision)
+
+    def test_values(self):
+        hll = HyperLogLog()
+        for value in ['1', 1, u'\xe9t\xe9', u'\xe9t\xe9'.encode('utf-8')]:
+            hll.add(value)
+        # Values are hashed by their string representation
+        self.assertEqual(hll.count(), 2)
+
+    def test_merge(self):
+        merged = HyperLogLog()
+        exact = HyperLogLog()
+        for i in xrange(4):
+            hll = HyperLogLog()
+            for value in xrange(i * 1000, (i + 2) * 1000):
+                hll.add(value)
+                exact.add(value)
+            merged.merge(hll)
+
+        self.assertEqual(merged.registers, exact.registers)
+        self.assertRaises(ValueError, merged.merge, HyperLogLog(10))
+
+    def test_precision(self):
+        self.assertRaises(ValueError, HyperLogLog, 3)
+        self.assertRaises(ValueError, HyperLogLog, 17)
@@ -1,7 +1,11 @@
 # stdlib
+import os
+import shutil
+import socket
+import tempfile
+import unittest
 from unittest import TestCase
 from mock import MagicMock, patch
-import socket
 from urlparse import urlparse
 from time import sleep
 
@@ -12,10 +16,22 @@ from nose.plugins.skip import SkipTest
 from utils.net import inet_pton, _inet_pton_win
 from utils.net import IPV6_V6ONLY, IPPROTO_IPV6
 from utils.net import DNSCache
+from utils.net import get_udp_socket_stats
 from config import get_url_endpoint
 
 DEFAULT_ENDPOINT = "https://app.datadoghq.com"
 
+PROC_NET_UDP = """\
+   sl  local_address rem_address   st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops
+  123: 0100007F:1FBD 00000000:0000 07 00000000:00000A00 00:00000000 00000000     0        0 20001 2 0000000000000000 5
+  124: 00000000:0035 00000000:0000 07 00000000:00000000 00:00000000 00000000     0        0 20002 2 0000000000000000 7
+"""
+PROC_NET_UDP6 = """\
+  sl  local_address                         remote_address                        st tx_queue rx_queue tr tm->when retrnsmt   uid  timeout inode ref pointer drops
+  200: 00000000000000000000000000000000:1FBD 00000000000000000000000000000000:0000 07 00000000:00000100 00:00000000 00000000     0        0 20003 2 0000000000000000 1
+"""
+
+
 class TestUtilsNet(TestCase):
     DNS_TTL = 3
 
@@ -55,3 +71,40 @@ class TestUtilsNet(TestCase):
         location = urlparse(endpoint)
         ip = cache.resolve(location.netloc)
         self.assertNotEqual(ip, location.netloc)
+
+
+class TestUdpSocketStats(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.tmpdir, 'udp'), os.path.join(self.tmpdir, 'udp6')]
+        for path, content in zip(self.paths, [PROC_NET_UDP, PROC_NET_UDP6]):
+            with open(path, 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_udp_socket_stats(self):
+        # Summed over the IPv4 and IPv6 sockets bound to the port
+        self.assertEqual(get_udp_socket_stats(8125, paths=self.paths), (0xA00 + 0x100, 6))
+        self.assertEqual(get_udp_socket_stats(53, paths=self.paths), (0, 7))
+        self.assertEqual(get_udp_socket_stats(8126, paths=self.paths), None)
+        self.assertEqual(get_udp_socket_stats(8125, paths=[os.path.join(self.tmpdir, 'missing')]), None)
+
+    def test_udp_socket_stats_by_inode(self):
+        self.assertEqual(get_udp_socket_stats(inode=20003, paths=self.paths), (0x100, 1))
+        self.assertEqual(get_udp_socket_stats(inode=20004, paths=self.paths), None)
+
+    @unittest.skipIf(not os.path.exists('/proc/net/udp'), "/proc/net/udp is only available on Linux")
+    def test_live_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.sendto('metric:1|c', sock.getsockname())
+        try:
+            rx_queue, drops = get_udp_socket_stats(inode=os.fstat(sock.fileno()).st_ino)
+            self.assertTrue(rx_queue > 0)
+            self.assertEqual(drops, 0)
+        finally:
+            sock.close()
+            client.close()
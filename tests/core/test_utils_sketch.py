@@ -0,0 +1,75 @@
+# stdlib
+import random
+from unittest import TestCase
+
+# project
+from utils.sketch import QuantileSketch
+
+
+class TestQuantileSketch(TestCase):
+    def assert_relative_error(self, value, expected, relative_accuracy):
+        self.assertTrue(abs(value - expected) <= relative_accuracy * abs(expected),
+                        "%s is not within %s of %s" % (value, relative_accuracy, expected))
+
+    def test_accuracy(self):
+        random.seed(42)
+        values = [random.lognormvariate(0, 2) * random.choice([-1, 1]) for _ in xrange(10000)] + [0] * 100
+        sketch = QuantileSketch(0.02)
+        for value in values:
+            sketch.add(value)
+        values.sort()
+
+        self.assertEqual(sketch.count, len(values))
+        self.assertEqual(sketch.min, values[0])
+        self.assertEqual(sketch.max, values[-1])
+        self.assertAlmostEqual(sketch.sum, sum(values))
+        for rank in [1, 100, 2500, 4999, 5000, 5049, 5100, 7500, 9900, len(values) - 2]:
+            self.assert_relative_error(sketch.value_at_rank(rank), values[rank], 0.02)
+        self.assertEqual(sketch.value_at_rank(-1), values[-1])
+        self.assert_relative_error(sketch.quantile(0.99), values[int(round(0.99 * (len(values) - 1)))], 0.02)
+        # Far fewer bins than values
+        self.assertTrue(len(sketch.positive) + len(sketch.negative) < 1000)
+
+    def test_merge(self):
+        merged = QuantileSketch()
+        exact = QuantileSketch()
+        for i in xrange(4):
+            sketch = QuantileSketch()
+            for value in xrange(i * 100 + 1, (i + 1) * 100 + 1):
+                sketch.add(value)
+                exact.add(value)
+            merged.merge(sketch)
+
+        self.assertEqual(merged.positive, exact.positive)
+        self.assertEqual((merged.count, merged.sum, merged.min, merged.max), (400, 80200, 1, 400))
+        self.assertRaises(ValueError, merged.merge, QuantileSketch(0.05))
+
+    def test_max_bins(self):
+        sketch = QuantileSketch(0.01, max_bins=10)
+        for exponent in xrange(-5, 15):
+            sketch.add(-10 ** exponent)
+            sketch.add(10 ** exponent)
+
+        self.assertEqual(len(sketch.positive) + len(sketch.negative), 10)
+        self.assertEqual(sketch.count, 40)
+        # The lowest values are collapsed, the highest ones stay accurate
+        self.assert_relative_error(sketch.value_at_rank(38), 10 ** 13, 0.01)
+        self.assertEqual(sketch.min, -10 ** 14)
+
+    def test_serialization(self):
+        sketch = QuantileSketch()
+        for value in [-3, 0, 1, 2, 2, 1000]:
+            sketch.add(value)
+        sketch.add(5, 10)
+
+        data = sketch.to_dict()
+        self.assertEqual(data['count'], 16)
+        self.assertEqual(data['sum'], 1052)
+        self.assertEqual(data['zeros'], 1)
+        self.assertEqual(len(data['bins'][0]), len(data['bins'][1]))
+        self.assertEqual(data['bins'][0], sorted(data['bins'][0]))
+
+        copy = QuantileSketch.from_dict(data)
+        self.assertEqual(copy.positive, sketch.positive)
+        self.assertEqual(copy.negative, sketch.negative)
+        self.assertEqual(copy.value_at_rank(8), sketch.value_at_rank(8))
@@ -0,0 +1,142 @@
+# stdlib
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+# project
+from utils.spill import NEWEST_FIRST, RECORD_HEADER, SpillStore
+
+
+class TestSpillStore(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'spill')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _store(self, **kwargs):
+        kwargs.setdefault('segment_size', 100)
+        kwargs.setdefault('fsync_interval', 0.01)
+        store = SpillStore(self.path, **kwargs)
+        store.start()
+        return store
+
+    def _replay(self, store, max_bytes=1000000, key='a'):
+        store.request_replay(key, max_bytes)
+        for _ in xrange(100):
+            if not store._replay_requested:
+                break
+            time.sleep(0.01)
+        return store.get_replayed()
+
+    def _fill(self, store, count, key='a'):
+        for i in xrange(count):
+            self.assertTrue(store.put(key, 'record-%02d' % i + 'x' * 20))
+        # Wait for the background thread to write them
+        for _ in xrange(100):
+            if store.counts.get(key) == count:
+                break
+            time.sleep(0.01)
+
+    def test_replay_oldest_first(self):
+        store = self._store()
+        self._fill(store, 10)
+        self.assertEqual(store.count, 10)
+        # Segments of 100 bytes, 3 records each
+        self.assertEqual(len(os.listdir(self.path)), 4)
+
+        records = self._replay(store, max_bytes=1)
+        self.assertEqual([r[:9] for r in records], ['record-00', 'record-01', 'record-02'])
+        records = self._replay(store)
+        self.assertEqual([r[:9] for r in records], ['record-%02d' % i for i in xrange(3, 10)])
+        self.assertEqual(store.count, 0)
+        self.assertEqual(store.size, 0)
+        store.commit_replayed()
+        store.stop()
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_replay_newest_first(self):
+        store = self._store(replay_policy=NEWEST_FIRST)
+        self._fill(store, 5)
+        records = self._replay(store, max_bytes=1)
+        self.assertEqual([r[:9] for r in records], ['record-04', 'record-03'])
+        store.stop()
+
+    def test_recovery(self):
+        store = self._store()
+        self._fill(store, 4)
+        store.stop()
+
+        # A crash cut the last record
+        last = sorted(os.listdir(self.path))[-1]
+        with open(os.path.join(self.path, last), 'ab') as f:
+            f.write(RECORD_HEADER.pack(100, time.time()) + 'cut')
+
+        store = self._store()
+        self.assertEqual(store.count, 4)
+        records = self._replay(store)
+        self.assertEqual([r[:9] for r in records], ['record-%02d' % i for i in xrange(4)])
+        store.stop()
+
+    def test_replayed_kept_until_committed(self):
+        store = self._store()
+        self._fill(store, 4)
+        self.assertEqual(len(self._replay(store)), 4)
+        # Stopped before the records are committed: their segments are kept
+        store.stop()
+
+        store = self._store()
+        self.assertEqual(store.count, 4)
+        records = self._replay(store)
+        self.assertEqual([r[:9] for r in records], ['record-%02d' % i for i in xrange(4)])
+        store.commit_replayed()
+        store.stop()
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_keys(self):
+        store = self._store()
+        self._fill(store, 2, key='a')
+        self._fill(store, 3, key='b')
+        self.assertEqual(store.counts, {'a': 2, 'b': 3})
+        # Each key is replayed on its own
+        self.assertEqual(len(self._replay(store, key='b')), 3)
+        self.assertEqual(store.counts, {'a': 2})
+        store.stop()
+
+        # The records of b were not committed
+        store = self._store()
+        self.assertEqual(store.counts, {'a': 2, 'b': 3})
+        self.assertEqual([r[:9] for r in self._replay(store, key='a')], ['record-00', 'record-01'])
+        store.commit_replayed()
+        store.stop()
+
+    def test_size_cap(self):
+        store = self._store(max_size=250)
+        self._fill(store, 7)
+        for _ in xrange(100):
+            if store.size <= 250:
+                break
+            time.sleep(0.01)
+        # The oldest segments are dropped
+        self.assertTrue(store.size <= 250)
+        self.assertEqual(store.expired, 3)
+        records = self._replay(store)
+        self.assertEqual(records[0][:9], 'record-03')
+        store.stop()
+
+    def test_age_cap(self):
+        store = self._store()
+        self._fill(store, 3)
+        store.stop()
+
+        store = self._store(max_age=0)
+        self.assertEqual(store.count, 0)
+        self.assertEqual(store.expired, 3)
+        self.assertEqual(self._replay(store), [])
+        store.stop()
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, SpillStore, self.path, replay_policy='random')
@@ -1,9 +1,15 @@
 
 # stdlib
+import bisect
+from collections import deque, OrderedDict
+import cPickle as pickle
 from datetime import datetime, timedelta
+import hashlib
+import heapq
 import logging
-from operator import attrgetter
+from Queue import Queue
 import sys
+import threading
 import time
 
 # 3rd party
@@ -17,15 +23,62 @@ log = logging.getLogger(__name__)
 
 FLUSH_LOGGING_PERIOD = 20
 FLUSH_LOGGING_INITIAL = 5
+# The heaps of a TransactionQueue are rebuilt when they hold this many times
+# more entries than queued transactions
+HEAP_COMPACTION_RATIO = 2
+HEAP_COMPACTION_MIN_SIZE = 1024
+EPOCH = datetime(1970, 1, 1)
+
+# Adaptive concurrency of the endpoints: the limit of requests in flight grows
+# by about one for each window of successful requests, and is multiplied by
+# DECREASE_FACTOR on errors caused by the load of the endpoint
+DEFAULT_MAX_CONCURRENCY = 16
+DECREASE_FACTOR = 0.5
+# Response codes of an overloaded endpoint, along with the 5xx. 599 is a
+# timeout or a connection error
+CONGESTION_CODES = frozenset([429, 599])
+# A request slower than this many times the fastest one seen, plus the slack
+# in seconds, means the endpoint is saturated and the limit stops growing
+LATENCY_TOLERANCE = 3
+LATENCY_SLACK = 0.1
+LATENCY_EWMA_WEIGHT = 0.2
+# Longest time an endpoint is left alone after consecutive errors, in seconds
+MAX_ENDPOINT_BACKOFF = 60
+# Seconds the circuit of a failing endpoint stays open before a probe request
+# is let through, doubled by each failed probe
+CIRCUIT_OPEN_DELAY = 10
+MAX_CIRCUIT_OPEN_DELAY = 5 * 60
+# Upper bounds in seconds of the buckets of the enqueue-to-success latency
+# histograms, from 10ms to about 3 hours
+LATENCY_BUCKETS = [0.01 * 2 ** i for i in xrange(21)]
+# Throughput is measured over this many seconds, counted in this many slots
+THROUGHPUT_WINDOW = 60
+THROUGHPUT_SLOTS = 12
+# Response code of a batch too large for the intake, it is split in halves
+REQUEST_TOO_LARGE = 413
+# Seconds the queued transactions wait for room in the spill store when the
+# forwarder stops
+SPILL_STOP_TIMEOUT = 30
 
 class Transaction(object):
 
+    # Set by the transactions sent to an intake, they are queued by endpoint
+    # and API key
+    _endpoint = None
+    _api_key = None
+    # Transactions sent by a batch transaction, see `merge`
+    _batch = None
+    _created_at = None
+
     def __init__(self):
 
         self._id = None
         self._error_count = 0
         self._next_flush = datetime.utcnow()
         self._size = None
+        # Time of the last flush, to measure the latency of the endpoint
+        self._sent_at = None
+        self._created_at = time.time()
 
     def get_id(self):
         return self._id
@@ -65,22 +118,470 @@ class Transaction(object):
     def flush(self):
         raise NotImplementedError("To be implemented in a subclass")
 
+    def get_batch_key(self):
+        """
+        Transactions to flush with the same endpoint, API key and batch key
+        are merged into a single request. None if this one can't be.
+        """
+        return None
+
+    def merge(self, transactions):
+        """
+        Return a batch transaction sending this transaction and others of
+        `transactions`, its `_batch` lists the ones it sends. Called from the
+        thread of a `BatchMerger`, it must not change `transactions`.
+        """
+        raise NotImplementedError("To be implemented in a subclass")
+
+    def get_members(self):
+        return self._batch if self._batch is not None else [self]
+
+class EndpointThrottle(object):
+    """
+    AIMD controller of the requests in flight to an endpoint.
+
+    Successful requests raise the limit additively while their latency stays
+    close to the fastest seen. 5xx, timeouts and 429 divide it, once for the
+    requests sent before the previous decrease. Every error blocks the endpoint
+    for an exponential backoff, or the Retry-After of a 429 if it's longer.
+    """
+
+    def __init__(self, initial_limit=1, max_limit=DEFAULT_MAX_CONCURRENCY, backoff_delay=0):
+        self.limit = float(initial_limit)
+        self.max_limit = max(max_limit, initial_limit)
+        self.backoff_delay = backoff_delay
+        self.in_flight = 0
+        self.consecutive_errors = 0
+        self.blocked_until = 0
+        self.last_decrease = 0
+        self.min_latency = None
+        self.latency = None
+        self.successes = 0
+        self.errors = 0
+
+    def available(self, now):
+        return now >= self.blocked_until and self.in_flight < int(self.limit)
+
+    def on_send(self):
+        self.in_flight += 1
+
+    def on_success(self, latency):
+        self.in_flight -= 1
+        self.successes += 1
+        self.consecutive_errors = 0
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_EWMA_WEIGHT * (latency - self.latency)
+        if latency <= LATENCY_TOLERANCE * self.min_latency + LATENCY_SLACK:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_error(self, sent_at, now, retry_after=None, congested=True):
+        self.in_flight -= 1
+        self.errors += 1
+        self.consecutive_errors += 1
+        # The requests in flight when the limit was lowered do not lower it again
+        if congested and sent_at >= self.last_decrease:
+            self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+            self.last_decrease = now
+        delay = min(self.backoff_delay * 2 ** (self.consecutive_errors - 1), MAX_ENDPOINT_BACKOFF)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        self.blocked_until = max(self.blocked_until, now + delay)
+
+    def on_reject(self):
+        # The intake refused the payload itself, nothing to learn about its load
+        self.in_flight -= 1
+
+    def to_dict(self, now):
+        return {
+            'limit': round(self.limit, 2),
+            'in_flight': self.in_flight,
+            'blocked_for': round(max(self.blocked_until - now, 0), 2),
+            'latency': round(self.latency, 3) if self.latency is not None else None,
+            'successes': self.successes,
+            'errors': self.errors,
+        }
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker of an endpoint.
+
+    `failure_threshold` consecutive failures open it: nothing is sent to the
+    endpoint for `open_delay` seconds. It's half-open then and lets a single
+    probe request through, whose success closes it and whose failure opens it
+    again for twice as long, up to `max_open_delay`.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold, open_delay=CIRCUIT_OPEN_DELAY, max_open_delay=MAX_CIRCUIT_OPEN_DELAY):
+        self.failure_threshold = failure_threshold
+        self.open_delay = open_delay
+        self.max_open_delay = max(max_open_delay, open_delay)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.delay = open_delay
+        self.open_until = 0
+        self.probing = False
+        self.opened = 0
+
+    def is_open(self, now):
+        if self.state == self.OPEN and now >= self.open_until:
+            self.state = self.HALF_OPEN
+            self.probing = False
+        return self.state == self.OPEN
+
+    def available(self, now):
+        if self.is_open(now):
+            return False
+        return self.state == self.CLOSED or not self.probing
+
+    def on_send(self):
+        if self.state == self.HALF_OPEN:
+            self.probing = True
+
+    def on_success(self):
+        """
+        Return True if the success closed the circuit.
+        """
+        closed = self.state != self.CLOSED
+        self.state = self.CLOSED
+        self.failures = 0
+        self.delay = self.open_delay
+        self.probing = False
+        return closed
+
+    def on_failure(self, now):
+        """
+        Return True if the failure opened the circuit.
+        """
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self.delay = min(self.delay * 2, self.max_open_delay)
+        elif self.state == self.OPEN or self.failures < self.failure_threshold:
+            return False
+        self.state = self.OPEN
+        self.open_until = now + self.delay
+        self.probing = False
+        self.opened += 1
+        return True
+
+    def to_dict(self, now):
+        self.is_open(now)
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'open_for': round(max(self.open_until - now, 0), 2) if self.state == self.OPEN else 0,
+            'opened': self.opened,
+        }
+
+
+class EndpointQueue(object):
+    """
+    Transactions of an endpoint and API key, with their own memory budget,
+    throttle and circuit breaker so that a failing endpoint never holds back
+    the others.
+    """
+
+    def __init__(self, endpoint, api_key, max_size, throttle, breaker):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.max_size = max_size
+        self.throttle = throttle
+        self.breaker = breaker
+        self.transactions = TransactionQueue()
+        self.size = 0
+        # Name of the transactions of the queue in the spill store
+        self.spill_key = hashlib.md5('%s %s' % (endpoint, api_key)).hexdigest()
+        self.delivered_since_unspill = False
+        # Delivery statistics
+        self.latency = LatencyHistogram()
+        self.throughput = ThroughputCounter()
+        self.delivered = 0
+        self.retries = 0
+
+    def __str__(self):
+        if self.api_key:
+            return '%s (API key ...%s)' % (self.endpoint, self.api_key[-5:])
+        return str(self.endpoint)
+
+    def available(self, now):
+        return self.breaker.available(now) and self.throttle.available(now)
+
+
+class LatencyHistogram(object):
+    """
+    Counts of values in fixed buckets, whose percentiles are the upper bound
+    of the bucket they fall in. Adding a value and reading a percentile don't
+    depend on the number of values.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # The last bucket holds the values above the last bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= rank:
+                if i == len(self.bounds):
+                    return self.max
+                return min(self.bounds[i], self.max)
+        return self.max
+
+
+class ThroughputCounter(object):
+    """
+    Transactions and bytes counted over the last `window` seconds, in slots
+    rotated as time goes by.
+    """
+
+    def __init__(self, window=THROUGHPUT_WINDOW, slots=THROUGHPUT_SLOTS):
+        self.window = window
+        self.slot_duration = float(window) / slots
+        self._slots = deque([[0, 0] for _ in xrange(slots)], slots)
+        self._current = 0
+
+    def _rotate(self, now):
+        current = int(now / self.slot_duration)
+        for _ in xrange(min(current - self._current, len(self._slots))):
+            self._slots.append([0, 0])
+        self._current = max(current, self._current)
+
+    def add(self, count, size, now):
+        self._rotate(now)
+        self._slots[-1][0] += count
+        self._slots[-1][1] += size
+
+    def rates(self, now):
+        """
+        Return the transactions and bytes per second over the window.
+        """
+        self._rotate(now)
+        return (sum(slot[0] for slot in self._slots) / float(self.window),
+                sum(slot[1] for slot in self._slots) / float(self.window))
+
+
+class TransactionQueue(object):
+    """
+    Queued transactions, in the order they were appended, indexed by two
+    heaps so that no operation scans the queue:
+    - the schedule, by next flush, holds the transactions waiting for their
+      next flush; `pop_due` takes them out of it until they are rescheduled;
+    - the evictions, by latest next flush then oldest, holds every queued
+      transaction, failing ones are evicted first when the queue is full;
+    - the ages, by creation time, holds every queued transaction: those
+      replayed from disk are appended last but may be the oldest.
+
+    Entries are not removed from the heaps, a transaction that is removed or
+    rescheduled invalidates them instead and they are skipped when popped.
+    """
+
+    def __init__(self):
+        self._transactions = OrderedDict()
+        # Current heap entries of the transactions, by id
+        self._scheduled = {}
+        self._evictable = {}
+        self._schedule = []
+        self._evictions = []
+        self._ages = []
+
+    def __len__(self):
+        return len(self._transactions)
+
+    def __iter__(self):
+        return self._transactions.itervalues()
+
+    def __contains__(self, tr):
+        return tr.get_id() in self._transactions
+
+    def oldest(self):
+        """
+        The queued transaction created first, None if the queue is empty or
+        none has a creation time.
+        """
+        ages = self._ages
+        while ages:
+            tr = self._transactions.get(ages[0][1])
+            if tr is not None:
+                return tr
+            heapq.heappop(ages)
+        return None
+
+    def append(self, tr):
+        tr_id = tr.get_id()
+        self._transactions[tr_id] = tr
+        # Created once, removing the transaction is enough to invalidate it
+        if tr._created_at is not None:
+            heapq.heappush(self._ages, (tr._created_at, tr_id))
+        self.reschedule(tr)
+
+    def remove(self, tr):
+        """
+        Remove a transaction, return False if it was not queued.
+        """
+        tr_id = tr.get_id()
+        if self._transactions.pop(tr_id, None) is None:
+            return False
+        self._scheduled.pop(tr_id, None)
+        self._evictable.pop(tr_id, None)
+        return True
+
+    def reschedule(self, tr):
+        """
+        Index a queued transaction by its current next flush.
+        """
+        tr_id = tr.get_id()
+        if tr_id not in self._transactions:
+            return
+        next_flush = tr.get_next_flush()
+        entry = (next_flush, tr_id)
+        self._scheduled[tr_id] = entry
+        heapq.heappush(self._schedule, entry)
+        eviction = (-(next_flush - EPOCH).total_seconds(), tr_id)
+        self._evictable[tr_id] = eviction
+        heapq.heappush(self._evictions, eviction)
+        self._compact()
+
+    def pop_due(self, now):
+        """
+        Take the transactions to flush at `now` out of the schedule. They
+        can't be evicted either until they are rescheduled: they are being
+        flushed, and would be delivered twice if they were spilled.
+        """
+        due = []
+        schedule = self._schedule
+        while schedule and schedule[0][0] <= now:
+            entry = heapq.heappop(schedule)
+            tr_id = entry[1]
+            if self._scheduled.get(tr_id) is entry:
+                del self._scheduled[tr_id]
+                del self._evictable[tr_id]
+                due.append(self._transactions[tr_id])
+        return due
+
+    def evict(self):
+        """
+        Remove and return the next transaction to drop when the queue is full,
+        None if every transaction is being flushed.
+        """
+        evictions = self._evictions
+        while evictions:
+            entry = heapq.heappop(evictions)
+            tr_id = entry[1]
+            if self._evictable.get(tr_id) is entry:
+                tr = self._transactions[tr_id]
+                self.remove(tr)
+                return tr
+        return None
+
+    def _compact(self):
+        max_size = max(HEAP_COMPACTION_MIN_SIZE, HEAP_COMPACTION_RATIO * len(self._transactions))
+        if len(self._schedule) > max_size:
+            self._schedule = self._scheduled.values()
+            heapq.heapify(self._schedule)
+        if len(self._evictions) > max_size:
+            self._evictions = self._evictable.values()
+            heapq.heapify(self._evictions)
+        if len(self._ages) > max_size:
+            self._ages = [(tr._created_at, tr_id) for tr_id, tr in self._transactions.iteritems()
+                          if tr._created_at is not None]
+            heapq.heapify(self._ages)
+
+
+def merge_batch(members):
+    """
+    Merge `members` into a batch transaction, the first one on its own
+    if they can't be.
+    """
+    try:
+        batch = members[0].merge(members)
+    except Exception:
+        log.exception("Unable to merge %s transactions into a batch", len(members))
+        return members[0]
+    if batch._batch is not None:
+        log.debug("Merged %s transactions into batch %d (%s KB)",
+                  len(batch._batch), batch.get_id(), batch.get_size() / 1024)
+    return batch
+
+
+class BatchMerger(object):
+    """
+    Thread merging batches off the IOLoop, merging reads and compresses their
+    payloads again. Each batch is handed back to the IOLoop of its request.
+    """
+
+    def __init__(self):
+        self._requests = Queue()
+        self._thread = None
+
+    def merge(self, members, io_loop, callback):
+        """
+        Merge `members` with `merge_batch`, then call `callback(members, batch)`
+        on `io_loop`.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='BatchMerger')
+            self._thread.daemon = True
+            self._thread.start()
+        self._requests.put((members, io_loop, callback))
+
+    def _run(self):
+        while True:
+            members, io_loop, callback = self._requests.get()
+            io_loop.add_callback(callback, members, merge_batch(members))
+
+
 class TransactionManager(object):
     """Holds any transaction derived object list and make sure they
-       are all commited, without exceeding parameters (throttling, memory consumption) """
+       are all commited, without exceeding parameters (throttling, memory consumption)
+
+       Transactions are queued by endpoint and API key: each queue gets
+       `max_queue_size` bytes, and a circuit breaker that opens after
+       `max_endpoint_errors` consecutive errors. A transaction failing more
+       than `max_endpoint_errors` times while its circuit is closed is spilled
+       to disk, or dropped."""
 
     def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay,
-                 max_parallelism=1, max_endpoint_errors=4):
+                 max_parallelism=1, max_endpoint_errors=4, spill_store=None,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, circuit_open_delay=CIRCUIT_OPEN_DELAY,
+                 max_batch_size=0):
         self._MAX_WAIT_FOR_REPLAY = max_wait_for_replay
+        # By endpoint and API key
         self._MAX_QUEUE_SIZE = max_queue_size
         self._THROTTLING_DELAY = throttling_delay
+        # Initial and maximum requests in flight to each endpoint
         self._MAX_PARALLELISM = max_parallelism
+        self._MAX_CONCURRENCY = max(max_concurrency, max_parallelism)
         self._MAX_ENDPOINT_ERRORS = max_endpoint_errors
+        self._CIRCUIT_OPEN_DELAY = circuit_open_delay
+        # Transactions are merged into batches of at most this many bytes, 0 to
+        # send each transaction on its own
+        self._MAX_BATCH_SIZE = max_batch_size
         self._MAX_FLUSH_DURATION = timedelta(seconds=10)
 
         self._flush_without_ioloop = False # useful for tests
 
-        self._transactions = []  # List of all non commited transactions
+        self._queues = {}  # Non commited transactions, by endpoint and API key
         self._total_count = 0  # Maintain size/count not to recompute it everytime
         self._total_size = 0
         self._flush_count = 0
@@ -95,17 +596,117 @@ class TransactionManager(object):
         self._counter = 0
 
         self._trs_to_flush = None # Current transactions being flushed
-        self._last_flush = datetime.utcnow() # Last flush (for throttling)
+        self._flush_next_scheduled = False
+        # Members of the batches to flush again after a rejection, by id of
+        # the first one, the only one in the transactions to flush
+        self._batch_groups = {}
+        self._merger = BatchMerger()
 
         # Error management
-        self._endpoints_errors = {}
         self._finished_flushes = 0
 
+        # Transactions evicted from memory are spilled to disk, and replayed
+        # once the intake accepts transactions again
+        self._spill_store = spill_store
+        self._transactions_spilled = 0
+        self._transactions_unspilled = 0
+        self._spill_queues = {}  # by spill key
+
+        # Returns the (opened, reused) counts of the connections to the endpoints
+        self._connection_stats = None
+
         # Track an initial status message.
-        ForwarderStatus().persist()
+        ForwarderStatus().publish()
+
+    def set_connection_stats(self, connection_stats):
+        self._connection_stats = connection_stats
+
+    def _persist_status(self):
+        connections_opened, connections_reused = 0, 0
+        if self._connection_stats is not None:
+            connections_opened, connections_reused = self._connection_stats()
+        ForwarderStatus(
+            queue_length=self._total_count,
+            queue_size=self._total_size,
+            flush_count=self._flush_count,
+            transactions_received=self._transactions_received,
+            transactions_flushed=self._transactions_flushed,
+            transactions_rejected=self._transactions_rejected,
+            connections_opened=connections_opened,
+            connections_reused=connections_reused).publish()
 
     def get_transactions(self):
-        return self._transactions
+        transactions = []
+        for queue in self._queues.itervalues():
+            transactions.extend(queue.transactions)
+        transactions.sort(key=lambda tr: tr._id)
+        return transactions
+
+    def get_queue(self, tr):
+        key = (tr._endpoint, tr._api_key)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = EndpointQueue(
+                tr._endpoint, tr._api_key, self._MAX_QUEUE_SIZE,
+                EndpointThrottle(self._MAX_PARALLELISM, self._MAX_CONCURRENCY,
+                                 self._THROTTLING_DELAY.total_seconds()),
+                CircuitBreaker(self._MAX_ENDPOINT_ERRORS, self._CIRCUIT_OPEN_DELAY))
+            self._queues[key] = queue
+            self._spill_queues[queue.spill_key] = queue
+        return queue
+
+    def get_queues(self):
+        return sorted(self._queues.itervalues(), key=lambda queue: (queue.endpoint, queue.api_key))
+
+    def get_status(self, now=None):
+        """
+        Aggregated state of the queues, whose cost does not depend on the
+        number of queued transactions.
+        """
+        now = now or time.time()
+        endpoints = []
+        for queue in self.get_queues():
+            oldest = queue.transactions.oldest()
+            transactions_per_second, bytes_per_second = queue.throughput.rates(now)
+            endpoints.append({
+                'endpoint': str(queue),
+                'queue_length': len(queue.transactions),
+                'queue_size': queue.size,
+                'oldest_age': round(now - oldest._created_at, 3)
+                if oldest is not None and oldest._created_at is not None else None,
+                'latency': dict(('p%s' % int(p * 100), queue.latency.percentile(p)) for p in (0.5, 0.9, 0.99)),
+                'delivered': queue.delivered,
+                'retries': queue.retries,
+                'transactions_per_second': round(transactions_per_second, 3),
+                'bytes_per_second': round(bytes_per_second, 1),
+                'circuit': queue.breaker.to_dict(now),
+                'throttle': queue.throttle.to_dict(now),
+            })
+        return {
+            'queue_length': self._total_count,
+            'queue_size': self._total_size,
+            'transactions_received': self._transactions_received,
+            'transactions_flushed': self._transactions_flushed,
+            'transactions_rejected': self._transactions_rejected,
+            'transactions_spilled': self._transactions_spilled,
+            'transactions_unspilled': self._transactions_unspilled,
+            'flush_count': self._flush_count,
+            'endpoints': endpoints,
+        }
+
+    def get_health_errors(self, status, max_age):
+        """
+        Reasons why the forwarder is unhealthy, from its `get_status`: an
+        endpoint whose circuit is open, or whose oldest transaction has been
+        queued for more than `max_age` seconds.
+        """
+        errors = []
+        for endpoint in status['endpoints']:
+            if endpoint['circuit']['state'] == CircuitBreaker.OPEN:
+                errors.append("circuit of %s is open" % endpoint['endpoint'])
+            if endpoint['oldest_age'] is not None and endpoint['oldest_age'] > max_age:
+                errors.append("oldest transaction of %s is %ss old" % (endpoint['endpoint'], int(endpoint['oldest_age'])))
+        return errors
 
     def print_queue_stats(self):
         log.debug("Queue size: at %s, %s transaction(s), %s KB" %
@@ -116,6 +717,10 @@ class TransactionManager(object):
         return self._counter
 
     def append(self,tr):
+        self._enqueue(tr)
+        self._transactions_received += 1
+
+    def _enqueue(self, tr):
 
         # Give the transaction an id
         tr.set_id(self.get_tr_id())
@@ -123,21 +728,30 @@ class TransactionManager(object):
         # Check the size
         tr_size = tr.get_size()
 
+        queue = self.get_queue(tr)
         log.debug("New transaction to add, total size of queue would be: %s KB" %
-            ((self._total_size + tr_size) / 1024))
-
-        if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-            log.warn("Queue is too big, removing old transactions...")
-            new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
-            for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-                    self._remove(tr2)
+            ((queue.size + tr_size) / 1024))
+
+        # Only the transactions of the same endpoint make room for it
+        if (queue.size + tr_size) > queue.max_size:
+            log.warn("Queue of %s is too big, removing old transactions...", queue)
+            while (queue.size + tr_size) > queue.max_size:
+                tr2 = queue.transactions.evict()
+                if tr2 is None:
+                    # The others are being flushed, they leave the queue soon
+                    break
+                queue.size -= tr2.get_size()
+                self._total_count -= 1
+                self._total_size -= tr2.get_size()
+                if self._spill(tr2):
+                    log.warn("Moved transaction %s from queue to disk" % tr2.get_id())
+                else:
                     log.warn("Removed transaction %s from queue" % tr2.get_id())
 
         # Done
-        self._transactions.append(tr)
+        queue.transactions.append(tr)
+        queue.size += tr_size
         self._total_count += 1
-        self._transactions_received += 1
         self._total_size = self._total_size + tr_size
 
         log.debug("Transaction %s added" % (tr.get_id()))
@@ -145,27 +759,115 @@ class TransactionManager(object):
 
     def _remove(self, tr):
         '''Safely remove transaction from list'''
-        try:
-            self._transactions.remove(tr)
-        except ValueError:
-            # Should not happen if we order the queue consistently, but we should catch the error anyway
-            log.warn("Tried to remove transaction %s from queue but it was not in the queue anymore.", tr.get_id())
-        else:
+        queue = self.get_queue(tr)
+        if queue.transactions.remove(tr):
+            queue.size -= tr.get_size()
             self._total_count -= 1
             self._total_size -= tr.get_size()
+        else:
+            # The transaction was evicted while it was being flushed
+            log.warn("Tried to remove transaction %s from queue but it was not in the queue anymore.", tr.get_id())
+
+    def _spill(self, tr, timeout=None):
+        """
+        Write a transaction to the spill store, return False if it was dropped.
+        Waits up to `timeout` seconds for the store to take it.
+        """
+        if self._spill_store is None:
+            return False
+        try:
+            record = pickle.dumps(tr, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            log.exception("Unable to spill transaction %s to disk", tr.get_id())
+            return False
+        if not self._spill_store.put(self.get_queue(tr).spill_key, record, timeout):
+            log.warn("Spill store is busy, dropping transaction %s", tr.get_id())
+            return False
+        self._transactions_spilled += 1
+        return True
+
+    def _unspill(self):
+        """
+        Queue again the transactions read back from disk, and ask for more
+        for each queue whose circuit is closed, while its transactions get
+        delivered and it has room for them. An empty queue whose circuit is
+        half-open gets a single segment, to probe its endpoint with.
+        """
+        if self._spill_store is None:
+            return
+        for record in self._spill_store.get_replayed():
+            try:
+                tr = pickle.loads(record)
+            except Exception:
+                log.exception("Unable to load a transaction spilled to disk, dropping it")
+                continue
+            tr._id = None
+            tr._next_flush = datetime.utcnow()
+            # The endpoint is back, or being probed
+            tr._error_count = 0
+            self._enqueue(tr)
+            self._transactions_unspilled += 1
+        self._spill_store.commit_replayed()
+
+        for spill_key in self._spill_store.counts.keys():
+            queue = self._spill_queues.get(spill_key)
+            if queue is None:
+                # Spilled before a restart, nothing is queued for it yet
+                self._spill_store.request_replay(spill_key, self._MAX_QUEUE_SIZE / 2)
+                continue
+            if queue.breaker.is_open(time.time()):
+                continue
+            if queue.breaker.state == CircuitBreaker.HALF_OPEN:
+                # Nothing else would close the circuit
+                if not queue.transactions:
+                    self._spill_store.request_replay(spill_key, 1)
+                continue
+            if queue.delivered_since_unspill or not queue.transactions:
+                self._spill_store.request_replay(spill_key, queue.max_size / 2 - queue.size)
+            queue.delivered_since_unspill = False
+
+    def stop(self):
+        """
+        Spill the queued transactions so that a restart replays them.
+        """
+        if self._spill_store is None:
+            return
+        spilled, dropped = 0, 0
+        deadline = time.time() + SPILL_STOP_TIMEOUT
+        for tr in self.get_transactions():
+            # Wait for the store to write the backlog rather than drop it
+            if self._spill(tr, timeout=max(deadline - time.time(), 0)):
+                spilled += 1
+            else:
+                dropped += 1
+        log.info("Spilled %s queued transaction%s to disk", spilled, plural(spilled))
+        if dropped:
+            log.warn("Dropped %s queued transaction%s the spill store could not take", dropped, plural(dropped))
+        # The replayed transactions were spilled again with the others
+        self._spill_store.commit_replayed(block=True)
+        self._spill_store.stop()
+
+    def _reschedule(self, tr):
+        for member in tr.get_members():
+            member.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+            self.get_queue(member).transactions.reschedule(member)
 
     def flush(self):
 
+        self._unspill()
+
         if self._trs_to_flush is not None:
             log.debug("A flush is already in progress, not doing anything")
             return
 
-        to_flush = []
-        # Do we have something to do ?
+        # Do we have something to do ? The transactions are rescheduled once
+        # this flush is done with them. Those of an open circuit wait for it
         now = datetime.utcnow()
-        for tr in self._transactions:
-            if tr.time_to_flush(now):
-                to_flush.append(tr)
+        timestamp = time.time()
+        to_flush = []
+        for queue in self._queues.itervalues():
+            if not queue.breaker.is_open(timestamp):
+                to_flush.extend(queue.transactions.pop_due(now))
 
         count = len(to_flush)
         should_log = self._flush_count + 1 <= FLUSH_LOGGING_INITIAL or (self._flush_count + 1) % FLUSH_LOGGING_PERIOD == 0
@@ -175,11 +877,11 @@ class TransactionManager(object):
             else:
                 log.debug("Flushing %s transaction%s during flush #%s" % (count,plural(count), str(self._flush_count + 1)))
 
-            self._endpoints_errors = {}
             self._finished_flushes = 0
 
             # We sort LIFO-style, taking into account errors
             self._trs_to_flush = sorted(to_flush, key=lambda tr: (- tr._error_count, tr._id))
+            self._batch_groups = {}
             self._flush_time = datetime.utcnow()
             self.flush_next()
         else:
@@ -193,13 +895,7 @@ class TransactionManager(object):
 
         self._flush_count += 1
 
-        ForwarderStatus(
-            queue_length=self._total_count,
-            queue_size=self._total_size,
-            flush_count=self._flush_count,
-            transactions_received=self._transactions_received,
-            transactions_flushed=self._transactions_flushed,
-            transactions_rejected=self._transactions_rejected).persist()
+        self._persist_status()
 
     def flush_next(self):
 
@@ -210,33 +906,38 @@ class TransactionManager(object):
                 for tr in self._trs_to_flush:
                     # Recompute these transactions' next flush so that if we hit the max queue size
                     # newer transactions are preserved
-                    tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+                    self._reschedule_pending(tr)
                 self._trs_to_flush = []
                 return self.flush_next()
 
-            td = self._last_flush + self._THROTTLING_DELAY - datetime.utcnow()
-            delay = td.total_seconds()
-
-            if delay <= 0 and self._running_flushes < self._MAX_PARALLELISM:
-                tr = self._trs_to_flush.pop()
+            now = time.time()
+            tr = self._pop_sendable(now)
+            if tr is not None:
+                members = self._pop_batch(tr)
+                queue = self.get_queue(tr)
+                queue.throttle.on_send()
+                queue.breaker.on_send()
                 self._running_flushes += 1
-                self._last_flush = datetime.utcnow()
-                log.debug("Flushing transaction %d", tr.get_id())
-                try:
-                    tr.flush()
-                except Exception as e:
-                    log.exception(e)
-                    self.tr_error(tr)
+                tornado_ioloop = ioloop.IOLoop.current()
+                if len(members) == 1:
+                    self._send(tr)
+                elif tornado_ioloop._running:
+                    self._merger.merge(members, tornado_ioloop, self._merged)
+                else:
+                    self._send_batch(members, merge_batch(members))
                 self.flush_next()
             # Every running flushes relaunches a flush once it's finished
-            # If we are already at MAX_PARALLELISM, do nothing
-            # Otherwise, schedule a flush as soon as possible (throttling)
-            elif self._running_flushes < self._MAX_PARALLELISM:
+            # If the endpoints are at their limit of requests in flight, do nothing
+            # Otherwise, schedule a flush once an endpoint is not blocked anymore
+            elif not self._flush_next_scheduled:
+                delay = self._next_unblocked(now)
+                if delay is None:
+                    return
                 # Wait a little bit more
                 tornado_ioloop = ioloop.IOLoop.current()
                 if tornado_ioloop._running:
-                    tornado_ioloop.add_timeout(time.time() + delay,
-                                               lambda: self.flush_next())
+                    self._flush_next_scheduled = True
+                    tornado_ioloop.add_timeout(now + delay, self._scheduled_flush_next)
                 elif self._flush_without_ioloop:
                     # Tornado is no started (ie, unittests), do it manually: BLOCKING
                     time.sleep(delay)
@@ -253,72 +954,219 @@ class TransactionManager(object):
         else:
             log.debug("Flush in progress, %s flushes running", self._running_flushes)
 
-    def tr_error(self, tr):
+    def _pop_sendable(self, now):
+        """
+        Pop the next transaction to flush whose endpoint is available.
+        """
+        trs = self._trs_to_flush
+        available = {}
+        for i in xrange(len(trs) - 1, -1, -1):
+            key = (trs[i]._endpoint, trs[i]._api_key)
+            if key not in available:
+                available[key] = self._queues[key].available(now)
+            if available[key]:
+                return trs.pop(i)
+            if len(available) == len(self._queues) and not any(available.itervalues()):
+                break
+        return None
+
+    def _pop_batch(self, tr):
+        """
+        Pop the transactions to flush that can be sent along with `tr`, up to
+        the max batch size, and return them after `tr`.
+        """
+        group = self._batch_groups.pop(id(tr), None)
+        if group is not None:
+            return group
+        key = tr.get_batch_key()
+        if not self._MAX_BATCH_SIZE or key is None:
+            return [tr]
+        size = tr.get_size()
+        members = [tr]
+        trs = self._trs_to_flush
+        for i in xrange(len(trs) - 1, -1, -1):
+            other = trs[i]
+            if (other._endpoint == tr._endpoint and other._api_key == tr._api_key and id(other) not in self._batch_groups
+                    and size + other.get_size() <= self._MAX_BATCH_SIZE and other.get_batch_key() == key):
+                members.append(other)
+                size += other.get_size()
+                if size >= self._MAX_BATCH_SIZE:
+                    break
+        if len(members) > 1:
+            popped = set(id(member) for member in members)
+            self._trs_to_flush = [pending for pending in trs if id(pending) not in popped]
+        return members
+
+    def _send(self, tr):
+        tr._sent_at = time.time()
+        log.debug("Flushing transaction %d", tr.get_id())
+        try:
+            tr.flush()
+        except Exception as e:
+            log.exception(e)
+            self.tr_error(tr)
+
+    def _send_batch(self, members, batch):
+        """
+        Send the batch merged from `members`, the members it left out are
+        flushed again on their own.
+        """
+        merged = set(id(member) for member in batch.get_members())
+        for member in members:
+            if id(member) not in merged:
+                self._flush_again([member])
+        self._send(batch)
+
+    def _merged(self, members, batch):
+        self._send_batch(members, batch)
+        self.flush_next()
+
+    def _flush_again(self, members):
+        """
+        Flush `members` again in a batch of their own.
+        """
+        self._batch_groups[id(members[0])] = members
+        self._trs_to_flush.append(members[0])
+
+    def _reschedule_pending(self, tr):
+        for member in self._batch_groups.pop(id(tr), [tr]):
+            self._reschedule(member)
+
+    def _next_unblocked(self, now):
+        """
+        Seconds until an endpoint blocked by a backoff can be flushed again,
+        None if every endpoint is waiting for its requests in flight.
+        """
+        delays = [queue.throttle.blocked_until - now for queue in self._queues.itervalues()
+                  if queue.throttle.blocked_until > now and queue.throttle.in_flight < int(queue.throttle.limit)
+                  and queue.breaker.state != CircuitBreaker.OPEN]
+        if delays:
+            return min(delays)
+        return None
+
+    def _scheduled_flush_next(self):
+        self._flush_next_scheduled = False
+        self.flush_next()
+
+    def tr_error(self, tr, retry_after=None, response_code=None):
+        """
+        Schedule the retry of a failed transaction, `response_code` is None if
+        no response was received.
+        """
         self._running_flushes -= 1
         self._finished_flushes += 1
-        tr.inc_error_count()
-        if tr.get_error_count() > self._MAX_ENDPOINT_ERRORS:
-            log.warn("Transaction %d failed too many (%d) times, removing",
-                     tr.get_id(),
-                     tr.get_error_count())
-            self._remove(tr)
-            self._transactions_flushed += 1
-            self.print_queue_stats()
-            self._transactions_rejected += 1
-            ForwarderStatus(
-                queue_length=self._total_count,
-                queue_size=self._total_size,
-                flush_count=self._flush_count,
-                transactions_received=self._transactions_received,
-                transactions_flushed=self._transactions_flushed,
-                transactions_rejected=self._transactions_rejected).persist()
-        else:
-            tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
-            log.warn("Transaction %d in error (%s error%s), it will be replayed after %s",
-                     tr.get_id(),
-                     tr.get_error_count(),
-                     plural(tr.get_error_count()),
-                     tr.get_next_flush())
-            self._endpoints_errors[tr._endpoint] = self._endpoints_errors.get(tr._endpoint, 0) + 1
-            # Endpoint failed too many times, it's probably an enpoint issue
-            # Let's avoid blocking on it
-            if self._endpoints_errors[tr._endpoint] == self._MAX_ENDPOINT_ERRORS:
-                new_trs_to_flush = []
-                for transaction in self._trs_to_flush:
-                    if transaction._endpoint != tr._endpoint:
-                        new_trs_to_flush.append(transaction)
-                    else:
-                        transaction.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
-                log.debug('Endpoint %s seems down, removed %s transaction from current flush',
-                          tr._endpoint,
-                          len(self._trs_to_flush) - len(new_trs_to_flush))
-
-                self._trs_to_flush = new_trs_to_flush
+        now = time.time()
+        queue = self.get_queue(tr)
+        # A 403 or a 404 says nothing about the load of the endpoint
+        congested = response_code is None or response_code in CONGESTION_CODES or response_code >= 500
+        queue.throttle.on_error(tr._sent_at or 0, now, retry_after, congested)
+        # The probes of a half-open circuit, and the requests still in flight
+        # when it opened, fail because the endpoint is down: the transactions
+        # wait for it without aging
+        counted = queue.breaker.state == CircuitBreaker.CLOSED
+        opened = queue.breaker.on_failure(now)
+        members = tr.get_members()
+        # A batch is a single request, its members share its error count: that
+        # of its freshest member, plus this failure
+        error_count = min(member.get_error_count() for member in members) + 1
+        for member in members:
+            if counted and member.get_error_count() < error_count:
+                member.inc_error_count()
+            if member.get_error_count() > self._MAX_ENDPOINT_ERRORS:
+                self._remove(member)
+                # Kept on disk through long outages, replayed once the
+                # endpoint is back
+                if self._spill(member):
+                    log.warn("Transaction %d failed too many (%d) times, moved to disk",
+                             member.get_id(),
+                             member.get_error_count())
+                else:
+                    log.warn("Transaction %d failed too many (%d) times, removing",
+                             member.get_id(),
+                             member.get_error_count())
+                    self._transactions_flushed += 1
+                    self._transactions_rejected += 1
+                self.print_queue_stats()
+                self._persist_status()
+            else:
+                self._reschedule(member)
+                queue.retries += 1
+                log.warn("Transaction %d in error (%s error%s), it will be replayed after %s",
+                         member.get_id(),
+                         member.get_error_count(),
+                         plural(member.get_error_count()),
+                         member.get_next_flush())
+
+        # Endpoint failed too many times, it's probably an enpoint issue
+        # Let's avoid blocking on it until its circuit is half-open
+        if opened and self._trs_to_flush is not None:
+            new_trs_to_flush = []
+            for transaction in self._trs_to_flush:
+                if self.get_queue(transaction) is not queue:
+                    new_trs_to_flush.append(transaction)
+                else:
+                    self._reschedule_pending(transaction)
+            log.warn('Endpoint %s seems down, opening its circuit for %ss, removed %s transaction from current flush',
+                     queue,
+                     queue.breaker.delay,
+                     len(self._trs_to_flush) - len(new_trs_to_flush))
+
+            self._trs_to_flush = new_trs_to_flush
 
     def tr_error_reject_request(self, tr, response_code):
         self._running_flushes -= 1
         self._finished_flushes += 1
-        tr.inc_error_count()
-        log.warn("Transaction %d has been rejected (code %d, size %sKB), it will not be replayed",
-                 tr.get_id(),
-                 response_code,
-                 tr.get_size() / 1024)
-        self._remove(tr)
-        self._transactions_flushed += 1
+        queue = self.get_queue(tr)
+        queue.throttle.on_reject()
+        # The endpoint is up, it answered
+        if queue.breaker.on_success():
+            log.info("Endpoint %s is back, closing its circuit", queue)
+        # The transactions of a batch too large are flushed again in halves,
+        # until it fits. Those of a batch rejected for another reason are
+        # flushed again on their own, to find the ones it was rejected for
+        if tr._batch is not None and len(tr._batch) > 1 and self._trs_to_flush is not None:
+            log.warn("Batch %d of %s transactions has been rejected (code %d, size %sKB), %s",
+                     tr.get_id(),
+                     len(tr._batch),
+                     response_code,
+                     tr.get_size() / 1024,
+                     "splitting it" if response_code == REQUEST_TOO_LARGE else "sending them one by one")
+            members = tr._batch
+            if response_code == REQUEST_TOO_LARGE:
+                half = len(members) // 2
+                self._flush_again(members[:half])
+                self._flush_again(members[half:])
+            else:
+                for member in members:
+                    self._flush_again([member])
+            return
+        for member in tr.get_members():
+            member.inc_error_count()
+            log.warn("Transaction %d has been rejected (code %d, size %sKB), it will not be replayed",
+                     member.get_id(),
+                     response_code,
+                     member.get_size() / 1024)
+            self._remove(member)
+            self._transactions_flushed += 1
+            self._transactions_rejected += 1
         self.print_queue_stats()
-        self._transactions_rejected += 1
-        ForwarderStatus(
-            queue_length=self._total_count,
-            queue_size=self._total_size,
-            flush_count=self._flush_count,
-            transactions_received=self._transactions_received,
-            transactions_flushed=self._transactions_flushed,
-            transactions_rejected=self._transactions_rejected).persist()
+        self._persist_status()
 
     def tr_success(self, tr):
         self._running_flushes -= 1
         self._finished_flushes += 1
+        now = time.time()
+        queue = self.get_queue(tr)
+        queue.throttle.on_success(now - (tr._sent_at or now))
+        if queue.breaker.on_success():
+            log.info("Endpoint %s is back, closing its circuit", queue)
         log.debug("Transaction %d completed",  tr.get_id())
-        self._remove(tr)
-        self._transactions_flushed += 1
+        queue.delivered_since_unspill = True
+        for member in tr.get_members():
+            self._remove(member)
+            self._transactions_flushed += 1
+            queue.delivered += 1
+            if member._created_at is not None:
+                queue.latency.add(now - member._created_at)
+        queue.throughput.add(len(tr.get_members()), tr.get_size(), now)
         self.print_queue_stats()
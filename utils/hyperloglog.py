@@ -0,0 +1,67 @@
+# stdlib
+from hashlib import md5
+import math
+import struct
+
+# 2 ** 14 one-byte registers: 16KB per counter, 0.8% standard error
+DEFAULT_PRECISION = 14
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+
+
+class HyperLogLog(object):
+    """
+    Approximate distinct counter using a fixed amount of memory: 2 ** precision
+    one-byte registers, with a standard error of 1.04 / sqrt(2 ** precision).
+    See http://algo.inria.fr/flajolet/Publications/FlFuGaMe07.pdf, small
+    cardinalities are estimated with linear counting.
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        precision = int(precision)
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError("Precision must be in [%s;%s]: %s" % (MIN_PRECISION, MAX_PRECISION, precision))
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif not isinstance(value, str):
+            value = str(value)
+        hashed = struct.unpack('<Q', md5(value).digest()[:8])[0]
+
+        index = hashed >> (64 - self.precision)
+        remaining_bits = 64 - self.precision
+        # Position of the leftmost 1 in the remaining bits
+        rank = remaining_bits - (hashed & ((1 << remaining_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge counters with different precisions: %s, %s"
+                             % (self.precision, other.precision))
+        registers = self.registers
+        for index, rank in enumerate(other.registers):
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def count(self):
+        size = self.size
+        if size == 16:
+            alpha = 0.673
+        elif size == 32:
+            alpha = 0.697
+        elif size == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / size)
+
+        estimate = alpha * size * size / sum(2.0 ** -rank for rank in self.registers)
+        if estimate <= 2.5 * size:
+            zeros = self.registers.count('\x00')
+            if zeros:
+                estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
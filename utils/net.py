@@ -4,6 +4,12 @@ import ctypes
 import time
 import random
 import socket
+import struct
+try:
+    import fcntl
+    import termios
+except ImportError:
+    fcntl = termios = None
 
 
 # 3p
@@ -26,8 +32,18 @@ try:
 except AttributeError:
     IPV6_V6ONLY = 27  # from `Ws2ipdef.h`
 
+# Python 2 does not expose SO_REUSEPORT, its value is the same on every Linux
+# architecture we ship on.
+try:
+    SO_REUSEPORT = socket.SO_REUSEPORT
+except AttributeError:
+    SO_REUSEPORT = 15  # from `asm-generic/socket.h`
+
 DEFAULT_DNS_TTL = 300
 
+# Kernel tables of the UDP sockets, on Linux
+PROC_NET_UDP_PATHS = ['/proc/net/udp', '/proc/net/udp6']
+
 class sockaddr(ctypes.Structure):
     _fields_ = [("sa_family", ctypes.c_short),
                 ("__pad1", ctypes.c_ushort),
@@ -85,3 +101,55 @@ try:
     from socket import inet_pton
 except ImportError:
     inet_pton = _inet_pton_win
+
+
+def get_udp_socket_stats(port=None, inode=None, paths=None):
+    """
+    Read the kernel counters of UDP sockets from /proc/net/udp and
+    /proc/net/udp6: the bytes waiting in their receive queues and the
+    datagrams they dropped. Sockets are matched by `inode` when given, by
+    local `port` otherwise. Returns a (rx_queue, drops) tuple summed over the
+    matching sockets, e.g. the SO_REUSEPORT ones, or None when no socket is
+    found or the tables are not available (not Linux).
+    """
+    rx_queue = drops = 0
+    found = False
+    for path in paths or PROC_NET_UDP_PATHS:
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            # sl local_address rem_address st tx_queue:rx_queue tr:tm->when retrnsmt uid timeout inode ref pointer drops
+            fields = line.split()
+            if len(fields) < 13:
+                continue
+            if inode is not None:
+                if int(fields[9]) != inode:
+                    continue
+            elif int(fields[1].rsplit(':', 1)[1], 16) != port:
+                continue
+            found = True
+            rx_queue += int(fields[4].split(':')[1], 16)
+            drops += int(fields[12])
+    if not found:
+        return None
+    return rx_queue, drops
+
+
+def get_socket_pending_bytes(sock):
+    """
+    Bytes pending in the receive queue of `sock`, read with the FIONREAD
+    (SIOCINQ) ioctl, or None when it is not available (Windows).
+
+    For datagram sockets Linux only reports the size of the datagram at the
+    head of the queue: a non-zero value tells that datagrams are still queued,
+    not how many.
+    """
+    if fcntl is None:
+        return None
+    try:
+        return struct.unpack('i', fcntl.ioctl(sock.fileno(), termios.FIONREAD, '\0' * 4))[0]
+    except (IOError, OSError):
+        return None
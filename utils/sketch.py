@@ -0,0 +1,170 @@
+# stdlib
+import math
+
+# Values are approximated within 1% of the exact ones by default
+DEFAULT_RELATIVE_ACCURACY = 0.01
+# Bounds the memory used by a sketch, with the default accuracy it covers
+# values spanning more than 17 orders of magnitude before collapsing
+DEFAULT_MAX_BINS = 2048
+# Values closer to zero are counted as zero
+MIN_INDEXABLE_VALUE = 1e-9
+
+
+class QuantileSketch(object):
+    """
+    Mergeable quantile sketch with a relative error guarantee, based on DDSketch
+    (http://www.vldb.org/pvldb/vol12/p2195-masson.pdf).
+
+    Values are counted in bins whose boundaries grow geometrically, so that
+    any value returned is within `relative_accuracy` of an exact one. Count,
+    sum, min and max are exact. When there are more than `max_bins` bins, the
+    lowest values are collapsed into the same bin.
+    """
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("Relative accuracy must be in ]0;1[: %s" % relative_accuracy)
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        # Counts by bin index, negative values are indexed by their absolute value
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _bin_value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        if value > MIN_INDEXABLE_VALUE:
+            index = int(math.ceil(math.log(value) / self.log_gamma))
+            self.positive[index] = self.positive.get(index, 0) + count
+        elif value < -MIN_INDEXABLE_VALUE:
+            index = int(math.ceil(math.log(-value) / self.log_gamma))
+            self.negative[index] = self.negative.get(index, 0) + count
+        else:
+            self.zero_count += count
+
+        self.count += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if len(self.positive) + len(self.negative) > self.max_bins:
+            self._collapse()
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with different relative accuracies: %s, %s"
+                             % (self.relative_accuracy, other.relative_accuracy))
+        if not other.count:
+            return
+
+        for bins, other_bins in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in other_bins.iteritems():
+                bins[index] = bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+
+        self.count += other.count
+        self.sum += other.sum
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+        if len(self.positive) + len(self.negative) > self.max_bins:
+            self._collapse()
+
+    def _collapse(self):
+        """
+        Merge the bins of the lowest values until there are `max_bins` bins left.
+        """
+        excess = len(self.positive) + len(self.negative) - self.max_bins
+        # The lowest values are in the negative bins of highest index, then in
+        # the positive bins of lowest index
+        for bins, indexes in ((self.negative, sorted(self.negative, reverse=True)),
+                              (self.positive, sorted(self.positive))):
+            collapsed = min(excess, len(indexes) - 1)
+            if collapsed <= 0:
+                continue
+            target = indexes[collapsed]
+            for index in indexes[:collapsed]:
+                bins[target] += bins.pop(index)
+            excess -= collapsed
+            if not excess:
+                return
+
+    def value_at_rank(self, rank):
+        """
+        Approximate value of rank `rank` (0-based) in the sorted values, a
+        negative rank counts from the end like a list index.
+        """
+        if not self.count:
+            return None
+        if rank < 0:
+            rank += self.count
+        if rank <= 0:
+            return self.min
+        if rank >= self.count - 1:
+            return self.max
+
+        seen = 0
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return self._clamp(-self._bin_value(index))
+        seen += self.zero_count
+        if seen > rank:
+            return self._clamp(0)
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._clamp(self._bin_value(index))
+        return self.max
+
+    def quantile(self, q):
+        """
+        Approximate value of the `q` quantile, `q` in [0;1].
+        """
+        return self.value_at_rank(int(round(q * (self.count - 1))))
+
+    def _clamp(self, value):
+        return min(max(value, self.min), self.max)
+
+    def to_dict(self):
+        """
+        Compact form of the sketch, merged by the backend across hosts. Bins are
+        sent as sorted lists of indexes and counts, the values counted in bin `i`
+        are within `relative_accuracy` of `2 * gamma ** i / (gamma + 1)`.
+        """
+        positive = sorted(self.positive.iteritems())
+        negative = sorted(self.negative.iteritems())
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'zeros': self.zero_count,
+            'bins': [[index for index, _ in positive], [count for _, count in positive]],
+            'negative_bins': [[index for index, _ in negative], [count for _, count in negative]],
+        }
+
+    @classmethod
+    def from_dict(cls, data, max_bins=DEFAULT_MAX_BINS):
+        sketch = cls(data['relative_accuracy'], max_bins)
+        sketch.positive = dict(zip(*data['bins']))
+        sketch.negative = dict(zip(*data['negative_bins']))
+        sketch.zero_count = data['zeros']
+        sketch.count = data['count']
+        sketch.sum = data['sum']
+        sketch.min = data['min']
+        sketch.max = data['max']
+        return sketch
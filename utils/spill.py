@@ -0,0 +1,385 @@
+"""
+Append-only store of records spilled to disk, used by the forwarder to keep
+the transactions that do not fit in memory.
+
+Records are appended to segment files of a directory, in streams named by a
+key so that each stream is replayed on its own. All the file operations run in a background thread so that callers, like the
+forwarder IOLoop, never wait for the disk: records to write are queued, and
+records to replay are read on request and handed back through a queue.
+"""
+# stdlib
+from collections import deque
+import errno
+import logging
+import os
+from Queue import Empty, Full, Queue
+import struct
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+OLDEST_FIRST = 'oldest'
+NEWEST_FIRST = 'newest'
+REPLAY_POLICIES = (OLDEST_FIRST, NEWEST_FIRST)
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024  # 256MB
+DEFAULT_MAX_AGE = 6 * 60 * 60  # 6 hours
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024  # 4MB
+# Writes are fsynced at most this often (in seconds)
+DEFAULT_FSYNC_INTERVAL = 1
+# Records waiting to be written, records are dropped once it's full
+DEFAULT_MAX_PENDING = 10000
+
+SEGMENT_SUFFIX = '.spill'
+# Header of a record: length of the record and time it was spilled at
+RECORD_HEADER = struct.Struct('!Id')
+
+
+class Segment(object):
+    __slots__ = ('seq', 'key', 'path', 'size', 'count', 'newest')
+
+    def __init__(self, seq, key, path, size=0, count=0, newest=None):
+        self.seq = seq
+        self.key = key
+        self.path = path
+        self.size = size
+        self.count = count
+        # Time of the newest record of the segment
+        self.newest = newest
+
+
+def read_segment(path):
+    """
+    Return the (timestamp, record) tuples of a segment file. A record cut by
+    a crash ends the segment.
+    """
+    records = []
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            length, timestamp = RECORD_HEADER.unpack(header)
+            record = f.read(length)
+            if len(record) < length:
+                log.warning("Spill segment %s is truncated, ignoring its last record", path)
+                break
+            records.append((timestamp, record))
+    return records
+
+
+class SpillStore(object):
+    """
+    Records spilled to the segments of directory `path`, by key. Keys name
+    the segment files and must not contain anything but letters and digits.
+
+    At most `max_size` bytes and records spilled less than `max_age` seconds
+    ago are kept: the oldest segments are deleted first, whatever their key.
+    The records of a key are replayed one segment at a time, in the order of
+    `replay_policy`, and their segment is deleted once the caller commits
+    them, see `commit_replayed`. Segments left by a previous process are
+    recovered when the store starts.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, max_age=DEFAULT_MAX_AGE, replay_policy=OLDEST_FIRST,
+                 segment_size=DEFAULT_SEGMENT_SIZE, fsync_interval=DEFAULT_FSYNC_INTERVAL,
+                 max_pending=DEFAULT_MAX_PENDING):
+        if replay_policy not in REPLAY_POLICIES:
+            raise ValueError("Unknown spill replay policy %r, expected one of %s" % (
+                replay_policy, ', '.join(REPLAY_POLICIES)))
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.replay_policy = replay_policy
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+
+        self._commands = Queue(max_pending)
+        # Records read for replay, by segment
+        self._replayed = Queue()
+        # Keys whose replay is requested and not done yet
+        self._replay_requested = set()
+        # Segments whose records were handed back, to delete once committed
+        self._uncommitted = []
+        self._thread = None
+
+        # Only used by the background thread
+        self._segments = {}  # by key, oldest first
+        # Segments read for replay, deleted once their records are committed
+        self._replaying = {}
+        self._next_seq = 0
+        self._files = {}  # Segment being written of each key
+        self._dirty = set()
+        self._last_fsync = 0
+
+        # Bytes and records on disk, records dropped or expired
+        self.size = 0
+        self.count = 0
+        self.dropped = 0
+        self.expired = 0
+        # Records on disk by key
+        self.counts = {}
+
+    def start(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._recover()
+        self._thread = threading.Thread(target=self._run, name='SpillStore')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Write the pending records and stop the background thread.
+        """
+        if self._thread is None:
+            return
+        self._commands.put(('stop', None))
+        self._thread.join()
+        self._thread = None
+
+    def put(self, key, record, timeout=None):
+        """
+        Queue a record to be written to disk, return False when it's dropped
+        because too many records are waiting. Waits up to `timeout` seconds
+        for room, not at all if it's None.
+        """
+        try:
+            self._commands.put(('put', (key, time.time(), record)), timeout is not None, timeout)
+        except Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def request_replay(self, key, max_bytes):
+        """
+        Ask for about `max_bytes` of the records of `key` to replay, they are
+        returned by `get_replayed` once read.
+        """
+        if key in self._replay_requested or max_bytes <= 0:
+            return
+        self._replay_requested.add(key)
+        try:
+            self._commands.put_nowait(('replay', (key, max_bytes)))
+        except Full:
+            self._replay_requested.discard(key)
+
+    def get_replayed(self):
+        """
+        Return the records read for replay so far. Their segments stay on disk
+        until `commit_replayed` is called.
+        """
+        records = []
+        while True:
+            try:
+                seq, segment_records = self._replayed.get_nowait()
+            except Empty:
+                return records
+            records.extend(segment_records)
+            self._uncommitted.append(seq)
+
+    def commit_replayed(self, block=False):
+        """
+        Delete the segments of the records returned by `get_replayed`, to call
+        once they are queued again: a crash in between replays them again on
+        restart instead of losing them.
+        """
+        if not self._uncommitted:
+            return
+        try:
+            self._commands.put(('commit', self._uncommitted), block)
+        except Full:
+            # Deleted with the next commit
+            return
+        self._uncommitted = []
+
+    def pending(self):
+        return self._commands.qsize()
+
+    def _recover(self):
+        segments = []
+        for name in os.listdir(self.path):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    seq, key = name[:-len(SEGMENT_SUFFIX)].split('-', 1)
+                    segments.append((int(seq), key))
+                except ValueError:
+                    continue
+        for seq, key in sorted(segments):
+            path = self._segment_path(seq, key)
+            records = read_segment(path)
+            if not records:
+                os.remove(path)
+                continue
+            segment = Segment(seq, key, path, os.path.getsize(path), len(records), records[-1][0])
+            self._segments.setdefault(key, deque()).append(segment)
+            self._add(segment, segment.size, segment.count)
+        if segments:
+            self._next_seq = max(segments)[0] + 1
+        if self.count:
+            log.info("Recovered %s spilled records (%s KB) from %s", self.count, self.size / 1024, self.path)
+        self._expire()
+
+    def _segment_path(self, seq, key):
+        return os.path.join(self.path, '%020d-%s%s' % (seq, key, SEGMENT_SUFFIX))
+
+    def _add(self, segment, size, count):
+        self.size += size
+        self.count += count
+        count += self.counts.get(segment.key, 0)
+        if count:
+            self.counts[segment.key] = count
+        else:
+            self.counts.pop(segment.key, None)
+
+    def _run(self):
+        running = True
+        while running:
+            try:
+                commands = [self._commands.get(timeout=self.fsync_interval)]
+            except Empty:
+                commands = []
+            # Drain the batch of commands, fsync once for all of its writes
+            while True:
+                try:
+                    commands.append(self._commands.get_nowait())
+                except Empty:
+                    break
+            for command, arg in commands:
+                try:
+                    if command == 'put':
+                        self._write(*arg)
+                    elif command == 'replay':
+                        self._replay(*arg)
+                    elif command == 'commit':
+                        self._commit(arg)
+                    elif command == 'stop':
+                        running = False
+                except Exception:
+                    log.exception("Spill store failed to %s records", command)
+                    if command == 'replay':
+                        self._replay_requested.discard(arg[0])
+            try:
+                self._sync(force=not running)
+                self._expire()
+            except Exception:
+                log.exception("Spill store failed to sync its segments")
+        for key in self._files.keys():
+            self._close_segment(key)
+
+    def _write(self, key, timestamp, record):
+        if key not in self._files:
+            seq = self._next_seq
+            self._next_seq += 1
+            segment = Segment(seq, key, self._segment_path(seq, key))
+            self._files[key] = open(segment.path, 'ab')
+            self._segments.setdefault(key, deque()).append(segment)
+        segment = self._segments[key][-1]
+        data = RECORD_HEADER.pack(len(record), timestamp) + record
+        self._files[key].write(data)
+        self._dirty.add(key)
+        segment.size += len(data)
+        segment.count += 1
+        segment.newest = timestamp
+        self._add(segment, len(data), 1)
+        if segment.size >= self.segment_size:
+            self._close_segment(key)
+
+    def _sync(self, force=False):
+        if not self._dirty:
+            return
+        now = time.time()
+        if force or now - self._last_fsync >= self.fsync_interval:
+            for key in self._dirty:
+                f = self._files[key]
+                f.flush()
+                os.fsync(f.fileno())
+            self._dirty.clear()
+            self._last_fsync = now
+
+    def _close_segment(self, key):
+        f = self._files.pop(key, None)
+        if f is None:
+            return
+        f.flush()
+        if key in self._dirty:
+            os.fsync(f.fileno())
+            self._dirty.discard(key)
+        f.close()
+
+    def _remove_segment(self, segment, delete=True):
+        segments = self._segments[segment.key]
+        if segment is segments[-1]:
+            self._close_segment(segment.key)
+        segments.remove(segment)
+        if not segments:
+            del self._segments[segment.key]
+        self._add(segment, -segment.size, -segment.count)
+        if delete:
+            self._delete_segment(segment)
+
+    def _delete_segment(self, segment):
+        try:
+            os.remove(segment.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _expire(self):
+        """
+        Delete the oldest segments until the store fits in its size and age caps.
+        """
+        deadline = time.time() - self.max_age
+        expired = []
+        for segments in self._segments.itervalues():
+            for segment in segments:
+                if segment.newest is None or segment.newest >= deadline:
+                    break
+                expired.append(segment)
+        for segment in expired:
+            self._drop_segment(segment)
+        while self.size > self.max_size and self._segments:
+            self._drop_segment(min((segments[0] for segments in self._segments.itervalues()),
+                                   key=lambda segment: segment.seq))
+
+    def _drop_segment(self, segment):
+        log.warning("Spill store is full or too old, dropping %s records (%s KB)",
+                    segment.count, segment.size / 1024)
+        self.expired += segment.count
+        self._remove_segment(segment)
+
+    def _replay(self, key, max_bytes):
+        deadline = time.time() - self.max_age
+        loaded = 0
+        while loaded < max_bytes and key in self._segments:
+            segments = self._segments[key]
+            if self.replay_policy == OLDEST_FIRST:
+                segment = segments[0]
+            else:
+                segment = segments[-1]
+            if segment is segments[-1]:
+                self._close_segment(key)
+            records = read_segment(segment.path)
+            if self.replay_policy == NEWEST_FIRST:
+                records.reverse()
+            replayed = []
+            for timestamp, record in records:
+                if timestamp < deadline:
+                    self.expired += 1
+                    continue
+                replayed.append(record)
+                loaded += len(record)
+            if replayed:
+                self._remove_segment(segment, delete=False)
+                self._replaying[segment.seq] = segment
+                self._replayed.put((segment.seq, replayed))
+            else:
+                self._remove_segment(segment)
+        self._replay_requested.discard(key)
+
+    def _commit(self, seqs):
+        for seq in seqs:
+            segment = self._replaying.pop(seq, None)
+            if segment is not None:
+                self._delete_segment(segment)